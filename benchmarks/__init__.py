@@ -0,0 +1,6 @@
+"""
+Performance benchmarks for pyspecpol.
+
+The classes follow the airspeed velocity (asv) conventions: `time_*` methods are timed and
+`setup` prepares the inputs outside of the timed region.
+"""
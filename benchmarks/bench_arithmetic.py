@@ -0,0 +1,79 @@
+"""
+Benchmarks for the arithmetic operators of PolData, in place versus out of place.
+
+The allocations are measured by their proxy, the peak memory traced by tracemalloc (which
+numpy reports its array buffers to): tracemalloc does not count the buffers that are freed
+again. Running this file directly prints it for a template subtraction loop, in bytes and in
+data blocks: the out of place loop allocates a new data block at every step, the in place
+loop at most one temporary column.
+"""
+
+import tracemalloc
+import numpy as np
+from pyspecpol.misc import PolData
+
+
+def _make_poldata(n, seed=0):
+    rng = np.random.RandomState(seed)
+    poldata = PolData()
+    poldata.wl = np.linspace(3500., 9000., n)
+    poldata.q, poldata.u = rng.normal(0., 1., n), rng.normal(0., 1., n)
+    poldata.dq, poldata.du = np.full(n, 0.3), np.full(n, 0.3)
+    return poldata
+
+
+def _subtract_out_of_place(poldata, template, n_steps):
+    for _ in range(n_steps):
+        poldata = poldata - template
+    return poldata
+
+
+def _subtract_in_place(poldata, template, n_steps):
+    for _ in range(n_steps):
+        poldata -= template
+    return poldata
+
+
+class TimeArithmetic(object):
+    params = [10**3, 10**5, 10**6]
+    param_names = ['n_pixels']
+
+    def setup(self, n):
+        self.poldata = _make_poldata(n)
+        self.template = _make_poldata(n, seed=1)
+
+    def time_subtract(self, n):
+        self.poldata - self.template
+
+    def time_copy(self, n):
+        # Reference for the in place operators below, which work on a fresh copy at every call
+        # (repeated operations on the same data would drift towards denormals or inf)
+        self.poldata.copy()
+
+    def time_subtract_in_place(self, n):
+        poldata = self.poldata.copy()
+        poldata -= self.template
+
+    def time_divide_in_place(self, n):
+        poldata = self.poldata.copy()
+        poldata /= self.template
+
+    def peakmem_subtract_loop(self, n):
+        _subtract_out_of_place(self.poldata, self.template, 10)
+
+    def peakmem_subtract_loop_in_place(self, n):
+        _subtract_in_place(self.poldata, self.template, 10)
+
+
+if __name__ == "__main__":
+    n, n_steps = 10**5, 100
+    print("{0} subtractions of {1} pixels".format(n_steps, n))
+    for label, func in (('out of place', _subtract_out_of_place),
+                        ('in place', _subtract_in_place)):
+        poldata, template = _make_poldata(n), _make_poldata(n, seed=1)
+        tracemalloc.start()
+        func(poldata, template, n_steps)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("{0:>14}: peak traced memory {1:>12} bytes ({2:.2f} data blocks)"
+              .format(label, peak, peak / poldata._data.nbytes))
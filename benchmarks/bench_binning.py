@@ -0,0 +1,41 @@
+"""
+Benchmarks for the spectral binning of the Stokes parameters.
+"""
+
+import numpy as np
+from pyspecpol.binning import rebin_stokes, adaptive_edges
+
+
+def _make_spectra(shape, seed=0):
+    rng = np.random.RandomState(seed)
+    wl = np.linspace(3500., 9000., shape[-1])
+    q, u = rng.normal(0., 1., shape), rng.normal(0., 1., shape)
+    dq, du = np.full(shape, 0.3), np.full(shape, 0.3)
+    flux = np.abs(rng.normal(100., 10., shape))
+    return wl, q, u, dq, du, flux
+
+
+class TimeRebin(object):
+    params = ([(10**4,), (10**6,), (100, 10**4)], [5., 50.])
+    param_names = ['shape', 'bin_width']
+
+    def setup(self, shape, width):
+        self.wl, self.q, self.u, self.dq, self.du, self.flux = _make_spectra(shape)
+
+    def time_rebin(self, shape, width):
+        rebin_stokes(self.wl, self.q, self.u, self.dq, self.du, bins=width)
+
+    def time_rebin_flux_weighted(self, shape, width):
+        rebin_stokes(self.wl, self.q, self.u, self.dq, self.du, bins=width, flux=self.flux)
+
+
+class TimeAdaptiveBinning(object):
+    params = ([10**4, 10**6], [3., 10.])
+    param_names = ['n_pixels', 'target_snr']
+
+    def setup(self, n, target_snr):
+        self.wl, self.q, self.u, self.dq, self.du, _ = _make_spectra((n,))
+        self.q += 1.
+
+    def time_adaptive_edges(self, n, target_snr):
+        adaptive_edges(self.wl, self.q, self.u, self.dq, self.du, target_snr)
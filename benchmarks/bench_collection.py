@@ -0,0 +1,62 @@
+"""
+Benchmarks for stacks of epochs: one PolDataCollection versus one PolData per epoch.
+"""
+
+import numpy as np
+from pyspecpol.misc import PolData
+from pyspecpol.collection import PolDataCollection
+
+
+def _make_epochs(n_epochs, n_wl, seed=0):
+    rng = np.random.RandomState(seed)
+    wl = np.linspace(3500., 9000., n_wl)
+    epochs = []
+    for i in range(n_epochs):
+        poldata = PolData()
+        poldata.wl = wl
+        poldata.q, poldata.u = rng.normal(0., 1., n_wl), rng.normal(0., 1., n_wl)
+        poldata.dq, poldata.du = np.full(n_wl, 0.3), np.full(n_wl, 0.3)
+        epochs.append(poldata)
+    return epochs
+
+
+class TimeStackedPolarisation(object):
+    params = [(50, 2000), (500, 2000)]
+    param_names = ['shape']
+
+    def setup(self, shape):
+        self.epochs = _make_epochs(*shape)
+        self.collection = PolDataCollection.from_poldata(self.epochs,
+                                                         times=np.arange(shape[0]))
+
+    def time_per_epoch(self, shape):
+        for poldata in self.epochs:
+            poldata.calc_pol()
+
+    def time_collection(self, shape):
+        self.collection.calc_pol()
+
+    def time_select_time(self, shape):
+        self.collection.select_time(10, 20)
+
+
+class TimeResample(object):
+    """ Resampling 1000 epochs sharing one grid: the interpolation plan is built once """
+    params = [(1000, 2000)]
+    param_names = ['shape']
+
+    def setup(self, shape):
+        self.epochs = _make_epochs(*shape)
+        self.times = np.arange(shape[0])
+        self.collection = PolDataCollection.from_poldata(self.epochs, times=self.times)
+        self.wl = np.linspace(4000., 8000., shape[1] // 2)
+
+    def time_from_poldata_resampled(self, shape):
+        PolDataCollection.from_poldata(self.epochs, times=self.times, wl=self.wl)
+
+    def time_collection_resample(self, shape):
+        self.collection.resample(self.wl)
+
+    def time_per_epoch_resample(self, shape):
+        for poldata in self.epochs:
+            poldata.resample(self.wl)
@@ -0,0 +1,65 @@
+"""
+Benchmarks of the core kernels over 10^3 to 10^7 pixels (loading csv files: see bench_io).
+
+The kernels are timed on 1D arrays, on stacked (n_epochs, n_wl) arrays with the same number
+of pixels, and on scalars (the cost of one call). `peakmem_*` methods record the peak memory.
+"""
+
+import numpy as np
+from pyspecpol.misc import calc_p, debias_polarisation, _pol_ang_and_err
+
+SIZES = [10**3, 10**4, 10**5, 10**6, 10**7]
+LAYOUTS = ['1d', 'stacked']
+# Number of epochs of the stacked layout
+N_EPOCHS = 100
+
+
+def _make_stokes(n, layout, seed=0):
+    """ q, u, dq, du with `n` pixels, as 1D arrays or (N_EPOCHS, n // N_EPOCHS) stacks """
+    rng = np.random.RandomState(seed)
+    shape = (n,) if layout == '1d' else (N_EPOCHS, n // N_EPOCHS)
+    q, u = rng.normal(0., 1., shape), rng.normal(0., 1., shape)
+    dq, du = np.abs(rng.normal(0.3, 0.1, shape)), np.abs(rng.normal(0.3, 0.1, shape))
+    return q, u, dq, du
+
+
+class TimeKernels(object):
+    params = (SIZES, LAYOUTS)
+    param_names = ['n_pixels', 'layout']
+    timeout = 300
+
+    def setup(self, n, layout):
+        self.q, self.u, self.dq, self.du = _make_stokes(n, layout)
+        self.p, self.dp = calc_p(self.q, self.u, self.dq, self.du, debiased=False)
+
+    def time_calc_p(self, n, layout):
+        calc_p(self.q, self.u, self.dq, self.du)
+
+    def time_debias_polarisation(self, n, layout):
+        debias_polarisation(self.p, self.dp)
+
+    def time_pol_ang_and_err(self, n, layout):
+        _pol_ang_and_err(self.q, self.u, self.dq, self.du)
+
+    def peakmem_calc_p(self, n, layout):
+        calc_p(self.q, self.u, self.dq, self.du)
+
+    def peakmem_debias_polarisation(self, n, layout):
+        debias_polarisation(self.p, self.dp)
+
+    def peakmem_pol_ang_and_err(self, n, layout):
+        _pol_ang_and_err(self.q, self.u, self.dq, self.du)
+
+
+class TimeKernelsScalar(object):
+    def setup(self):
+        self.q, self.u, self.dq, self.du = 1.2, -0.4, 0.3, 0.2
+
+    def time_calc_p(self):
+        calc_p(self.q, self.u, self.dq, self.du)
+
+    def time_debias_polarisation(self):
+        debias_polarisation(1.26, 0.3)
+
+    def time_pol_ang_and_err(self):
+        _pol_ang_and_err(self.q, self.u, self.dq, self.du)
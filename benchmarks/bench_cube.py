@@ -0,0 +1,36 @@
+"""
+Benchmarks for the memory mapped IFU cubes: maps of every pixel and integration over a
+wavelength range, on a cube read from disk.
+"""
+
+import shutil
+import tempfile
+import numpy as np
+from pyspecpol.cube import PolCube
+
+
+class TimeCube(object):
+    params = [(32, 32, 1000), (64, 64, 2000)]
+    param_names = ['shape']
+    timeout = 300
+
+    def setup(self, shape):
+        rng = np.random.RandomState(0)
+        self.directory = tempfile.mkdtemp()
+        PolCube(np.linspace(4000., 9000., shape[2]), rng.normal(0., 1., shape),
+                rng.normal(0., 1., shape), np.full(shape, 0.3), np.full(shape, 0.4)
+                ).save(self.directory)
+        self.cube = PolCube.open(self.directory)
+
+    def teardown(self, shape):
+        del self.cube
+        shutil.rmtree(self.directory)
+
+    def time_calc_pol(self, shape):
+        self.cube.calc_pol()
+
+    def time_integrate(self, shape):
+        self.cube.integrate(5000., 6000.)
+
+    def peakmem_integrate(self, shape):
+        self.cube.integrate(5000., 6000.)
@@ -0,0 +1,81 @@
+"""
+Benchmarks for the debiasing of the degree of polarisation.
+
+`_debias_loop` is the pixel by pixel implementation pyspecpol used before
+`debias_polarisation` was vectorised, it is kept here as the reference for the speedup.
+Running this file directly prints the speedup of each estimator over that loop.
+"""
+
+import timeit
+import numpy as np
+from pyspecpol.misc import debias_polarisation
+
+METHODS = ['wang', 'wardle-kronberg', 'mas']
+SIZES = [10**3, 10**5, 10**6]
+
+
+def _debias_loop(p, dp):
+    """ Former list comprehension implementation of the Wang et al. (1997) debiasing """
+    return [p[i] - (dp[i]**2)/p[i] if p[i] - dp[i] > 0 else p[i] for i in range(len(p))]
+
+
+def _make_p_dp(n, seed=0):
+    rng = np.random.RandomState(seed)
+    p = np.abs(rng.normal(1., 0.5, n))
+    dp = np.abs(rng.normal(0.5, 0.2, n))
+    return p, dp
+
+
+class TimeDebias(object):
+    params = (SIZES, METHODS)
+    param_names = ['n_pixels', 'method']
+
+    def setup(self, n, method):
+        self.p, self.dp = _make_p_dp(n)
+        self.out = np.empty(n)
+
+    def time_debias(self, n, method):
+        debias_polarisation(self.p, self.dp, method=method)
+
+    def time_debias_out(self, n, method):
+        debias_polarisation(self.p, self.dp, method=method, out=self.out)
+
+
+class TimeDebiasStacked(object):
+    params = ([(10, 10**4), (500, 2000)], METHODS)
+    param_names = ['shape', 'method']
+
+    def setup(self, shape, method):
+        p, dp = _make_p_dp(shape[0] * shape[1])
+        self.p, self.dp = p.reshape(shape), dp.reshape(shape)
+
+    def time_debias(self, shape, method):
+        debias_polarisation(self.p, self.dp, method=method)
+
+
+class TimeDebiasLoop(object):
+    params = SIZES
+    param_names = ['n_pixels']
+
+    def setup(self, n):
+        self.p, self.dp = _make_p_dp(n)
+
+    def time_loop(self, n):
+        _debias_loop(self.p, self.dp)
+
+
+def _best_of(func, repeat=3):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+if __name__ == "__main__":
+    print("{0:>10} {1:>16} {2:>12} {3:>12} {4:>9}".format('n_pixels', 'method', 'loop [s]',
+                                                           'kernel [s]', 'speedup'))
+    for n in SIZES:
+        p, dp = _make_p_dp(n)
+        t_loop = _best_of(lambda: _debias_loop(p, dp))
+        for method in METHODS:
+            t_kernel = _best_of(lambda: debias_polarisation(p, dp, method=method))
+            print("{0:>10} {1:>16} {2:>12.3e} {3:>12.3e} {4:>8.0f}x".format(n, method, t_loop,
+                                                                            t_kernel,
+                                                                            t_loop / t_kernel))
@@ -0,0 +1,158 @@
+"""
+Benchmarks for the input/output of PolData objects.
+
+Running this file directly prints the number of files loaded per second for small and
+large csv files, with each available pandas engine, and for the binary format.
+"""
+
+import os
+import shutil
+import tempfile
+import timeit
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+from pyspecpol.misc import PolData, COLUMNS
+from pyspecpol.fitsio import read_fits, stack_fits
+
+SIZES = [10**3, 10**5, 10**6]
+
+
+# wl, q, dq, u, du: the columns of a reduced spectrum
+REDUCED_COLUMNS = ('wl', 'q', 'dq', 'u', 'du')
+
+
+def _write_csv(directory, n, columns=COLUMNS, seed=0):
+    """ Writes a csv file with the PolData `columns` and `n` rows, returns its path """
+    rng = np.random.RandomState(seed)
+    filename = os.path.join(directory, 'poldata_{0}.csv'.format(n))
+    data = dict((name, rng.normal(0., 1., n)) for name in columns)
+    data['wl'] = np.linspace(3500., 9000., n)
+    pd.DataFrame(data, columns=columns).to_csv(filename, index=False)
+    return filename
+
+
+class TimeLoadFile(object):
+    params = ([10**3, 10**4, 10**5, 10**6, 10**7], ['reduced', 'all'])
+    param_names = ['n_pixels', 'columns']
+    timeout = 600
+
+    def setup(self, n, columns):
+        if columns == 'all' and n > 10**6:
+            # Gigabytes of csv: the reduced columns are enough to follow the scaling
+            raise NotImplementedError
+        self.directory = tempfile.mkdtemp()
+        self.filename = _write_csv(self.directory, n,
+                                   REDUCED_COLUMNS if columns == 'reduced' else COLUMNS)
+
+    def teardown(self, n, columns):
+        shutil.rmtree(self.directory)
+
+    def time_load_file(self, n, columns):
+        PolData(self.filename)
+
+    def peakmem_load_file(self, n, columns):
+        PolData(self.filename)
+
+
+class TimeBinary(object):
+    params = [10**5, 10**7]
+    param_names = ['n_pixels']
+    timeout = 300
+
+    def setup(self, n):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'poldata.pspol')
+        poldata = PolData()
+        poldata.wl = np.linspace(3500., 9000., n)
+        poldata.q = np.zeros(n)
+        poldata.u = np.zeros(n)
+        poldata.dq = np.ones(n)
+        poldata.du = np.ones(n)
+        poldata.save_binary(self.filename)
+
+    def teardown(self, n):
+        shutil.rmtree(self.directory)
+
+    def time_load_binary(self, n):
+        PolData().load_binary(self.filename)
+
+    def time_load_binary_select_wl(self, n):
+        poldata = PolData()
+        poldata.load_binary(self.filename)
+        poldata.select_wl(6000., 6010.).q.sum()
+
+
+class TimeFits(object):
+    """ One night of FITS products: `n_files` epochs of 10**5 pixels """
+    params = [10, 100]
+    param_names = ['n_files']
+    timeout = 300
+
+    def setup(self, n_files):
+        self.directory = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.filenames = []
+        for i in range(n_files):
+            poldata = PolData()
+            poldata.wl = np.linspace(3500., 9000., 10**5)
+            poldata.time = np.full(10**5, float(i))
+            for name in ('q', 'dq', 'u', 'du'):
+                setattr(poldata, name, rng.normal(0., 1., 10**5))
+            self.filenames.append(os.path.join(self.directory, 'obs{0}.fits'.format(i)))
+            poldata.save_fits(self.filenames[-1])
+
+    def teardown(self, n_files):
+        shutil.rmtree(self.directory)
+
+    def time_read_fits(self, n_files):
+        for filename in self.filenames:
+            read_fits(filename)
+
+    def time_stack_fits(self, n_files):
+        stack_fits(self.filenames)
+
+    def time_read_bytes(self, n_files):
+        # Reference: reading the files without parsing them
+        for filename in self.filenames:
+            with open(filename, 'rb') as f:
+                f.read()
+
+    def time_open_fits(self, n_files):
+        # Reference: astropy parsing the headers and reading the data of all the HDUs, the
+        # floor of read_fits
+        for filename in self.filenames:
+            with fits.open(filename, memmap=True, lazy_load_hdus=True) as hdul:
+                for hdu in hdul[1:]:
+                    np.array(hdu.data)
+
+
+def _engines():
+    # None lets load_file pick the engine
+    engines = [None, 'c']
+    try:
+        import pyarrow  # noqa: F401
+        engines.append('pyarrow')
+    except ImportError:
+        pass
+    return engines
+
+
+if __name__ == "__main__":
+    directory = tempfile.mkdtemp()
+    try:
+        print("{0:>10} {1:>8} {2:>14}".format('n_pixels', 'engine', 'files/s'))
+        for n in SIZES:
+            filename = _write_csv(directory, n)
+            for engine in _engines():
+                number = max(1, 10**5 // n)
+                t = min(timeit.repeat(lambda: PolData().load_file(filename, engine=engine),
+                                      number=number, repeat=3)) / number
+                print("{0:>10} {1:>8} {2:>14.1f}".format(n, engine or 'auto', 1 / t))
+
+            binary = os.path.join(directory, 'poldata_{0}.pspol'.format(n))
+            PolData(filename).save_binary(binary)
+            t = min(timeit.repeat(lambda: PolData().load_binary(binary), number=100, repeat=3)) / 100
+            print("{0:>10} {1:>8} {2:>14.1f}".format(n, 'binary', 1 / t))
+    finally:
+        shutil.rmtree(directory)
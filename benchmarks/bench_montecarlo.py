@@ -0,0 +1,39 @@
+"""
+Benchmarks for the Monte Carlo propagation of the errors on p and P.A.
+"""
+
+import numpy as np
+from pyspecpol.montecarlo import mc_p_and_pa
+
+
+class TimeMonteCarlo(object):
+    params = ([10**3, 10**4], [1000, 10000])
+    param_names = ['n_pixels', 'n_draws']
+
+    def setup(self, n, n_draws):
+        rng = np.random.RandomState(0)
+        self.q, self.u = rng.normal(0., 1., n), rng.normal(0., 1., n)
+        self.dq, self.du = np.full(n, 0.3), np.full(n, 0.3)
+        self.covqu = np.full(n, 0.01)
+
+    def time_mc_p_and_pa(self, n, n_draws):
+        mc_p_and_pa(self.q, self.u, self.dq, self.du, n_draws=n_draws, seed=1)
+
+    def time_mc_p_and_pa_correlated(self, n, n_draws):
+        mc_p_and_pa(self.q, self.u, self.dq, self.du, covqu=self.covqu, n_draws=n_draws, seed=1)
+
+    def peakmem_mc_p_and_pa(self, n, n_draws):
+        mc_p_and_pa(self.q, self.u, self.dq, self.du, n_draws=n_draws, seed=1)
+
+
+if __name__ == '__main__':
+    import time
+    bench = TimeMonteCarlo()
+    for n, n_draws in [(10**4, 10**4)]:
+        bench.setup(n, n_draws)
+        for n_jobs in (1, 4):
+            start = time.perf_counter()
+            mc_p_and_pa(bench.q, bench.u, bench.dq, bench.du, n_draws=n_draws, seed=1,
+                        n_jobs=n_jobs)
+            print('{0} pixels x {1} draws, n_jobs={2}: {3:.2f} s'
+                  .format(n, n_draws, n_jobs, time.perf_counter() - start))
@@ -0,0 +1,97 @@
+"""
+Benchmarks of the single precision mode: the same pipelines in float64 and in float32.
+
+The peak memory of float32 should be about half that of float64, and the kernels, which are
+bound by the memory bandwidth, correspondingly faster.
+"""
+
+import os
+import shutil
+import tempfile
+import numpy as np
+from pyspecpol.misc import PolData
+from pyspecpol.collection import PolDataCollection
+from pyspecpol.binning import rebin
+from pyspecpol.fitsio import read_fits
+
+DTYPES = ['float64', 'float32']
+
+
+def _make_poldata(n, dtype, seed=0):
+    rng = np.random.RandomState(seed)
+    poldata = PolData(dtype=dtype)
+    poldata.wl = np.linspace(3500., 9000., n)
+    poldata.q, poldata.u = rng.normal(0., 1., n), rng.normal(0., 1., n)
+    poldata.dq, poldata.du = np.abs(rng.normal(0.3, 0.1, n)), np.abs(rng.normal(0.3, 0.1, n))
+    return poldata
+
+
+class TimePrecisionKernels(object):
+    """ p, P.A. and binning of one spectrum of 10^7 pixels """
+    params = ([10**7], DTYPES)
+    param_names = ['n_pixels', 'dtype']
+    timeout = 300
+
+    def setup(self, n, dtype):
+        self.poldata = _make_poldata(n, dtype)
+
+    def time_calc_pol(self, n, dtype):
+        self.poldata.calc_pol()
+
+    def time_rebin(self, n, dtype):
+        rebin(self.poldata, 10.)
+
+    def peakmem_calc_pol(self, n, dtype):
+        self.poldata.copy().calc_pol()
+
+
+class TimePrecisionStack(object):
+    """ Stacking, resampling and p and P.A. of 500 epochs of 20000 pixels """
+    params = ([(500, 20000)], DTYPES)
+    param_names = ['shape', 'dtype']
+    timeout = 300
+
+    def setup(self, shape, dtype):
+        self.epochs = [_make_poldata(shape[1], dtype, seed=i) for i in range(shape[0])]
+        self.times = np.arange(shape[0])
+        self.collection = PolDataCollection.from_poldata(self.epochs, times=self.times)
+        self.wl = np.linspace(4000., 8000., shape[1] // 2)
+
+    def time_from_poldata(self, shape, dtype):
+        PolDataCollection.from_poldata(self.epochs, times=self.times)
+
+    def time_calc_pol(self, shape, dtype):
+        self.collection.calc_pol()
+
+    def time_resample(self, shape, dtype):
+        self.collection.resample(self.wl)
+
+    def peakmem_from_poldata_and_calc_pol(self, shape, dtype):
+        PolDataCollection.from_poldata(self.epochs, times=self.times).calc_pol()
+
+
+class TimePrecisionIO(object):
+    """ Reading a FITS file of 10^6 pixels and writing/reading it in the binary format """
+    params = ([10**6], DTYPES)
+    param_names = ['n_pixels', 'dtype']
+    timeout = 300
+
+    def setup(self, n, dtype):
+        self.directory = tempfile.mkdtemp()
+        poldata = _make_poldata(n, dtype)
+        self.fits = os.path.join(self.directory, 'poldata.fits')
+        self.binary = os.path.join(self.directory, 'poldata.pspol')
+        poldata.save_fits(self.fits)
+        self.poldata = poldata.calc_pol()
+
+    def teardown(self, n, dtype):
+        shutil.rmtree(self.directory)
+
+    def time_read_fits(self, n, dtype):
+        read_fits(self.fits, dtype=dtype)
+
+    def time_save_binary(self, n, dtype):
+        self.poldata.save_binary(self.binary)
+
+    def peakmem_read_fits(self, n, dtype):
+        read_fits(self.fits, dtype=dtype)
@@ -0,0 +1,24 @@
+"""
+Benchmarks for the reduction of o and e beam fluxes to Stokes q and u.
+"""
+
+import numpy as np
+from pyspecpol.reduction import beams_to_stokes, HWP_ANGLES
+
+
+class TimeReduction(object):
+    params = ([1, 100], [2000, 20000])
+    param_names = ['n_sets', 'n_wl']
+
+    def setup(self, n_sets, n_wl):
+        rng = np.random.RandomState(0)
+        shape = (n_sets, len(HWP_ANGLES), n_wl)
+        self.o = rng.poisson(1e4, shape).astype(float)
+        self.e = rng.poisson(1e4, shape).astype(float)
+        self.theta0 = np.linspace(-2., 2., n_wl)
+
+    def time_beams_to_stokes(self, n_sets, n_wl):
+        beams_to_stokes(self.o, self.e, theta0=self.theta0)
+
+    def peakmem_beams_to_stokes(self, n_sets, n_wl):
+        beams_to_stokes(self.o, self.e, theta0=self.theta0)
@@ -0,0 +1,43 @@
+"""
+Benchmarks for the Stokes q, u -> p, dp, P.A., dP.A. conversion.
+
+Compares the fused `calc_p_and_pa` with separate calls to `calc_p` and `calc_pa`.
+"""
+
+import numpy as np
+from pyspecpol.misc import calc_p, calc_pa, calc_p_and_pa
+
+
+def _make_stokes(shape, seed=0):
+    rng = np.random.RandomState(seed)
+    q = rng.normal(0., 1., shape)
+    u = rng.normal(0., 1., shape)
+    dq = np.abs(rng.normal(0.3, 0.1, shape))
+    du = np.abs(rng.normal(0.3, 0.1, shape))
+    return q, u, dq, du
+
+
+class TimeStokesToPol(object):
+    params = [10**3, 10**5, 10**6]
+    param_names = ['n_pixels']
+
+    def setup(self, n):
+        self.q, self.u, self.dq, self.du = _make_stokes(n)
+        self.out = tuple(np.empty(n) for _ in range(4))
+
+    def time_separate(self, n):
+        calc_p(self.q, self.u, self.dq, self.du)
+        calc_pa(self.q, self.u, self.dq, self.du)
+
+    def time_fused(self, n):
+        calc_p_and_pa(self.q, self.u, self.dq, self.du)
+
+    def time_fused_out(self, n):
+        calc_p_and_pa(self.q, self.u, self.dq, self.du, out=self.out)
+
+    def peakmem_separate(self, n):
+        calc_p(self.q, self.u, self.dq, self.du)
+        calc_pa(self.q, self.u, self.dq, self.du)
+
+    def peakmem_fused_out(self, n):
+        calc_p_and_pa(self.q, self.u, self.dq, self.du, out=self.out)
@@ -0,0 +1,183 @@
+"""
+Runs the benchmarks without asv and writes the results as JSON, to compare commits.
+
+    python -m benchmarks.run -o before.json
+    git checkout my-branch
+    python -m benchmarks.run -o after.json --compare before.json
+
+The benchmark classes are discovered in the benchmarks/bench_*.py modules, following the asv
+conventions (`params`, `param_names`, `setup`, `teardown`, `time_*` and `peakmem_*` methods).
+`time_*` results are the best wall time of `--repeat` runs in seconds. `peakmem_*` results are
+the peak memory in bytes traced by tracemalloc during one call (numpy reports its array
+buffers to tracemalloc), rather than the peak resident size recorded by asv.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import platform
+import itertools
+import importlib
+import subprocess
+import tracemalloc
+import timeit
+
+_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# Smallest total time of the calls timed together, so that fast calls are not dominated by the
+# resolution of the clock
+_MIN_TIME = 0.05
+
+
+def _benchmark_classes():
+    """ Yields (module name, class) of the benchmark classes of the bench_*.py modules """
+    for filename in sorted(os.listdir(_DIRECTORY)):
+        if not (filename.startswith('bench_') and filename.endswith('.py')):
+            continue
+        module_name = filename[:-3]
+        module = importlib.import_module('benchmarks.' + module_name)
+        for name in sorted(dir(module)):
+            cls = getattr(module, name)
+            if isinstance(cls, type) and cls.__module__ == module.__name__ and \
+                    any(attr.startswith(('time_', 'peakmem_')) for attr in dir(cls)):
+                yield module_name, cls
+
+
+def _parameter_sets(cls):
+    """ Combinations of the parameters of a benchmark class, as asv builds them """
+    params = getattr(cls, 'params', [])
+    if not getattr(cls, 'param_names', None):
+        return [()]
+    if len(cls.param_names) == 1:
+        return [(value,) for value in params]
+    return list(itertools.product(*params))
+
+
+def _time(func, repeat):
+    """ Best time of one call, over `repeat` runs of enough calls to last `_MIN_TIME` """
+    start = time.perf_counter()
+    func()
+    first = time.perf_counter() - start
+    number = max(1, int(_MIN_TIME / first)) if first > 0 else 1000
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def _peakmem(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(pattern=None, repeat=3, max_pixels=None, report=None):
+    """
+    Runs the benchmarks whose name ('module.Class.method(params)') matches the regular
+    expression `pattern`, skipping parameters 'n_pixels' larger than `max_pixels`.
+
+    Returns a dictionary of name: result.
+    """
+    results = {}
+    for module_name, cls in _benchmark_classes():
+        methods = sorted(attr for attr in dir(cls) if attr.startswith(('time_', 'peakmem_')))
+        for params in _parameter_sets(cls):
+            names = dict(zip(getattr(cls, 'param_names', []), params))
+            if max_pixels is not None and names.get('n_pixels', 0) > max_pixels:
+                continue
+            label = ', '.join(repr(value) for value in params)
+            selected = ['{0}.{1}.{2}({3})'.format(module_name, cls.__name__, method, label)
+                        for method in methods]
+            selected = [(method, name) for method, name in zip(methods, selected)
+                        if pattern is None or re.search(pattern, name)]
+            if not selected:
+                continue
+
+            bench = cls()
+            if hasattr(bench, 'setup'):
+                try:
+                    bench.setup(*params)
+                except NotImplementedError:
+                    # Parameter combination skipped, as in asv
+                    continue
+            try:
+                for method, name in selected:
+                    func = getattr(bench, method)
+                    call = lambda: func(*params)
+                    if method.startswith('time_'):
+                        results[name] = _time(call, repeat)
+                    else:
+                        results[name] = _peakmem(call)
+                    if report is not None:
+                        report(name, results[name])
+            finally:
+                if hasattr(bench, 'teardown'):
+                    bench.teardown(*params)
+    return results
+
+
+def compare(old, new, factor=1.2):
+    """
+    Compares two result dictionaries. Returns the (name, old, new, ratio) of the benchmarks in
+    both, and the names of those slower or bigger than `factor` times the old result.
+    """
+    rows, regressions = [], []
+    for name in sorted(set(old) & set(new)):
+        ratio = new[name] / old[name] if old[name] else float('inf')
+        rows.append((name, old[name], new[name], ratio))
+        if ratio > factor:
+            regressions.append(name)
+    return rows, regressions
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=_DIRECTORY,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _format(name, value):
+    if '.time_' in name:
+        return '{0:.3e} s'.format(value)
+    return '{0:.1f} MiB'.format(value / 2**20)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-b', '--bench', help='Regular expression selecting the benchmarks')
+    parser.add_argument('-o', '--output', help='JSON file to write the results to')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    parser.add_argument('--factor', type=float, default=1.2,
+                        help='Ratio above which a result is a regression (default: 1.2)')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timing runs')
+    parser.add_argument('--max-pixels', type=int, help='Skip larger n_pixels parameters')
+    args = parser.parse_args(args)
+
+    results = run(args.bench, repeat=args.repeat, max_pixels=args.max_pixels,
+                  report=lambda name, value: print('{0:<90} {1:>14}'
+                                                   .format(name, _format(name, value))))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'commit': _commit(), 'machine': platform.node(),
+                       'python': platform.python_version(), 'results': results}, f, indent=1,
+                      sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)['results']
+        rows, regressions = compare(old, results, factor=args.factor)
+        print('\n{0:<90} {1:>8}'.format('benchmark', 'ratio'))
+        for name, _, _, ratio in rows:
+            print('{0:<90} {1:>8.2f}{2}'.format(name, ratio, ' !' if name in regressions else ''))
+        if regressions:
+            print('\n{0} regression(s) above a factor {1}'.format(len(regressions), args.factor))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,5 +5,15 @@ from ._astropy_init import *
 
 if not _ASTROPY_SETUP_:
     from .misc import *
+    from .collection import *
+    from .isp import *
+    from .binning import *
+    from .montecarlo import *
+    from .reduction import *
+    from .instrumentation import *
+    from .precision import *
+    from .cube import *
+    from .fitsio import read_fits, read_fits_collection, stack_fits, write_fits
+    from .daskdata import DaskPolData
 
 
@@ -0,0 +1,296 @@
+"""
+Batch processing of spectropolarimetric data files: the `pyspecpol` command.
+
+Each file is loaded, optionally corrected for the ISP, its degree and angle of polarisation are
+calculated and the result is written in the chosen format. The files are independent, so they
+are spread over a pool of processes (one file per task, no shared state) and the throughput
+grows with the number of cores.
+
+    pyspecpol 'night1/*.csv' night2/ -o reduced/ -j 64 --format binary --isp 1.2 5500 30
+
+The outputs mirror the input directories below their common parent directory (here
+reduced/night1/ and reduced/night2/), so files of the same name do not overwrite each other.
+"""
+
+import os
+import sys
+import glob
+import time
+import collections
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from .misc import PolData
+from .isp import remove_isp
+from .precision import _float_dtype
+
+# Extension of the output files for each format
+OUTPUT_FORMATS = {'csv': '.csv', 'binary': '.pspol', 'fits': '.fits'}
+# Files picked up in a directory given as input
+_INPUT_EXTENSIONS = ('.csv', '.txt', '.dat', '.pspol', '.fits', '.fit')
+
+
+def find_files(inputs, output_dir=None):
+    """
+    Expands directories and glob patterns into a sorted list of files (without duplicates).
+
+    Parameters
+    ----------
+    inputs : list of str
+        Files, directories (their files with a data extension are used) or glob patterns
+    output_dir : str, optional
+        Output directory of the batch: the outputs of previous runs it contains (files named
+        <name>_pol<extension>) are skipped if it is also an input.
+
+    Returns
+    -------
+    list of str
+    """
+    files = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            files.update(os.path.join(pattern, name) for name in os.listdir(pattern)
+                         if os.path.splitext(name)[1].lower() in _INPUT_EXTENSIONS)
+        else:
+            files.update(path for path in glob.glob(pattern) if os.path.isfile(path))
+    if output_dir is not None:
+        files = [filename for filename in files if not _is_output(filename, output_dir)]
+    return sorted(files)
+
+
+def _is_output(filename, output_dir):
+    """ Whether `filename` is in `output_dir` (or below) and named like an output file """
+    name, extension = os.path.splitext(os.path.basename(filename))
+    if not name.endswith('_pol') or extension not in OUTPUT_FORMATS.values():
+        return False
+    output_dir = os.path.realpath(output_dir)
+    return os.path.realpath(filename).startswith(os.path.join(output_dir, ''))
+
+
+def output_path(filename, output_dir, output_format, keep_extension=False):
+    """
+    Path of the output file of `filename`: <output_dir>/<name>_pol<extension>, or
+    <output_dir>/<name>_<input extension>_pol<extension> if `keep_extension` is True.
+    """
+    name, input_extension = os.path.splitext(os.path.basename(filename))
+    if keep_extension and input_extension:
+        name += '_' + input_extension[1:]
+    return os.path.join(output_dir, name + '_pol' + OUTPUT_FORMATS[output_format])
+
+
+def output_paths(files, output_dir, output_format):
+    """
+    Paths of the output files of `files`, all different (see `output_path`).
+
+    The input directories are mirrored in `output_dir` below their common parent directory, and
+    the input extension is kept in the names of files which only differ by their extension
+    (e.g. obs.csv and obs.fits give obs_csv_pol.pspol and obs_fits_pol.pspol).
+
+    Parameters
+    ----------
+    files : list of str
+        Input files
+    output_dir : str
+        Output directory
+    output_format : str
+        'binary', 'fits' or 'csv'
+
+    Returns
+    -------
+    list of str, in the order of `files`
+    """
+    if not files:
+        return []
+    directories = [os.path.dirname(os.path.abspath(filename)) for filename in files]
+    common = os.path.commonpath(directories)
+    directories = [os.path.normpath(os.path.join(output_dir, os.path.relpath(directory, common)))
+                   for directory in directories]
+
+    outputs = [output_path(filename, directory, output_format)
+               for filename, directory in zip(files, directories)]
+    counts = collections.Counter(outputs)
+    outputs = [output_path(filename, directory, output_format, keep_extension=True)
+               if counts[output] > 1 else output
+               for filename, directory, output in zip(files, directories, outputs)]
+
+    duplicates = sorted(output for output, count in collections.Counter(outputs).items()
+                        if count > 1)
+    if duplicates:
+        raise ValueError("Several input files would be written to {0}."
+                         .format(", ".join(duplicates)))
+    return outputs
+
+
+def process_file(filename, output, output_format='binary', isp=None, debiased=True,
+                 method='wang', dtype=None):
+    """
+    Load -> (ISP removal) -> p and P.A. -> write, for one file.
+
+    Parameters
+    ----------
+    filename : str
+        Input file: pyspecpol binary (.pspol), FITS (.fits, .fit) or CSV (see
+        `PolData.load_file`)
+    output : str
+        Output file
+    output_format : str, optional
+        'binary' (default), 'fits' or 'csv'
+    isp : dict, optional
+        Keyword arguments of `remove_isp` (p_max, wl_max, theta, ...). Default is no ISP removal.
+    debiased : bool, optional
+        Default is True. Debiases the degree of polarisation.
+    method : str, optional
+        Debiasing estimator, see `debias_polarisation`. Default is 'wang'.
+    dtype : str or numpy.dtype, optional
+        Precision of the calculations and of the output, 'float32' or 'float64'. Default is
+        the current precision (see `precision.set_precision`).
+
+    Returns
+    -------
+    Time taken in seconds
+    """
+    start = time.perf_counter()
+    dtype = _float_dtype(dtype)
+    poldata = PolData(dtype=dtype)
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == OUTPUT_FORMATS['binary']:
+        poldata.load_binary(filename)
+        if poldata.dtype != dtype:
+            # Binary files are mapped in their own precision
+            poldata = poldata.astype(dtype)
+    elif extension in ('.fits', '.fit'):
+        poldata.load_fits(filename)
+    else:
+        poldata.load_file(filename)
+
+    if isp is not None:
+        remove_isp(poldata, in_place=True, **isp)
+    poldata.calc_pol(debiased=debiased, method=method)
+
+    if output_format == 'csv':
+        poldata.save_csv(output)
+    elif output_format == 'fits':
+        poldata.save_fits(output, overwrite=True)
+    else:
+        poldata.save_binary(output)
+    return time.perf_counter() - start
+
+
+def _process_task(task):
+    """ Runs `process_file` in a worker, returning the error message instead of raising """
+    filename, output, kwargs = task
+    try:
+        return filename, output, process_file(filename, output, **kwargs), None
+    except Exception as error:
+        return filename, output, None, '{0}: {1}'.format(type(error).__name__, error)
+
+
+def run_batch(files, output_dir, output_format='binary', n_jobs=1, isp=None, debiased=True,
+              method='wang', report=None, dtype=None):
+    """
+    Processes files with `process_file`, over a pool of `n_jobs` processes.
+
+    Parameters
+    ----------
+    files : list of str
+        Input files
+    output_dir : str
+        Directory of the output files (created if needed), see `output_paths` for their names
+    output_format : str, optional
+        'binary' (default), 'fits' or 'csv'
+    n_jobs : int, optional
+        Number of processes. Default is 1 (no process pool).
+    isp, debiased, method : optional
+        See `process_file`
+    report : callable, optional
+        Called with each result as soon as its file is done, e.g. to print progress.
+    dtype : str or numpy.dtype, optional
+        See `process_file`. The current precision is passed on to the worker processes.
+
+    Returns
+    -------
+    List of (input file, output file, time in seconds or None, error message or None), in the
+    order of `files`.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("Unknown output format '{0}', use one of {1}."
+                         .format(output_format, sorted(OUTPUT_FORMATS)))
+    outputs = output_paths(files, output_dir, output_format)
+    for directory in set([output_dir] + [os.path.dirname(output) for output in outputs]):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    kwargs = {'output_format': output_format, 'isp': isp, 'debiased': debiased, 'method': method,
+              'dtype': _float_dtype(dtype)}
+    tasks = [(filename, output, kwargs) for filename, output in zip(files, outputs)]
+
+    results = {}
+    if n_jobs == 1 or len(tasks) <= 1:
+        for task in tasks:
+            results[task[0]] = _process_task(task)
+            if report is not None:
+                report(results[task[0]])
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [pool.submit(_process_task, task) for task in tasks]
+            for future in as_completed(futures):
+                result = future.result()
+                results[result[0]] = result
+                if report is not None:
+                    report(result)
+    return [results[filename] for filename in files]
+
+
+def _print_result(result):
+    filename, output, elapsed, error = result
+    if error is None:
+        print('{0} -> {1} ({2:.3f} s)'.format(filename, output, elapsed))
+    else:
+        print('{0} FAILED ({1})'.format(filename, error), file=sys.stderr)
+
+
+def main(args=None):
+    """ Entry point of the `pyspecpol` command """
+    parser = argparse.ArgumentParser(
+        prog='pyspecpol',
+        description='Calculates the degree and angle of polarisation of a batch of data files '
+                    '(load, optional ISP removal, p and P.A., write) over a pool of processes.')
+    parser.add_argument('inputs', nargs='+',
+                        help='Data files, directories or glob patterns (quote them)')
+    parser.add_argument('-o', '--output-dir', default='.',
+                        help='Directory of the output files (default: current directory)')
+    parser.add_argument('-f', '--format', default='binary', choices=sorted(OUTPUT_FORMATS),
+                        help='Output format (default: binary)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Number of processes (default: number of CPUs)')
+    parser.add_argument('--isp', nargs=3, type=float, metavar=('P_MAX', 'WL_MAX', 'THETA'),
+                        help='Removes a Serkowski law ISP with these parameters')
+    parser.add_argument('--isp-k', type=float, default=1.15,
+                        help='Width parameter K of the ISP (default: 1.15)')
+    parser.add_argument('--method', default='wang',
+                        help="Debiasing estimator (default: 'wang')")
+    parser.add_argument('--no-debias', action='store_true',
+                        help='Do not debias the degree of polarisation')
+    parser.add_argument('--float32', action='store_true',
+                        help='Calculate and write the results in single precision, '
+                             'with half the memory and file size')
+    args = parser.parse_args(args)
+
+    files = find_files(args.inputs, output_dir=args.output_dir)
+    if not files:
+        parser.error('No input files found.')
+
+    isp = None
+    if args.isp is not None:
+        p_max, wl_max, theta = args.isp
+        isp = {'p_max': p_max, 'wl_max': wl_max, 'theta': theta, 'k': args.isp_k}
+
+    start = time.perf_counter()
+    results = run_batch(files, args.output_dir, output_format=args.format, n_jobs=args.jobs,
+                        isp=isp, debiased=not args.no_debias, method=args.method,
+                        report=_print_result, dtype='float32' if args.float32 else None)
+    total = time.perf_counter() - start
+
+    n_failed = sum(error is not None for _, _, _, error in results)
+    print('{0} files processed in {1:.3f} s with {2} process(es), {3} failed'
+          .format(len(results), total, min(args.jobs, len(results)), n_failed))
+    return 1 if n_failed else 0
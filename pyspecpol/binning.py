@@ -0,0 +1,371 @@
+"""
+Spectral binning of the Stokes parameters.
+
+The binning is done with segment reductions (numpy.add.reduceat) over contiguous pixel ranges,
+so it runs in linear time and works along the last axis of (n_epochs, n_wl) stacks. The
+adaptive binning finds its bins from cumulative sums, also in linear time.
+
+The binned values keep the precision of the data (see `precision`), but all the sums are
+accumulated in float64: the cumulative sums of the adaptive binning in particular would lose
+the S/N of the bins to rounding errors in float32.
+"""
+
+import numpy as np
+from .misc import PolData
+from .collection import PolDataCollection
+from .precision import _as_float, _result_dtype
+
+# Speed of light in km/s, for velocity bins
+C_KMS = 299792.458
+# Number of float32 pixels summed in float32 before the float64 accumulation, see `_segment_sum`
+_SUM_BLOCK = 1024
+
+
+def velocity_edges(wl_min, wl_max, dv):
+    """
+    Bin edges of constant width in velocity space (logarithmic in wavelength).
+
+    Parameters
+    ----------
+    wl_min, wl_max : float
+        Wavelength range to cover
+    dv : float
+        Width of the bins in km/s
+
+    Returns
+    -------
+    numpy.ndarray of bin edges (wavelength units)
+    """
+    n_bins = int(np.ceil(np.log(wl_max / wl_min) / np.log1p(dv / C_KMS)))
+    return wl_min * (1 + dv / C_KMS) ** np.arange(n_bins + 1)
+
+
+def _bin_edges(wl, bins):
+    """ Bin edges from `bins`: an array of edges or a bin width starting at wl[0] """
+    if np.ndim(bins) == 0:
+        n_bins = int(np.floor((wl[-1] - wl[0]) / bins)) + 1
+        return wl[0] + bins * np.arange(n_bins + 1)
+    return np.asarray(bins, dtype=float)
+
+
+def _segment_sum(values, starts):
+    """
+    Sums `values` over the segments starting at `starts` (last axis, starts[0] = 0), in one
+    pass. The sums are accumulated in float64: float32 values are summed over blocks of at most
+    `_SUM_BLOCK` pixels in float32 (exact enough with numpy's pairwise summation, and much
+    faster than converting every value), then the blocks are summed in float64.
+    """
+    if values.dtype == np.float64:
+        return np.add.reduceat(values, starts, axis=-1)
+    block_starts = np.union1d(starts, np.arange(0, values.shape[-1], _SUM_BLOCK))
+    blocks = np.add.reduceat(values, block_starts, axis=-1)
+    return np.add.reduceat(blocks, np.searchsorted(block_starts, starts), axis=-1,
+                           dtype=np.float64)
+
+
+def _segments(wl, bins):
+    """
+    Pixel ranges of the bins: (bin centres, first and last pixel covered, mask of the
+    non-empty bins, start of each non-empty bin relative to `first`, number of pixels per bin)
+    """
+    edges = _bin_edges(wl, bins)
+    centres = 0.5 * (edges[1:] + edges[:-1])
+    # Edges in the precision of `wl`, so that float32 wavelengths are not converted
+    bounds = np.searchsorted(wl, edges.astype(wl.dtype), side='left')
+    lengths = np.diff(bounds)
+    filled = lengths > 0
+    starts = bounds[:-1][filled] - bounds[0]
+    return centres, bounds[0], bounds[-1], filled, starts, lengths
+
+
+def _sum_weights(flux, shape, first, last, starts, filled, lengths, dtype):
+    """ Weights (None if uniform, of `dtype` otherwise) and their sum over each non-empty bin """
+    if flux is None:
+        # Uniform weights: the sum of the weights is the number of pixels
+        return None, lengths[filled].astype(float)
+    weights = np.asarray(flux, dtype=dtype)[..., first:last]
+    return weights, np.abs(_segment_sum(np.broadcast_to(weights, shape), starts))
+
+
+def rebin_stokes(wl, q, u, dq=None, du=None, bins=None, flux=None):
+    """
+    Flux weighted binning of Stokes q and u, with error propagation.
+
+    Notes
+    -----
+    1) In each bin: q = sum(w q) / sum(w) and dq = sqrt(sum((w dq)**2)) / sum(w), and the
+    same for u, where the weights w are the flux (Stokes I) or 1 if no flux is given.
+
+    2) The wavelengths must be sorted in increasing order. Pixels outside of the bins are
+    ignored and empty bins are NaN. q, u, ... can be (n_epochs, n_wl) stacks sharing `wl`.
+
+    3) The binned q, u, dq and du have the precision of q and u (float32 or float64), the sums
+    are accumulated in float64.
+
+    Parameters
+    ----------
+    wl : numpy.ndarray
+        Wavelengths
+    q, u : numpy.ndarray
+        Stokes parameters
+    dq, du : numpy.ndarray, optional
+        Errors on the Stokes parameters
+    bins : float or numpy.ndarray
+        Width of the bins (starting at wl[0]) or bin edges, e.g. from `velocity_edges`
+    flux : numpy.ndarray, optional
+        Stokes I, used as weights.
+
+    Returns
+    -------
+    Tuple(wl, q, u, dq, du) of the bins -- wl is the centre of the bins, dq and du are None if
+    not given.
+    """
+    wl = _as_float(wl)
+    # Pixel index range of each bin, and the part of the arrays covered by the bins
+    centres, first, last, filled, starts, lengths = _segments(wl, bins)
+
+    dtype = _result_dtype(q, u, dq, du)
+    q = np.asarray(q, dtype=dtype)[..., first:last]
+    u = np.asarray(u, dtype=dtype)[..., first:last]
+    out_shape = q.shape[:-1] + (len(centres),)
+    if not np.any(filled):
+        empty = np.full(out_shape, np.nan, dtype=dtype)
+        return centres, empty, empty.copy(), \
+            None if dq is None else empty.copy(), None if du is None else empty.copy()
+
+    weights, sum_weights = _sum_weights(flux, q.shape, first, last, starts, filled, lengths,
+                                        dtype)
+
+    results = []
+    for values, errors in ((q, dq), (u, du)):
+        if weights is not None:
+            values = weights * values
+        binned = np.full(out_shape, np.nan, dtype=dtype)
+        binned[..., filled] = _segment_sum(values, starts) / sum_weights
+        results.append(binned)
+
+        if errors is None:
+            results.append(None)
+            continue
+        errors = np.asarray(errors, dtype=dtype)[..., first:last]
+        variance = np.square(errors if weights is None else weights * errors)
+        binned_errors = np.full(out_shape, np.nan, dtype=dtype)
+        binned_errors[..., filled] = np.sqrt(_segment_sum(variance, starts)) / sum_weights
+        results.append(binned_errors)
+
+    q_bin, dq_bin, u_bin, du_bin = results
+    return centres, q_bin, u_bin, dq_bin, du_bin
+
+
+def rebin_covariance(wl, covqu, bins, flux=None):
+    """
+    Covariance of the q and u binned by `rebin_stokes`: sum(w**2 covqu) / sum(w)**2.
+
+    Parameters
+    ----------
+    wl : numpy.ndarray
+        Wavelengths
+    covqu : numpy.ndarray
+        Covariance of q and u
+    bins : float or numpy.ndarray
+        Width of the bins (starting at wl[0]) or bin edges
+    flux : numpy.ndarray, optional
+        Stokes I, used as weights.
+
+    Returns
+    -------
+    numpy.ndarray -- NaN for the empty bins
+    """
+    wl = _as_float(wl)
+    centres, first, last, filled, starts, lengths = _segments(wl, bins)
+    dtype = _result_dtype(covqu)
+    covqu = np.asarray(covqu, dtype=dtype)[..., first:last]
+    binned = np.full(covqu.shape[:-1] + (len(centres),), np.nan, dtype=dtype)
+    if not np.any(filled):
+        return binned
+
+    weights, sum_weights = _sum_weights(flux, covqu.shape, first, last, starts, filled,
+                                        lengths, dtype)
+    if weights is not None:
+        covqu = np.square(weights) * covqu
+    binned[..., filled] = _segment_sum(covqu, starts) / np.square(sum_weights)
+    return binned
+
+
+def rebin(data, bins, flux=None):
+    """
+    Flux weighted binning of a PolData object or of all the epochs of a PolDataCollection.
+    See `rebin_stokes`.
+
+    Parameters
+    ----------
+    data : PolData or PolDataCollection
+        Data with wavelengths and Stokes q and u
+    bins : float or numpy.ndarray
+        Width of the bins (starting at the first wavelength) or bin edges
+    flux : numpy.ndarray, optional
+        Stokes I, used as weights. Can be (n_epochs, n_wl) for a collection.
+
+    Returns
+    -------
+    PolData or PolDataCollection with the binned wl, q, u, dq, du and covqu (p, dp, pa and dpa
+    need to be recalculated, e.g. with `calc_pol`).
+    """
+    if not isinstance(data, (PolData, PolDataCollection)):
+        raise TypeError("`data` should be a PolData or a PolDataCollection object.")
+    if data.wl is None or data.q is None or data.u is None:
+        raise ValueError("Binning needs the wavelengths and Stokes q and u.")
+
+    wl, q, u, dq, du = rebin_stokes(data.wl, data.q, data.u, dq=data.dq, du=data.du,
+                                    bins=bins, flux=flux)
+
+    if isinstance(data, PolDataCollection):
+        binned = PolDataCollection(wl, data.time, dtype=data.dtype)
+    else:
+        binned = PolData(dtype=data.dtype)
+        binned.wl = wl
+    binned.q, binned.u = q, u
+    if dq is not None:
+        binned.dq = dq
+    if du is not None:
+        binned.du = du
+    if data.covqu is not None:
+        binned.covqu = rebin_covariance(data.wl, data.covqu, bins, flux=flux)
+    return binned
+
+
+### ADAPTIVE BINNING ###
+
+def adaptive_edges(wl, q, u, dq, du, target_snr, merge_last=True, covqu=None):
+    """
+    Bin edges such that the degree of polarisation of each bin reaches a target S/N (p/dp).
+
+    Notes
+    -----
+    1) Starting from the blue end, each bin grows pixel by pixel until p/dp >= target_snr,
+    with p and dp of the bin calculated from the mean q and u as in `_pol_deg_and_err`.
+
+    2) The S/N of all the candidate bins is computed from cumulative sums of q, u, dq**2,
+    du**2 (and covqu), over windows that double in size until the target is reached, so the whole
+    spectrum is processed in linear time.
+
+    3) The edges are half way between pixels, so they can be reused with `rebin_stokes` for
+    other epochs on the same grid.
+
+    Parameters
+    ----------
+    wl : numpy.ndarray
+        Wavelengths (increasing)
+    q, u, dq, du : numpy.ndarray
+        Stokes parameters and their errors (1D)
+    target_snr : float
+        S/N of the degree of polarisation to reach in each bin
+    merge_last : bool, optional
+        Whether to merge the last bin into the previous one if it does not reach the target.
+        Default is True.
+    covqu : numpy.ndarray, optional
+        Covariance of q and u (1D). Default is None (uncorrelated).
+
+    Returns
+    -------
+    numpy.ndarray of bin edges (wavelength units)
+    """
+    wl = np.asarray(wl, dtype=float)
+    n = len(wl)
+    zero = np.zeros(1)
+    # The sums of the bins are differences of cumulative sums: float64 whatever the data
+    cum_q = np.concatenate((zero, np.cumsum(q, dtype=np.float64)))
+    cum_u = np.concatenate((zero, np.cumsum(u, dtype=np.float64)))
+    cum_var_q = np.concatenate((zero, np.cumsum(np.square(dq), dtype=np.float64)))
+    cum_var_u = np.concatenate((zero, np.cumsum(np.square(du), dtype=np.float64)))
+    cum_cov = None if covqu is None else np.concatenate((zero, np.cumsum(covqu, dtype=np.float64)))
+
+    def bin_snr2(start, stop):
+        # Squared S/N of the bins [start, end) for all the candidate ends start < end <= stop.
+        # With the mean q and u of a bin and the errors of `_pol_deg_and_err`, the number of
+        # pixels cancels out: (p/dp)**2 = (Q**2 + U**2)**2 / (Q**2 var_Q + U**2 var_U + 2 Q U cov)
+        # where Q, U, var_Q, var_U and cov are the sums over the bin.
+        ends = slice(start + 1, stop + 1)
+        sum_q, sum_u = cum_q[ends] - cum_q[start], cum_u[ends] - cum_u[start]
+        sum_q2, sum_u2 = np.square(sum_q), np.square(sum_u)
+        variance = (sum_q2 * (cum_var_q[ends] - cum_var_q[start]) +
+                    sum_u2 * (cum_var_u[ends] - cum_var_u[start]))
+        if cum_cov is not None:
+            # Clipped at 0 as in `_pol_deg_and_err`
+            variance = np.maximum(variance + 2 * sum_q * sum_u * (cum_cov[ends] - cum_cov[start]),
+                                  0.)
+        return np.square(sum_q2 + sum_u2) / variance
+
+    target_snr2 = target_snr * target_snr
+    stops = []
+    start, window = 0, 1
+    reached = True
+    with np.errstate(divide='ignore', invalid='ignore'):
+        while start < n:
+            while True:
+                stop = min(start + window, n)
+                hits = np.flatnonzero(bin_snr2(start, stop) >= target_snr2)
+                if hits.size:
+                    stop = start + 1 + hits[0]
+                    break
+                if stop == n:
+                    reached = False
+                    break
+                window *= 2
+            stops.append(stop)
+            # The next bin probably needs about as many pixels as this one: a window twice
+            # as large is rarely too small, and keeps the total work linear
+            window = 2 * (stop - start)
+            start = stop
+
+    if not reached and merge_last and len(stops) > 1:
+        del stops[-2]
+
+    # Edges half way between the last pixel of a bin and the first of the next
+    stops = np.array(stops[:-1], dtype=int)
+    inner = 0.5 * (wl[stops - 1] + wl[stops])
+    first = wl[0] - 0.5 * (wl[1] - wl[0]) if n > 1 else wl[0] - 0.5
+    last = wl[-1] + 0.5 * (wl[-1] - wl[-2]) if n > 1 else wl[-1] + 0.5
+    return np.concatenate(([first], inner, [last]))
+
+
+def adaptive_rebin(data, target_snr, edges=None, merge_last=True):
+    """
+    Adaptive binning of a PolData object or of all the epochs of a PolDataCollection to a
+    target S/N of the degree of polarisation. See `adaptive_edges`.
+
+    Notes
+    -----
+    For a collection, the edges are found from the mean of the epochs (errors combined in
+    quadrature, covariances summed) and every epoch is binned with the same edges in one call.
+
+    Parameters
+    ----------
+    data : PolData or PolDataCollection
+        Data with wavelengths, Stokes q and u and their errors
+    target_snr : float
+        S/N of the degree of polarisation to reach in each bin
+    edges : numpy.ndarray, optional
+        Edges returned by a previous call, to bin other data the same way.
+    merge_last : bool, optional
+        See `adaptive_edges`. Default is True.
+
+    Returns
+    -------
+    Tuple(binned data, edges)
+    """
+    if edges is None:
+        if data.dq is None or data.du is None:
+            raise ValueError("Adaptive binning needs the errors on q and u.")
+        q, u, dq, du, covqu = data.q, data.u, data.dq, data.du, data.covqu
+        if isinstance(data, PolDataCollection):
+            n_epochs = len(data)
+            q, u = q.mean(axis=0, dtype=np.float64), u.mean(axis=0, dtype=np.float64)
+            dq = np.sqrt(np.square(dq).sum(axis=0, dtype=np.float64)) / n_epochs
+            du = np.sqrt(np.square(du).sum(axis=0, dtype=np.float64)) / n_epochs
+            if covqu is not None:
+                covqu = covqu.sum(axis=0, dtype=np.float64) / (n_epochs * n_epochs)
+        edges = adaptive_edges(data.wl, q, u, dq, du, target_snr, merge_last=merge_last,
+                               covqu=covqu)
+
+    return rebin(data, edges), edges
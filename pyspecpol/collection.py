@@ -0,0 +1,315 @@
+"""
+Stacks of spectropolarimetric epochs sharing one wavelength grid.
+
+A PolDataCollection holds the Stokes parameters (and the derived p and P.A.) of many epochs
+as (n_epochs, n_wl) arrays, so that the calculations are done once over the whole stack
+instead of once per PolData object.
+"""
+
+import numpy as np
+from .misc import PolData, calc_p_and_pa, _rows_of, _compact_block, _add_block_rows
+from .utils.interpolation import interpolation_plan
+from .precision import _float_dtype
+
+# Per-pixel columns of a collection, in the order they are stored in its data block.
+STACK_COLUMNS = ('q', 'dq', 'u', 'du', 'p', 'dp', 'pa', 'dpa', 'covqu')
+_STACK_INDEX = dict((name, i) for i, name in enumerate(STACK_COLUMNS))
+
+# Errors are resampled by propagating the variance, not interpolated like the values.
+_ERROR_OF = {'dq': 'q', 'du': 'u', 'dp': 'p', 'dpa': 'pa'}
+# Covariances are resampled with the squared weights
+_VARIANCE_COLUMNS = ('covqu',)
+
+
+def _stack_column(name):
+    """ Property giving the (n_epochs, n_wl) view of one column of the stack (None if empty) """
+    index = _STACK_INDEX[name]
+
+    def getter(self):
+        if not self._filled[index]:
+            return None
+        return self._data[self._rows[index]]
+
+    def setter(self, value):
+        if value is None:
+            self._filled[index] = False
+            return
+        self._add_rows([index])
+        self._data[self._rows[index]] = value
+        self._filled[index] = True
+
+    return property(getter, setter, doc="Column '{0}' -- (n_epochs, n_wl) view or None"
+                                        .format(name))
+
+
+class PolDataCollection(object):
+    """
+    Stack of epochs of spectropolarimetric data on a common wavelength grid.
+
+    Notes
+    -----
+    1) The columns of `STACK_COLUMNS` are stored in a single C-contiguous array of shape
+    (n_rows, n_epochs, n_wl), column i being the row `_rows[i]`, and the attributes `q`, `dq`,
+    ... are (n_epochs, n_wl) views into it, or None when not filled. Rows are only allocated
+    for the columns that get filled, and copies or pickles only hold the filled rows.
+
+    2) The epochs are kept sorted by time, so that selecting a time range (`select_time`)
+    returns a view.
+
+    3) The data block is float64 or float32 (see `precision`), the wavelengths and times are
+    always float64.
+
+    Parameters
+    ----------
+    wl : numpy.ndarray
+        Wavelength grid shared by all epochs
+    time : numpy.ndarray
+        Time of each epoch
+    dtype : str or numpy.dtype, optional
+        Precision of the data block: 'float32' or 'float64'. Default is the precision set with
+        `precision.set_precision`.
+    """
+
+    __slots__ = ('wl', 'time', '_data', '_rows', '_filled')
+
+    q, dq, u, du = _stack_column('q'), _stack_column('dq'), _stack_column('u'), _stack_column('du')
+    p, dp, pa, dpa = _stack_column('p'), _stack_column('dp'), _stack_column('pa'), \
+                     _stack_column('dpa')
+    covqu = _stack_column('covqu')
+
+    def __init__(self, wl, time, dtype=None):
+        self.wl = np.asarray(wl, dtype=float)
+        self.time = np.asarray(time, dtype=float)
+        if np.any(np.diff(self.time) < 0):
+            raise ValueError("The epochs must be sorted by time, see `from_poldata`.")
+        self._data = np.empty((0, len(self.time), len(self.wl)), dtype=_float_dtype(dtype))
+        self._rows = np.full(len(STACK_COLUMNS), -1, dtype=np.intp)
+        self._filled = np.zeros(len(STACK_COLUMNS), dtype=bool)
+
+    def __len__(self):
+        return len(self.time)
+
+    def __getstate__(self):
+        # Only the filled rows, in the order of STACK_COLUMNS
+        return self.wl, self.time, _compact_block(self._data, self._rows, self._filled), \
+               self._filled
+
+    def __setstate__(self, state):
+        self.wl, self.time, self._data, self._filled = state
+        if len(self._data) != np.count_nonzero(self._filled):
+            # Pickled with one row per column
+            self._rows = np.arange(len(STACK_COLUMNS))
+        else:
+            self._rows = _rows_of(self._filled)
+
+    @property
+    def columns(self):
+        """ Names of the filled columns """
+        return tuple(name for name, filled in zip(STACK_COLUMNS, self._filled) if filled)
+
+    @property
+    def dtype(self):
+        """ Precision of the data block (numpy.dtype) """
+        return self._data.dtype
+
+    def copy(self):
+        """ Returns a deep copy of the collection (a single copy of the filled rows) """
+        new = PolDataCollection.__new__(PolDataCollection)
+        new.wl, new.time = self.wl.copy(), self.time.copy()
+        new._data = _compact_block(self._data, self._rows, self._filled, copy=True)
+        new._filled = self._filled.copy()
+        new._rows = _rows_of(new._filled)
+        return new
+
+    def _add_rows(self, indices):
+        """ Makes sure the columns `indices` have a row in the block, see `_add_block_rows` """
+        self._data = _add_block_rows(self._data, self._rows, self._filled, indices)
+
+    def _add_columns(self, names):
+        """ Allocates the rows of the columns `names` and marks them filled (uninitialised) """
+        indices = [_STACK_INDEX[name] for name in names]
+        self._add_rows(indices)
+        self._filled[indices] = True
+
+    def _sort_epochs(self, order):
+        """
+        Reorders the epochs in place, epoch i becoming epoch order[i]. The data block is
+        permuted one cycle at a time, so only one epoch is held twice.
+        """
+        done = np.zeros(len(order), dtype=bool)
+        for start in range(len(order)):
+            if done[start] or order[start] == start:
+                continue
+            saved = self._data[:, start].copy()
+            i = start
+            while order[i] != start:
+                self._data[:, i] = self._data[:, order[i]]
+                done[i] = True
+                i = order[i]
+            self._data[:, i] = saved
+            done[i] = True
+        self.time = self.time[order]
+
+    @classmethod
+    def from_poldata(cls, poldatas, times=None, wl=None, dtype=None):
+        """
+        Stacks PolData objects into a collection.
+
+        Notes
+        -----
+        If all the objects have the same wavelengths they are used as the grid, otherwise
+        (or if `wl` is given) every epoch is linearly resampled on the grid `wl`, with the
+        variance propagated for the errors. Pixels outside of an epoch's wavelength range are NaN.
+
+        Parameters
+        ----------
+        poldatas : list of PolData
+            The epochs. Only the columns filled in all of them are stacked.
+        times : list or numpy.ndarray, optional
+            Time of each epoch. Default is the mean of each object's time column.
+        wl : numpy.ndarray, optional
+            Wavelength grid to resample the epochs on.
+        dtype : str or numpy.dtype, optional
+            Precision of the collection. Default is that of the PolData objects (float64 if
+            they are mixed).
+
+        Returns
+        -------
+        PolDataCollection
+        """
+        if len(poldatas) == 0:
+            raise ValueError("At least one PolData object is needed.")
+
+        if times is None:
+            times = [np.nan if poldata.time is None else np.mean(poldata.time)
+                     for poldata in poldatas]
+        times = np.asarray(times, dtype=float)
+        if len(times) != len(poldatas):
+            raise ValueError("There should be one time per PolData object.")
+
+        if wl is None:
+            wl = poldatas[0].wl
+            if wl is None:
+                raise ValueError("The PolData objects have no wavelength column.")
+            if not all(poldata.wl is not None and np.array_equal(poldata.wl, wl)
+                       for poldata in poldatas):
+                raise ValueError("The PolData objects do not share the same wavelengths: "
+                                 "give a common grid `wl` to resample them on.")
+            resample = False
+        else:
+            wl = np.asarray(wl, dtype=float)
+            resample = True
+
+        names = [name for name in STACK_COLUMNS
+                 if all(name in poldata.columns for poldata in poldatas)]
+
+        if dtype is None:
+            dtype = np.result_type(*[poldata.dtype for poldata in poldatas])
+        order = np.argsort(times, kind='mergesort')
+        collection = cls(wl, times[order], dtype=dtype)
+        collection._add_columns(names)
+        for epoch, i in enumerate(order):
+            poldata = poldatas[i]
+            if resample:
+                # Cached: epochs sharing their wavelengths share the plan
+                plan = interpolation_plan(poldata.wl, wl)
+            for name in names:
+                if resample:
+                    plan.apply(getattr(poldata, name), error=name in _ERROR_OF,
+                               variance=name in _VARIANCE_COLUMNS,
+                               out=getattr(collection, name)[epoch])
+                else:
+                    getattr(collection, name)[epoch] = getattr(poldata, name)
+        return collection
+
+    def select_time(self, t_min=None, t_max=None):
+        """
+        Selects the epochs with t_min <= time <= t_max. The result shares the data of this
+        collection (no copy).
+
+        Parameters
+        ----------
+        t_min, t_max : float, optional
+            Limits of the time range (inclusive). Default is no limit.
+
+        Returns
+        -------
+        PolDataCollection
+        """
+        start = 0 if t_min is None else np.searchsorted(self.time, t_min, side='left')
+        stop = len(self) if t_max is None else np.searchsorted(self.time, t_max, side='right')
+
+        new = PolDataCollection.__new__(PolDataCollection)
+        new.wl = self.wl
+        new.time = self.time[start:stop]
+        new._data = self._data[:, start:stop]
+        new._rows = self._rows.copy()
+        new._filled = self._filled.copy()
+        return new
+
+    def resample(self, wl):
+        """
+        Linearly resamples all the epochs on a new wavelength grid (both grids increasing).
+
+        Notes
+        -----
+        The interpolation plan is built once (see `utils.interpolation.interpolation_plan`)
+        and applied to each column of the whole stack. The errors are resampled by propagating
+        the variance. Pixels outside of the current wavelength range are NaN.
+
+        Parameters
+        ----------
+        wl : numpy.ndarray
+            The new wavelength grid
+
+        Returns
+        -------
+        PolDataCollection
+        """
+        wl = np.asarray(wl, dtype=float)
+        plan = interpolation_plan(self.wl, wl)
+
+        new = PolDataCollection(wl, self.time.copy(), dtype=self.dtype)
+        new._add_columns(self.columns)
+        for name in self.columns:
+            plan.apply(getattr(self, name), error=name in _ERROR_OF,
+                       variance=name in _VARIANCE_COLUMNS, out=getattr(new, name))
+        return new
+
+    def epoch(self, i):
+        """ Returns epoch `i` as a (new) PolData object """
+        poldata = PolData(dtype=self.dtype)
+        poldata.wl = self.wl
+        # p, dp, pa and dpa last, since setting the Stokes columns clears them
+        for name in sorted(self.columns, key=lambda name: name in ('p', 'dp', 'pa', 'dpa')):
+            setattr(poldata, name, getattr(self, name)[i])
+        if not np.isnan(self.time[i]):
+            poldata.time = np.full(len(self.wl), self.time[i])
+        return poldata
+
+    def calc_pol(self, debiased=True, method='wang'):
+        """
+        Fills p, dp, pa and dpa for all the epochs at once (see `calc_p_and_pa`), with the q-u
+        covariance if the covqu column is filled.
+
+        Parameters
+        ----------
+        debiased : Bool, optional
+            Default is True. Debiases the degree of polarisation.
+        method : str, optional
+            Debiasing estimator, see `debias_polarisation`. Default is 'wang'.
+
+        Returns
+        -------
+        self
+        """
+        if any(getattr(self, name) is None for name in ('q', 'dq', 'u', 'du')):
+            raise ValueError("q, dq, u and du are needed to calculate the polarisation.")
+
+        indices = [_STACK_INDEX[name] for name in ('p', 'dp', 'pa', 'dpa')]
+        self._add_rows(indices)
+        calc_p_and_pa(self.q, self.u, self.dq, self.du, debiased=debiased, method=method,
+                      covqu=self.covqu, out=tuple(self._data[self._rows[index]]
+                                                  for index in indices))
+        self._filled[indices] = True
+        return self
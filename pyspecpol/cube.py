@@ -0,0 +1,230 @@
+"""
+Integral field spectropolarimetry: (ny, nx, n_wl) cubes of Stokes parameters.
+
+The cubes are stored as one .npy file per column in a directory and memory mapped, so opening
+a cube reads nothing. The maps are calculated tile by tile (blocks of rows of spaxels sized to a
+memory budget) with the same kernels as the 1D spectra (`calc_p_and_pa`), so the full cube is
+never loaded at once.
+"""
+
+import os
+import numpy as np
+from .misc import PolData, calc_p_and_pa
+from .precision import _result_dtype
+
+# Columns of a cube, each a (ny, nx, n_wl) array stored as <directory>/<name>.npy
+CUBE_COLUMNS = ('q', 'dq', 'u', 'du', 'covqu')
+# Default memory budget (bytes) for the arrays of one tile
+_CUBE_TILE_MEMORY = 64 * 2**20
+
+
+class PolCube(object):
+    """
+    Cube of Stokes parameters of integral field spectropolarimetry.
+
+    Notes
+    -----
+    q, dq, u and du are (ny, nx, n_wl) arrays -- memory maps when the cube is opened with `open`,
+    in which case the data are read from disk tile by tile as they are used. The maps are
+    calculated and saved in the precision of the columns (float32 or float64, see `precision`).
+
+    Parameters
+    ----------
+    wl : numpy.ndarray
+        Wavelengths, (n_wl,)
+    q, u : numpy.ndarray
+        Stokes parameters, (ny, nx, n_wl)
+    dq, du : numpy.ndarray, optional
+        Errors on the Stokes parameters, (ny, nx, n_wl)
+    covqu : numpy.ndarray, optional
+        Covariance of q and u, (ny, nx, n_wl)
+    """
+
+    __slots__ = ('wl', 'q', 'dq', 'u', 'du', 'covqu')
+
+    def __init__(self, wl, q, u, dq=None, du=None, covqu=None):
+        self.wl = np.asarray(wl, dtype=float)
+        self.q, self.u, self.dq, self.du, self.covqu = q, u, dq, du, covqu
+        for name in CUBE_COLUMNS:
+            column = getattr(self, name)
+            if column is not None and (column.ndim != 3 or column.shape[2] != len(self.wl)):
+                raise ValueError("Column '{0}' should be a (ny, nx, {1}) cube"
+                                 .format(name, len(self.wl)))
+
+    @property
+    def shape(self):
+        """ (ny, nx, n_wl) """
+        return self.q.shape
+
+    @property
+    def dtype(self):
+        """ Precision of the columns (float64 if they are mixed) """
+        return _result_dtype(*[getattr(self, name) for name in CUBE_COLUMNS
+                               if getattr(self, name) is not None])
+
+    @classmethod
+    def open(cls, directory, mmap_mode='r'):
+        """
+        Memory maps a cube saved with `save`. Nothing is read until the data are used.
+
+        Parameters
+        ----------
+        directory : str
+            Directory with wl.npy and q.npy, u.npy (dq.npy, du.npy, covqu.npy)
+        mmap_mode : str, optional
+            Mode of the memory maps, see numpy.load. Default is 'r' (read only).
+
+        Returns
+        -------
+        PolCube
+        """
+        columns = {}
+        for name in CUBE_COLUMNS:
+            filename = os.path.join(directory, name + '.npy')
+            if os.path.exists(filename):
+                columns[name] = np.load(filename, mmap_mode=mmap_mode)
+        return cls(np.load(os.path.join(directory, 'wl.npy')), **columns)
+
+    def save(self, directory):
+        """ Saves the cube as .npy files in `directory` (created if needed), see `open` """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        np.save(os.path.join(directory, 'wl.npy'), self.wl)
+        for name in CUBE_COLUMNS:
+            column = getattr(self, name)
+            if column is None:
+                continue
+            # Copied tile by tile, so a memory mapped cube is never loaded at once
+            out = np.lib.format.open_memmap(os.path.join(directory, name + '.npy'), mode='w+',
+                                            dtype=_result_dtype(column), shape=column.shape)
+            for rows in self._tiles(n_arrays=1):
+                out[rows] = column[rows]
+            out.flush()
+
+    def _tiles(self, n_arrays, n_wl=None, max_memory=_CUBE_TILE_MEMORY):
+        """ Row slices of spaxels such that `n_arrays` arrays of a tile fit in `max_memory` """
+        ny, nx, n_total = self.shape
+        row_bytes = nx * (n_total if n_wl is None else n_wl) * self.dtype.itemsize * n_arrays
+        n_rows = max(1, int(max_memory // max(row_bytes, 1)))
+        for start in range(0, ny, n_rows):
+            yield slice(start, min(start + n_rows, ny))
+
+    def _check_errors(self):
+        if self.dq is None or self.du is None:
+            raise ValueError("q, dq, u and du are needed to calculate the polarisation.")
+
+    def spaxel(self, y, x):
+        """ Spectrum of spaxel (y, x) as a PolData object """
+        poldata = PolData(dtype=self.dtype)
+        poldata.wl = self.wl
+        for name in CUBE_COLUMNS:
+            column = getattr(self, name)
+            if column is not None:
+                setattr(poldata, name, column[y, x])
+        return poldata
+
+    def calc_pol(self, debiased=True, method='wang', directory=None,
+                 max_memory=_CUBE_TILE_MEMORY):
+        """
+        Degree of polarisation, P.A. and their errors of every pixel of the cube, tile by tile.
+
+        Parameters
+        ----------
+        debiased : Bool, optional
+            Default is True. Debiases the degree of polarisation.
+        method : str, optional
+            Debiasing estimator, see `debias_polarisation`. Default is 'wang'.
+        directory : str, optional
+            If given, the results are written to memory mapped p.npy, dp.npy, pa.npy and dpa.npy
+            in this directory, otherwise they are returned as arrays in memory.
+        max_memory : int, optional
+            Memory budget in bytes for one tile. Default is 64 MiB.
+
+        Returns
+        -------
+        Tuple(p, dp, pa, dpa) -- (ny, nx, n_wl) arrays (memory maps if `directory` is given)
+        """
+        self._check_errors()
+        dtype = self.dtype
+        if directory is None:
+            out = tuple(np.empty(self.shape, dtype=dtype) for _ in range(4))
+        else:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            out = tuple(np.lib.format.open_memmap(os.path.join(directory, name + '.npy'),
+                                                  mode='w+', dtype=dtype, shape=self.shape)
+                        for name in ('p', 'dp', 'pa', 'dpa'))
+
+        # 4 or 5 inputs, 4 outputs and the scratch arrays of calc_p_and_pa
+        n_arrays = 9 if self.covqu is None else 11
+        for rows in self._tiles(n_arrays=n_arrays, max_memory=max_memory):
+            calc_p_and_pa(self.q[rows], self.u[rows], self.dq[rows], self.du[rows],
+                          debiased=debiased, method=method,
+                          covqu=None if self.covqu is None else self.covqu[rows],
+                          out=tuple(array[rows] for array in out))
+        for array in out:
+            if isinstance(array, np.memmap):
+                array.flush()
+        return out
+
+    def integrate(self, wl_min=None, wl_max=None, debiased=True, method='wang',
+                  max_memory=_CUBE_TILE_MEMORY):
+        """
+        Maps of p, P.A. and their errors over a wavelength range.
+
+        Notes
+        -----
+        In each spaxel q and u are averaged over the range (errors added in quadrature and
+        covariances summed, divided by the number of pixels) and converted with
+        `calc_p_and_pa`. Only the wavelength range of each tile is read. The sums are
+        accumulated in float64.
+
+        Parameters
+        ----------
+        wl_min, wl_max : float, optional
+            Limits of the wavelength range (inclusive, wavelengths increasing). Default is no
+            limit.
+        debiased : Bool, optional
+            Default is True. Debiases the degree of polarisation.
+        method : str, optional
+            Debiasing estimator, see `debias_polarisation`. Default is 'wang'.
+        max_memory : int, optional
+            Memory budget in bytes for one tile. Default is 64 MiB.
+
+        Returns
+        -------
+        Tuple(p, dp, pa, dpa) -- (ny, nx) maps
+        """
+        self._check_errors()
+        start = 0 if wl_min is None else np.searchsorted(self.wl, wl_min, side='left')
+        stop = len(self.wl) if wl_max is None else np.searchsorted(self.wl, wl_max, side='right')
+        n_wl = stop - start
+        if n_wl == 0:
+            raise ValueError("No wavelengths between {0} and {1}.".format(wl_min, wl_max))
+
+        ny, nx = self.shape[:2]
+        q, u, dq, du = (np.empty((ny, nx)) for _ in range(4))
+        covqu = None if self.covqu is None else np.empty((ny, nx))
+        for rows in self._tiles(n_arrays=2, n_wl=n_wl, max_memory=max_memory):
+            window = (rows, slice(None), slice(start, stop))
+            np.sum(self.q[window], axis=-1, dtype=np.float64, out=q[rows])
+            np.sum(self.u[window], axis=-1, dtype=np.float64, out=u[rows])
+            for error, binned in ((self.dq, dq), (self.du, du)):
+                tile = np.square(error[window])
+                np.sum(tile, axis=-1, dtype=np.float64, out=binned[rows])
+            if covqu is not None:
+                np.sum(self.covqu[window], axis=-1, dtype=np.float64, out=covqu[rows])
+        q /= n_wl
+        u /= n_wl
+        np.sqrt(dq, out=dq)
+        dq /= n_wl
+        np.sqrt(du, out=du)
+        du /= n_wl
+        if covqu is not None:
+            covqu /= n_wl * n_wl
+        # Maps in the precision of the cube
+        dtype = self.dtype
+        q, u, dq, du = (x.astype(dtype, copy=False) for x in (q, u, dq, du))
+        if covqu is not None:
+            covqu = covqu.astype(dtype, copy=False)
+        return calc_p_and_pa(q, u, dq, du, debiased=debiased, method=method, covqu=covqu)
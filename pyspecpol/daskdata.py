@@ -0,0 +1,291 @@
+"""
+Out-of-core spectropolarimetric data: a PolData backend holding chunked, lazy Dask arrays.
+
+Dask is an optional dependency (`pip install "dask[array]"`). With it:
+
+1) `calc_p`, `calc_pa`, `debias_polarisation` and `calc_p_and_pa` accept Dask arrays and return
+Dask arrays: the numpy kernels are mapped over the chunks (`dask.array.map_blocks`), so they
+only add tasks to the graph and nothing is computed until asked for.
+
+2) `DaskPolData` holds its columns as Dask arrays. It can be read from (`from_binary`) and
+written to (`to_binary`) the pyspecpol binary format one chunk at a time, so datasets larger
+than the memory are processed with a memory use bounded by the chunk size times the number of
+workers, on the threaded or process scheduler:
+
+    data = DaskPolData.from_binary('cube.pspol', chunks=2**22)
+    data.calc_pol().to_binary('cube_pol.pspol', scheduler='processes')
+"""
+
+import numpy as np
+from . import misc
+from .misc import PolData, COLUMNS, _COLUMN_INDEX, _DERIVED_COLUMNS
+from .precision import _as_float, _result_dtype
+
+try:
+    import dask
+    import dask.array as da
+except ImportError:
+    dask, da = None, None
+
+
+def _require_dask():
+    if da is None:
+        raise ImportError("The Dask backend of pyspecpol needs dask: "
+                          "pip install \"dask[array]\"")
+
+
+def _as_dask(arrays):
+    """ Dask arrays with the same shape and chunks from arrays, numbers or Dask arrays """
+    _require_dask()
+    arrays = [x if isinstance(x, da.Array) else da.asarray(_as_float(x)) for x in arrays]
+    return da.broadcast_arrays(*arrays)
+
+
+def _map_kernel(kernel, arrays, n_out, **kwargs):
+    """
+    Maps a numpy kernel returning `n_out` arrays over the chunks of `arrays`. The outputs of a
+    chunk are computed by a single task and stacked along a new first axis.
+    """
+    def stacked_kernel(*blocks):
+        return np.stack(kernel(*blocks, **kwargs))
+
+    stacked = da.map_blocks(stacked_kernel, *arrays, new_axis=0, dtype=_result_dtype(*arrays),
+                            chunks=((n_out,),) + arrays[0].chunks)
+    return tuple(stacked[i] for i in range(n_out))
+
+
+def _with_covariance(arrays, covqu):
+    """ Dask arrays of `arrays` and of `covqu` if given """
+    return _as_dask(tuple(arrays) + (() if covqu is None else (covqu,)))
+
+
+def calc_p(q, u, dq=None, du=None, debiased=True, covqu=None):
+    """ `misc.calc_p` for Dask arrays (lazy) """
+    if dq is None or du is None:
+        return _map_kernel(lambda q, u: (misc._pol_deg(q, u),), _as_dask((q, u)), 1)[0]
+    p, dp = _map_kernel(misc._pol_deg_and_err, _with_covariance((q, u, dq, du), covqu), 2)
+    if debiased:
+        p = debias_polarisation(p, dp)
+    return p, dp
+
+
+def calc_pa(q, u, dq=None, du=None, covqu=None):
+    """ `misc.calc_pa` for Dask arrays (lazy) """
+    if dq is None or du is None:
+        return _map_kernel(lambda q, u: (misc._pol_ang(q, u),), _as_dask((q, u)), 1)[0]
+    return _map_kernel(misc._pol_ang_and_err, _with_covariance((q, u, dq, du), covqu), 2)
+
+
+def debias_polarisation(p, dp, method='wang'):
+    """ `misc.debias_polarisation` for Dask arrays (lazy) """
+    kernel = lambda p, dp: (misc.debias_polarisation(p, dp, method=method),)
+    return _map_kernel(kernel, _as_dask((p, dp)), 1)[0]
+
+
+def calc_p_and_pa(q, u, dq, du, debiased=True, method='wang', covqu=None):
+    """ `misc.calc_p_and_pa` for Dask arrays (lazy) """
+    def kernel(q, u, dq, du, covqu=None):
+        return misc.calc_p_and_pa(q, u, dq, du, debiased=debiased, method=method, covqu=covqu)
+
+    return _map_kernel(kernel, _with_covariance((q, u, dq, du), covqu), 4)
+
+
+### DASK BACKED POLDATA ###
+
+def _dask_column(name):
+    """ Property giving one column of a DaskPolData (Dask array or None) """
+
+    def getter(self):
+        column = self._columns.get(name)
+        if column is None and name in _DERIVED_COLUMNS and self.q is not None and \
+                self.u is not None:
+            # Building the graph is cheap, it is computed with the rest
+            if self.dq is not None and self.du is not None:
+                self.calc_pol()
+            else:
+                self._columns['p'] = calc_p(self.q, self.u)
+                self._columns['pa'] = calc_pa(self.q, self.u)
+            column = self._columns.get(name)
+        return column
+
+    def setter(self, value):
+        self._set_column(name, value)
+
+    return property(getter, setter, doc="Column '{0}' -- Dask array or None".format(name))
+
+
+def _read_binary_chunk(filename, index, start, stop):
+    """ Reads pixels start:stop of one column of a binary file (in the worker) """
+    block, _ = misc._open_binary(filename, mmap_mode='r')
+    return np.array(block[index, start:stop])
+
+
+class _BinaryColumnWriter(object):
+    """
+    `dask.array.store` target writing one column of a binary file created by `_create_binary`.
+    The file is opened by the worker writing a chunk, so this also works with processes.
+    """
+
+    def __init__(self, filename, index):
+        self.filename, self.index = filename, index
+
+    def __setitem__(self, key, value):
+        block, _ = misc._open_binary(self.filename, mmap_mode='r+')
+        block[self.index][key] = value
+        block.flush()
+
+
+class DaskPolData(object):
+    """
+    Spectropolarimetric data held as chunked, lazy Dask arrays (see the module docstring).
+
+    Notes
+    -----
+    1) The columns are the same as PolData's (`COLUMNS`), all 1D Dask arrays of the same length
+    and chunks. Like PolData, p, dp, pa and dpa are derived from q and u when first accessed
+    (here this only builds the task graph) and cleared when q, dq, u or du are assigned.
+
+    2) The columns keep the precision of the arrays they are set from (float32 or float64,
+    see `precision`), and `compute` and `to_binary` write in that precision.
+
+    3) Nothing is computed until `compute` or `to_binary` is called. These take the keyword
+    arguments of `dask.compute`, e.g. scheduler='threads' or scheduler='processes'.
+
+    Parameters
+    ----------
+    chunks : int, optional
+        Number of pixels per chunk for the columns set from numpy arrays. Default is 'auto'.
+    """
+
+    __slots__ = ('_columns', 'chunks')
+
+    wl, time = _dask_column('wl'), _dask_column('time')
+    q, dq, u, du = _dask_column('q'), _dask_column('dq'), _dask_column('u'), _dask_column('du')
+    p, dp = _dask_column('p'), _dask_column('dp')
+    pa, dpa = _dask_column('pa'), _dask_column('dpa')
+    nq, dnq, nu, dnu = _dask_column('nq'), _dask_column('dnq'), _dask_column('nu'), \
+        _dask_column('dnu')
+    hwp_chi2, hwp_flux_dev = _dask_column('hwp_chi2'), _dask_column('hwp_flux_dev')
+    covqu = _dask_column('covqu')
+
+    def __init__(self, chunks='auto'):
+        _require_dask()
+        self._columns = {}
+        self.chunks = chunks
+
+    def __len__(self):
+        return len(next(iter(self._columns.values()))) if self._columns else 0
+
+    @property
+    def columns(self):
+        """ Names of the filled columns (derived ones only once their graph is built) """
+        return tuple(name for name in COLUMNS if name in self._columns)
+
+    def _set_column(self, name, value):
+        if value is None:
+            self._columns.pop(name, None)
+            return
+        if not isinstance(value, da.Array):
+            value = da.from_array(_as_float(value), chunks=self.chunks)
+        if value.ndim != 1 or (self._columns and len(value) != len(self)):
+            raise ValueError("Column '{0}' should be 1D with {1} values".format(name, len(self)))
+        if self._columns:
+            value = value.rechunk(next(iter(self._columns.values())).chunks)
+        self._columns[name] = value
+        if name in ('q', 'dq', 'u', 'du', 'covqu'):
+            for derived in _DERIVED_COLUMNS:
+                self._columns.pop(derived, None)
+
+    @classmethod
+    def from_poldata(cls, poldata, chunks='auto'):
+        """ DaskPolData with the filled columns of a PolData object, split in chunks """
+        new = cls(chunks=chunks)
+        for name in poldata.columns:
+            new._set_column(name, getattr(poldata, name))
+        return new
+
+    @classmethod
+    def from_binary(cls, filename, chunks=2**22):
+        """
+        Lazily reads a pyspecpol binary file (see `PolData.save_binary`). Each task reads one
+        chunk of one column from the file, so no more than a chunk per worker is in memory.
+
+        Parameters
+        ----------
+        filename : str
+            path to the binary file
+        chunks : int, optional
+            Number of pixels per chunk. Default is 2**22 (32 MiB per column chunk).
+
+        Returns
+        -------
+        DaskPolData
+        """
+        _require_dask()
+        block, filled = misc._open_binary(filename, mmap_mode='r')
+        n_pixels, dtype = block.shape[1], block.dtype
+        del block
+        bounds = list(range(0, n_pixels, chunks)) + [n_pixels]
+
+        new = cls(chunks=chunks)
+        for index in np.flatnonzero(filled):
+            pieces = [da.from_delayed(dask.delayed(_read_binary_chunk)(filename, index, start,
+                                                                       stop),
+                                      shape=(stop - start,), dtype=dtype)
+                      for start, stop in zip(bounds[:-1], bounds[1:])]
+            new._columns[COLUMNS[index]] = da.concatenate(pieces) if pieces else da.zeros(0)
+        return new
+
+    def calc_pol(self, debiased=True, method='wang'):
+        """
+        Builds the graph of p, dp, pa and dpa (see `calc_p_and_pa`). Nothing is computed.
+
+        Returns
+        -------
+        self
+        """
+        if any(self._columns.get(name) is None for name in ('q', 'dq', 'u', 'du')):
+            raise ValueError("q, dq, u and du are needed to calculate the polarisation.")
+        results = calc_p_and_pa(self.q, self.u, self.dq, self.du, debiased=debiased,
+                                method=method, covqu=self.covqu)
+        self._columns.update(zip(_DERIVED_COLUMNS, results))
+        return self
+
+    def compute(self, **kwargs):
+        """
+        Computes all the columns into an in-memory PolData object.
+
+        Parameters
+        ----------
+        kwargs : optional
+            Keyword arguments of dask.compute, e.g. scheduler='processes'.
+
+        Returns
+        -------
+        PolData
+        """
+        names = self.columns
+        values = dask.compute(*[self._columns[name] for name in names], **kwargs)
+        poldata = PolData(dtype=_result_dtype(*values))
+        poldata._set_columns(dict(zip(names, values)))
+        return poldata
+
+    def to_binary(self, filename, **kwargs):
+        """
+        Computes all the columns and writes them chunk by chunk to a pyspecpol binary file,
+        which can then be memory mapped (`PolData.load_binary`) or read back lazily.
+
+        Parameters
+        ----------
+        filename : str
+            path to the file to write
+        kwargs : optional
+            Keyword arguments of dask.compute, e.g. scheduler='processes'.
+        """
+        names = self.columns
+        filled = np.array([name in names for name in COLUMNS])
+        misc._create_binary(filename, len(self), filled,
+                            _result_dtype(*[self._columns[name] for name in names]))
+        da.store([self._columns[name] for name in names],
+                 [_BinaryColumnWriter(filename, _COLUMN_INDEX[name]) for name in names],
+                 lock=False, **kwargs)
@@ -0,0 +1,341 @@
+"""
+FITS input/output of PolData objects and collections.
+
+Layout of the files written (and read) by pyspecpol:
+
+- an empty primary HDU whose PSPTYPE keyword is 'POLDATA' or 'COLLECTION'
+- one image HDU per filled column, named after the column in upper case (Q, DQ, U, ...):
+  1D for a PolData object, (n_epochs, n_wl) for a collection
+- the wavelengths as WCS keywords (CRVAL1, CDELT1, CRPIX1) of the column HDUs when they are
+  linear, otherwise a WL image HDU
+- for a collection, the time of each epoch in a 1D TIME image HDU
+
+The files are memory mapped by astropy and only the data of the HDUs of the columns asked for
+are read from disk, each copied straight into the data block. Products of other pipelines
+(e.g. one HDU per Stokes parameter) can be read with the `extnames` argument.
+
+The columns are written in the precision of the data (BITPIX -32 for float32) and read in the
+precision asked for (see `precision`).
+"""
+
+import contextlib
+import numpy as np
+from astropy.io import fits
+from .misc import PolData, COLUMNS
+from .collection import PolDataCollection, STACK_COLUMNS
+
+# Relative difference below which wavelengths are written as a linear WCS rather than an array
+_LINEAR_RTOL = 1e-10
+# CTYPE1 values of a linear wavelength axis
+_LINEAR_CTYPES = ('', 'WAVE', 'AWAV', 'LINEAR', 'LAMBDA')
+
+
+def _linear_solution(wl):
+    """ (CRVAL1, CDELT1) if the wavelengths `wl` are linear, None otherwise """
+    if wl is None or len(wl) < 2:
+        return None
+    cdelt = (wl[-1] - wl[0]) / (len(wl) - 1)
+    if cdelt == 0 or not np.allclose(wl, wl[0] + cdelt * np.arange(len(wl)), rtol=_LINEAR_RTOL,
+                                     atol=0):
+        return None
+    return float(wl[0]), float(cdelt)
+
+
+def _wcs_wavelengths(header, n_wl):
+    """ Wavelengths of the linear WCS keywords of `header`, None if there are none """
+    cdelt = header.get('CDELT1', header.get('CD1_1'))
+    if 'CRVAL1' not in header or cdelt is None:
+        return None
+    ctype = str(header.get('CTYPE1', '')).strip().upper()
+    if ctype not in _LINEAR_CTYPES:
+        raise ValueError("Unsupported wavelength axis CTYPE1 = '{0}': only linear wavelength "
+                         "solutions can be read.".format(ctype))
+    return header['CRVAL1'] + cdelt * (np.arange(n_wl) + (1. - header.get('CRPIX1', 1.)))
+
+
+def _wcs_keywords(columns, name):
+    """ Wavelength WCS keywords of the HDU of column `name`, to compare wavelength solutions """
+    header = columns.headers[name]
+    return tuple(header.get(keyword) for keyword in ('CTYPE1', 'CRVAL1', 'CDELT1', 'CD1_1',
+                                                     'CRPIX1'))
+
+
+def _extname_map(extnames):
+    """ EXTNAME (upper case) -> column name, with `extnames` overriding the defaults """
+    extnames = extnames or {}
+    return dict((extnames.get(name, name).upper(), name) for name in COLUMNS)
+
+
+def _shape(header):
+    """ numpy shape of the data of an HDU header """
+    return tuple(header['NAXIS{0}'.format(axis)] for axis in range(header.get('NAXIS', 0), 0, -1))
+
+
+### READING ###
+
+class _Columns(object):
+    """ Column HDUs of a FITS file opened by astropy, by column name """
+
+    def __init__(self, hdul, extnames=None):
+        self.primary = hdul[0].header
+        names = _extname_map(extnames)
+        self._hdus = {}
+        for hdu in hdul[1:]:
+            name = names.get(hdu.name.upper())
+            # The first HDU of a name is used, as by astropy
+            if name is not None and name not in self._hdus and hdu.is_image:
+                self._hdus[name] = hdu
+        self.headers = dict((name, hdu.header) for name, hdu in self._hdus.items())
+
+    def read(self, name, out):
+        """ Reads column `name` into `out`, a float array of its shape """
+        out[...] = self._hdus[name].data
+
+
+@contextlib.contextmanager
+def _open_columns(filename, extnames=None):
+    """ Opens a FITS file (memory mapped, the HDUs loaded on demand), yields its `_Columns` """
+    with fits.open(filename, memmap=True, lazy_load_hdus=True) as hdul:
+        yield _Columns(hdul, extnames)
+
+
+def _wavelengths(columns, n_wl):
+    """ Wavelengths from the WL HDU or the WCS keywords of the column HDUs / primary header """
+    if 'wl' in columns.headers:
+        wl = np.empty(n_wl)
+        columns.read('wl', wl)
+        return wl
+    headers = [header for name, header in columns.headers.items() if name not in ('time', 'wl')]
+    for header in headers + [columns.primary]:
+        wl = _wcs_wavelengths(header, n_wl)
+        if wl is not None:
+            return wl
+    return None
+
+
+def read_fits(filename, columns=None, extnames=None, dtype=None):
+    """
+    Reads a PolData object from a FITS file. Only the HDUs of the selected columns are read.
+
+    Notes
+    -----
+    Image HDUs named after the columns (case insensitive) are read. If there is no WL HDU the
+    wavelengths are calculated from the linear WCS keywords (CRVAL1, CDELT1 or CD1_1, CRPIX1)
+    of the column HDUs or of the primary header.
+
+    Parameters
+    ----------
+    filename : str
+        path to the file to load data from
+    columns : list of str, optional
+        Columns to read (see `COLUMNS`). Default is all the columns in the file.
+    extnames : dict, optional
+        column name: EXTNAME for files that do not use the column names, e.g. {'q': 'STOKES_Q'}
+    dtype : str or numpy.dtype, optional
+        Precision of the PolData object, 'float32' or 'float64'. Default is the current
+        precision (see `precision.set_precision`).
+
+    Returns
+    -------
+    PolData
+    """
+    with _open_columns(filename, extnames) as hdus:
+        if not hdus.headers:
+            raise ValueError("{0} has no PolData column HDU".format(filename))
+        shapes = set(_shape(header) for header in hdus.headers.values())
+        if len(shapes) > 1 or len(next(iter(shapes))) != 1:
+            raise ValueError("The column HDUs of {0} are not 1D arrays of the same length"
+                             .format(filename))
+        n_pixels, = shapes.pop()
+
+        poldata = PolData(dtype=dtype)
+        names = [name for name in COLUMNS
+                 if name in hdus.headers and (columns is None or name in columns)]
+        wl = None
+        if 'wl' not in names and (columns is None or 'wl' in columns):
+            # From the WCS keywords: allocated with the other columns
+            wl = _wavelengths(hdus, n_pixels)
+            if wl is not None:
+                names.insert(0, 'wl')
+        poldata._empty_block(names, n_pixels)
+        for name in names:
+            if name == 'wl' and wl is not None:
+                poldata.wl[:] = wl
+            else:
+                hdus.read(name, getattr(poldata, name))
+    return poldata
+
+
+def read_fits_collection(filename, columns=None, dtype=None):
+    """
+    Reads a PolDataCollection written by `write_fits`. Only the HDUs of the selected columns
+    are read.
+
+    Parameters
+    ----------
+    filename : str
+        path to the file to load data from
+    columns : list of str, optional
+        Columns to read (see `STACK_COLUMNS`). Default is all the columns in the file.
+    dtype : str or numpy.dtype, optional
+        Precision of the collection, see `read_fits`.
+
+    Returns
+    -------
+    PolDataCollection
+    """
+    with _open_columns(filename) as hdus:
+        if 'time' not in hdus.headers:
+            raise ValueError("{0} has no TIME HDU: it is not a PolDataCollection file"
+                             .format(filename))
+        time = np.empty(_shape(hdus.headers['time']))
+        hdus.read('time', time)
+        names = [name for name in STACK_COLUMNS if name in hdus.headers and
+                 (columns is None or name in columns)]
+        n_wl = _shape(hdus.headers[names[0] if names else 'wl'])[-1]
+        wl = _wavelengths(hdus, n_wl)
+        if wl is None:
+            raise ValueError("{0} has no wavelengths".format(filename))
+
+        collection = PolDataCollection(wl, time, dtype=dtype)
+        collection._add_columns(names)
+        for name in names:
+            hdus.read(name, getattr(collection, name))
+    return collection
+
+
+def stack_fits(filenames, columns=None, extnames=None, dtype=None):
+    """
+    Reads the FITS files of PolData objects with the same wavelengths (e.g. one night of
+    observations) directly into a PolDataCollection.
+
+    Notes
+    -----
+    Each column HDU is read once, straight into the data block of the collection, and the
+    epochs are then sorted by time in place (the block is never held twice). The time of an epoch is the mean of its TIME HDU, or the
+    MJD-OBS keyword of its primary header, or NaN.
+
+    Parameters
+    ----------
+    filenames : list of str
+        FITS files of the epochs (see `read_fits`)
+    columns : list of str, optional
+        Columns to read (see `STACK_COLUMNS`). Default is those in the first file.
+    extnames : dict, optional
+        column name: EXTNAME, see `read_fits`
+    dtype : str or numpy.dtype, optional
+        Precision of the collection, see `read_fits`.
+
+    Returns
+    -------
+    PolDataCollection
+    """
+    if len(filenames) == 0:
+        raise ValueError("At least one file is needed.")
+
+    collection, wl, wcs, names, n_wl = None, None, None, None, None
+    times = np.empty(len(filenames))
+    for epoch, filename in enumerate(filenames):
+        with _open_columns(filename, extnames) as hdus:
+            if collection is None:
+                names = [name for name in STACK_COLUMNS if name in hdus.headers and
+                         (columns is None or name in columns)]
+                if not names:
+                    raise ValueError("{0} has none of the columns {1}"
+                                     .format(filename, STACK_COLUMNS))
+                n_wl = _shape(hdus.headers[names[0]])[-1]
+                wl = _wavelengths(hdus, n_wl)
+                if wl is None:
+                    raise ValueError("{0} has no wavelengths".format(filename))
+                if 'wl' not in hdus.headers:
+                    wcs = _wcs_keywords(hdus, names[0])
+                collection = PolDataCollection(wl, np.zeros(len(filenames)), dtype=dtype)
+                collection._add_columns(names)
+            else:
+                missing = [name for name in names if name not in hdus.headers]
+                if missing:
+                    raise ValueError("{0} has no column {1}".format(filename, missing))
+                if any(_shape(hdus.headers[name]) != (n_wl,) for name in names):
+                    same_wl = False
+                elif wcs is not None and 'wl' not in hdus.headers:
+                    # Same linear solution: no need to build the wavelengths
+                    same_wl = _wcs_keywords(hdus, names[0]) == wcs
+                else:
+                    same_wl = np.array_equal(_wavelengths(hdus, n_wl), wl)
+                if not same_wl:
+                    raise ValueError("{0} does not have the same wavelengths as {1}"
+                                     .format(filename, filenames[0]))
+
+            for name in names:
+                hdus.read(name, getattr(collection, name)[epoch])
+            if 'time' in hdus.headers:
+                time = np.empty(_shape(hdus.headers['time']))
+                hdus.read('time', time)
+                times[epoch] = np.mean(time)
+            else:
+                times[epoch] = hdus.primary.get('MJD-OBS', np.nan)
+
+    collection.time = times
+    collection._sort_epochs(np.argsort(times, kind='mergesort'))
+    return collection
+
+
+### WRITING ###
+
+def _data_hdus(columns, solution, n_wl):
+    """
+    Image HDUs of (name, values) columns, with the WCS of `solution` if given. The values are
+    written in their precision (float32 or float64).
+    """
+    hdus = []
+    for name, values in columns:
+        values = np.asarray(values)
+        if values.dtype != np.float32:
+            values = values.astype(np.float64, copy=False)
+        hdu = fits.ImageHDU(values, name=name.upper())
+        if solution is not None and hdu.data.shape[-1] == n_wl and name != 'time':
+            hdu.header['CTYPE1'] = 'WAVE'
+            hdu.header['CRPIX1'] = 1.
+            hdu.header['CRVAL1'] = solution[0]
+            hdu.header['CDELT1'] = solution[1]
+        hdus.append(hdu)
+    return hdus
+
+
+def write_fits(data, filename, overwrite=False):
+    """
+    Writes a PolData object or a PolDataCollection to a FITS file (see the module docstring).
+
+    Parameters
+    ----------
+    data : PolData or PolDataCollection
+        The data to save. For PolData, p, dp, pa and dpa are only written if they are filled.
+    filename : str
+        path to the file to write
+    overwrite : bool, optional
+        Whether to overwrite an existing file. Default is False.
+
+    Returns
+    -------
+
+    """
+    primary = fits.PrimaryHDU()
+    if isinstance(data, PolDataCollection):
+        primary.header['PSPTYPE'] = ('COLLECTION', 'pyspecpol product type')
+        columns = [('time', data.time)] + [(name, getattr(data, name)) for name in data.columns]
+    else:
+        if data._data is None:
+            raise ValueError("There is no data to save.")
+        primary.header['PSPTYPE'] = ('POLDATA', 'pyspecpol product type')
+        columns = [(name, getattr(data, name)) for name in data.columns]
+
+    wl = data.wl
+    solution = _linear_solution(wl)
+    if solution is not None:
+        columns = [(name, values) for name, values in columns if name != 'wl']
+    elif isinstance(data, PolDataCollection):
+        columns.insert(0, ('wl', wl))
+
+    n_wl = 0 if wl is None else len(wl)
+    fits.HDUList([primary] + _data_hdus(columns, solution, n_wl)).writeto(filename,
+                                                                        overwrite=overwrite)
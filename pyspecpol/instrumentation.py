@@ -0,0 +1,189 @@
+"""
+Opt-in instrumentation of the hot paths of pyspecpol.
+
+The decorated functions (loading files, p, debiasing, P.A.) record their number of calls,
+number of elements processed, wall time and, optionally, the memory they allocate -- but only
+inside an `instrument()` block. Outside of it the decorator only checks one global flag.
+
+    with instrument() as report:
+        run_my_batch()
+    print(report.summary())
+    report.to_json('timings.json')
+
+The times are inclusive: the time of `calc_p` includes the debiasing it calls.
+
+The instrumented functions can run in several threads (e.g. with the threaded Dask scheduler):
+the counts and times of all the threads are added up. The memory traced is that of the whole
+process though, so the memory of a stage is only meaningful when one thread runs at a time.
+"""
+
+import json
+import time
+import threading
+import contextlib
+import functools
+import tracemalloc
+import numpy as np
+
+# Report being recorded, None when the instrumentation is off
+_REPORT = None
+
+
+class Report(object):
+    """
+    Statistics recorded by `instrument`, per stage.
+
+    Attributes
+    ----------
+    stats : dict
+        stage name -> {'calls', 'elements', 'time', 'bytes'}. 'bytes' is the sum over the calls
+        of the peak memory allocated during each call, None unless memory is traced.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def _memory_stack(self):
+        """ [memory at the start, largest peak seen] of the stages of this thread, see `_call` """
+        stack = getattr(self._local, 'memory_stack', None)
+        if stack is None:
+            stack = self._local.memory_stack = []
+        return stack
+
+    def _add(self, stage, elements, seconds, allocated):
+        with self._lock:
+            stats = self.stats.get(stage)
+            if stats is None:
+                stats = self.stats[stage] = {'calls': 0, 'elements': 0, 'time': 0.,
+                                             'bytes': 0 if self.trace_memory else None}
+            stats['calls'] += 1
+            stats['elements'] += elements
+            stats['time'] += seconds
+            if allocated is not None:
+                stats['bytes'] += allocated
+
+    def throughput(self, stage):
+        """ Elements per second processed by `stage` """
+        stats = self.stats[stage]
+        return stats['elements'] / stats['time'] if stats['time'] > 0 else float('inf')
+
+    def as_dict(self):
+        """ Statistics of all the stages, with their throughput in elements per second """
+        return dict((stage, dict(stats, elements_per_second=self.throughput(stage)))
+                    for stage, stats in self.stats.items())
+
+    def to_json(self, filename=None):
+        """ JSON dump of `as_dict` -- written to `filename` if given, returned otherwise """
+        if filename is None:
+            return json.dumps(self.as_dict(), indent=1, sort_keys=True)
+        with open(filename, 'w') as f:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+
+    def summary(self):
+        """ Table of the statistics of each stage, slowest first """
+        lines = ['{0:<20} {1:>8} {2:>12} {3:>10} {4:>12} {5:>12}'
+                 .format('stage', 'calls', 'elements', 'time [s]', 'elements/s', 'MiB')]
+        for stage in sorted(self.stats, key=lambda name: -self.stats[name]['time']):
+            stats = self.stats[stage]
+            memory = '-' if stats['bytes'] is None else '{0:.1f}'.format(stats['bytes'] / 2**20)
+            lines.append('{0:<20} {1:>8} {2:>12} {3:>10.4f} {4:>12.4g} {5:>12}'
+                         .format(stage, stats['calls'], stats['elements'], stats['time'],
+                                 self.throughput(stage), memory))
+        return '\n'.join(lines)
+
+
+@contextlib.contextmanager
+def instrument(trace_memory=False):
+    """
+    Context manager recording the statistics of the instrumented functions in a `Report`.
+
+    Parameters
+    ----------
+    trace_memory : bool, optional
+        Whether to record the memory allocated, with tracemalloc. This slows down the code
+        significantly. Default is False.
+
+    Yields
+    ------
+    Report
+    """
+    global _REPORT
+    report = Report(trace_memory=trace_memory)
+    start_tracing = trace_memory and not tracemalloc.is_tracing()
+    previous, _REPORT = _REPORT, report
+    if start_tracing:
+        tracemalloc.start()
+    try:
+        yield report
+    finally:
+        _REPORT = previous
+        if start_tracing:
+            tracemalloc.stop()
+
+
+def _n_elements(args, result):
+    """ Default element count: size of the first argument """
+    return int(np.size(args[0])) if args else 0
+
+
+def instrumented(stage, count=_n_elements):
+    """
+    Decorator recording the calls of a function as `stage` while an `instrument` block is active.
+
+    Parameters
+    ----------
+    stage : str
+        Name of the stage in the report
+    count : callable, optional
+        count(args, result) -> number of elements processed. Default is the size of the first
+        argument.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _REPORT is None:
+                return func(*args, **kwargs)
+            return _call(_REPORT, stage, count, func, args, kwargs)
+        return wrapper
+    return decorator
+
+
+def _call(report, stage, count, func, args, kwargs):
+    """ Runs func and records it in `report` """
+    # Peak memory of nested stages: the peak is reset when a stage starts, so the largest
+    # peak seen so far by the enclosing stage is kept on the stack.
+    memory_stack = report._memory_stack
+    tracing = report.trace_memory and tracemalloc.is_tracing()
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        if memory_stack:
+            memory_stack[-1][1] = max(memory_stack[-1][1], peak)
+        memory_stack.append([current, 0])
+        _reset_peak()
+
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter() - start
+        allocated = None
+        if tracing:
+            start_memory, enclosed_peak = memory_stack.pop()
+            peak = max(tracemalloc.get_traced_memory()[1], enclosed_peak)
+            allocated = max(0, peak - start_memory)
+            if memory_stack:
+                memory_stack[-1][1] = max(memory_stack[-1][1], peak)
+
+    report._add(stage, count(args, result), seconds, allocated)
+    return result
+
+
+def _reset_peak():
+    # tracemalloc.reset_peak is new in Python 3.9: before that, the peaks include those of the
+    # previous calls and over-estimate the memory of a stage
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
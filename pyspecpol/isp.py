@@ -0,0 +1,201 @@
+"""
+Interstellar polarisation (ISP): Serkowski law and its removal in Stokes q, u space.
+
+The Serkowski law (Serkowski, Mathewson & Ford 1975; Wilking et al. 1980) gives the degree
+of interstellar polarisation as a function of wavelength:
+
+    p(wl) = p_max * exp(-K * ln(wl_max / wl)**2)
+
+with a constant polarisation angle theta, so that q = p cos(2 theta) and u = p sin(2 theta).
+"""
+
+import functools
+import numpy as np
+from .misc import PolData
+from .collection import PolDataCollection
+
+# Number of (parameters, wavelength grid) combinations kept by the ISP cache
+_ISP_CACHE_SIZE = 128
+
+
+def serkowski(wl, p_max, wl_max, k=1.15):
+    """
+    Degree of polarisation following the Serkowski law.
+
+    Parameters
+    ----------
+    wl : numpy.ndarray or float
+        Wavelength(s), in the same units as wl_max
+    p_max : float
+        Maximum degree of polarisation
+    wl_max : float
+        Wavelength of the maximum
+    k : float, optional
+        Width parameter K. Default is 1.15 (Serkowski et al. 1975).
+
+    Returns
+    -------
+    Degree of polarisation in the units of p_max (float or numpy.ndarray)
+    """
+    log_ratio = np.log(wl_max / np.asarray(wl, dtype=float))
+    return p_max * np.exp(-k * log_ratio * log_ratio)
+
+
+class _Grid(object):
+    """
+    Hashable wrapper of a wavelength grid, so it can be part of an lru_cache key. The hash is
+    a cheap fingerprint of the grid (shape, first and last wavelengths, first step) and equal
+    fingerprints are told apart by comparing the grids. The grid is only copied when the key
+    is stored in the cache (see `own`), not at every lookup.
+    """
+    __slots__ = ('wl', '_hash')
+
+    def __init__(self, wl):
+        self.wl = np.asarray(wl, dtype=float)
+        flat = self.wl.reshape(-1)
+        ends = (flat[0], flat[-1], flat[min(1, flat.size - 1)] - flat[0]) if flat.size else ()
+        self._hash = hash((self.wl.shape,) + tuple(float(x) for x in ends))
+
+    def own(self):
+        """ Replaces the grid by a read-only copy, so the cache key cannot change afterwards """
+        self.wl = np.array(self.wl)
+        self.wl.setflags(write=False)
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        return self._hash == other._hash and (self.wl is other.wl or
+                                              np.array_equal(self.wl, other.wl))
+
+
+def isp_stokes(wl, p_max, wl_max, theta, k=1.15, dp_max=0., dwl_max=0., dk=0., dtheta=0.,
+               covariance=False):
+    """
+    Stokes q and u of the ISP (Serkowski law) on a wavelength grid, and their errors.
+
+    Notes
+    -----
+    1) The errors on the ISP parameters are assumed independent and propagated to first order.
+
+    2) The results are cached (least recently used, keyed by the parameters and the grid) and
+    returned as read-only arrays, so the same ISP subtracted from many spectra sharing a grid
+    is only evaluated once.
+
+    Parameters
+    ----------
+    wl : numpy.ndarray
+        Wavelength grid, in the same units as wl_max
+    p_max : float
+        Maximum degree of polarisation of the ISP (same units as the Stokes parameters)
+    wl_max : float
+        Wavelength of the maximum
+    theta : float
+        Polarisation angle of the ISP in degrees
+    k : float, optional
+        Width parameter K of the Serkowski law. Default is 1.15.
+    dp_max, dwl_max, dk, dtheta : float, optional
+        Errors on the ISP parameters. Default is 0.
+    covariance : bool, optional
+        Whether to also return the covariance of q_isp and u_isp, which share the errors on
+        the parameters. Default is False.
+
+    Returns
+    -------
+    Tuple(q_isp, u_isp, dq_isp, du_isp) -- numpy.ndarrays, followed by covqu_isp if
+    `covariance` is True
+    """
+    results = _isp_stokes_cached(_Grid(wl), float(p_max), float(wl_max), float(theta), float(k),
+                                 float(dp_max), float(dwl_max), float(dk), float(dtheta))
+    return results if covariance else results[:4]
+
+
+@functools.lru_cache(maxsize=_ISP_CACHE_SIZE)
+def _isp_stokes_cached(grid, p_max, wl_max, theta, k, dp_max, dwl_max, dk, dtheta):
+    """ Cached implementation of `isp_stokes` -- see `_isp_stokes_cached.cache_info()` """
+    # Cache miss: `grid` is about to be stored as (part of) the key
+    grid.own()
+    wl = grid.wl
+    log_ratio = np.log(wl_max / wl)
+    p = p_max * np.exp(-k * log_ratio * log_ratio)
+
+    two_theta = np.deg2rad(2 * theta)
+    cos, sin = np.cos(two_theta), np.sin(two_theta)
+    q, u = p * cos, p * sin
+
+    # Partial derivatives of p: dp/dp_max = p/p_max, dp/dwl_max = -2 K ln(wl_max/wl) p / wl_max,
+    # dp/dK = -ln(wl_max/wl)**2 p
+    var_p = np.zeros_like(p)
+    if dp_max:
+        var_p += (np.exp(-k * log_ratio * log_ratio) * dp_max) ** 2
+    if dwl_max:
+        var_p += (2 * k * log_ratio * p / wl_max * dwl_max) ** 2
+    if dk:
+        var_p += (log_ratio * log_ratio * p * dk) ** 2
+
+    # dq/dtheta = -2 p sin(2 theta), du/dtheta = 2 p cos(2 theta), theta in radians
+    dtheta = np.deg2rad(dtheta)
+    dq = np.sqrt(cos * cos * var_p + (2 * p * sin * dtheta) ** 2)
+    du = np.sqrt(sin * sin * var_p + (2 * p * cos * dtheta) ** 2)
+    covqu = cos * sin * var_p - 4 * p * p * sin * cos * dtheta * dtheta
+
+    for array in (q, u, dq, du, covqu):
+        array.setflags(write=False)
+    return q, u, dq, du, covqu
+
+
+def remove_isp(data, p_max, wl_max, theta, k=1.15, dp_max=0., dwl_max=0., dk=0., dtheta=0.,
+               in_place=False):
+    """
+    Subtracts a Serkowski law ISP from the Stokes parameters of a PolData object or of all the
+    epochs of a PolDataCollection at once.
+
+    Notes
+    -----
+    The errors on the ISP (see `isp_stokes`) are added in quadrature to dq and du, and the
+    covariance of the ISP q and u to covqu (filled if it was not). The derived columns (p, dp,
+    pa, dpa) are cleared since they no longer match q and u.
+
+    Parameters
+    ----------
+    data : PolData or PolDataCollection
+        Data with a wavelength grid and Stokes q and u
+    p_max, wl_max, theta, k, dp_max, dwl_max, dk, dtheta : float
+        ISP parameters and their errors, see `isp_stokes`
+    in_place : bool, optional
+        Whether to modify `data` rather than return a modified copy. Default is False.
+
+    Returns
+    -------
+    PolData or PolDataCollection (`data` itself if in_place is True)
+    """
+    if not isinstance(data, (PolData, PolDataCollection)):
+        raise TypeError("`data` should be a PolData or a PolDataCollection object.")
+    if data.wl is None or data.q is None or data.u is None:
+        raise ValueError("Removing the ISP needs the wavelengths and Stokes q and u.")
+
+    if not in_place:
+        data = data.copy()
+    elif isinstance(data, PolData):
+        # A selection sharing its data block (see `PolData.select_wl`) is copied on write
+        data._own_data()
+
+    q_isp, u_isp, dq_isp, du_isp, covqu_isp = isp_stokes(data.wl, p_max, wl_max, theta, k=k,
+                                                         dp_max=dp_max, dwl_max=dwl_max, dk=dk,
+                                                         dtheta=dtheta, covariance=True)
+    # The ISP arrays are 1D and broadcast over the epochs of a collection
+    np.subtract(data.q, q_isp, out=data.q)
+    np.subtract(data.u, u_isp, out=data.u)
+    if dp_max or dwl_max or dk or dtheta:
+        if data.dq is not None:
+            np.hypot(data.dq, dq_isp, out=data.dq)
+        if data.du is not None:
+            np.hypot(data.du, du_isp, out=data.du)
+        if data.covqu is not None:
+            np.add(data.covqu, covqu_isp, out=data.covqu)
+        elif np.any(covqu_isp):
+            data.covqu = np.broadcast_to(covqu_isp, data.q.shape)
+
+    for name in ('p', 'dp', 'pa', 'dpa'):
+        setattr(data, name, None)
+    return data
@@ -4,35 +4,706 @@
 T'is only the beginning
 """
 
+import os
 import sys
+import json
+import struct
+import logging
 import numpy as np
 import warnings
 import pandas as pd
 from .utils.errors import _warn_if_list
+from .utils.interpolation import interpolation_plan
+from .montecarlo import mc_p_and_pa
+from .instrumentation import instrumented
+from .precision import _float_dtype, _result_dtype
 
 if sys.version_info.major < 3:
     range = xrange
     input = raw_input
 
+logger = logging.getLogger(__name__)
+
+
+def _is_dask(array):
+    """ Whether `array` is a Dask array, see `daskdata` (without importing dask) """
+    return type(array).__module__.startswith('dask.')
+
 
 ### PolData Object ###
 
+# Per-pixel columns of a PolData object, in the order they are stored in its data block.
+# New columns are only ever appended, so that older binary files can still be read.
+COLUMNS = ('wl', 'time', 'q', 'dq', 'u', 'du', 'p', 'dp', 'pa', 'dpa',
+           'nq', 'dnq', 'nu', 'dnu', 'hwp_chi2', 'hwp_flux_dev', 'covqu')
+_COLUMN_INDEX = dict((name, i) for i, name in enumerate(COLUMNS))
+# Columns derived from the Stokes parameters, and the columns holding errors
+_DERIVED_COLUMNS = ('p', 'dp', 'pa', 'dpa')
+_ERROR_COLUMNS = ('dq', 'du', 'dp', 'dpa', 'dnq', 'dnu')
+# Columns holding a (co)variance rather than an error
+_VARIANCE_COLUMNS = ('covqu',)
+# Null parameters and HWP diagnostics from the beam reduction (see `reduction.beams_to_stokes`)
+_DIAGNOSTIC_COLUMNS = ('nq', 'dnq', 'nu', 'dnu', 'hwp_chi2', 'hwp_flux_dev')
+# Indices of the columns that no longer match q and u once these are modified
+_STOKES_DEPENDENT = [_COLUMN_INDEX[name] for name in _DERIVED_COLUMNS + _DIAGNOSTIC_COLUMNS]
+# Indices of the Stokes parameters and of the columns derived from them (see `_derived_column`)
+_STOKES_INDICES = frozenset(_COLUMN_INDEX[name] for name in ('q', 'dq', 'u', 'du', 'covqu'))
+_DERIVED_INDICES = [_COLUMN_INDEX[name] for name in _DERIVED_COLUMNS]
+
+
+def _pyarrow_available():
+    """ Whether pandas.read_csv can use the pyarrow engine (pyarrow installed and pandas >= 1.4) """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return tuple(int(v) for v in pd.__version__.split('.')[:2]) >= (1, 4)
+
+
+_PYARROW_AVAILABLE = _pyarrow_available()
+# The multi-threaded pyarrow parser only beats the C parser on files larger than this (bytes)
+_PYARROW_MIN_SIZE = 2**20
+
+
+def _csv_engine(filename, kwargs):
+    """
+    Fastest pandas.read_csv engine for this file: pyarrow for large files if installed.
+    The C engine is kept whenever other read_csv `kwargs` are given, as the pyarrow engine
+    does not support all of them (regex separators, comments, ...).
+    """
+    if not _PYARROW_AVAILABLE or kwargs:
+        return 'c'
+    try:
+        size = os.path.getsize(filename)
+    except (OSError, TypeError):
+        # e.g. buffers or URLs
+        return 'c'
+    return 'pyarrow' if size >= _PYARROW_MIN_SIZE else 'c'
+
+
+def _read_csv_columns(filename, dtype=np.float64, **kwargs):
+    """
+    Reads the recognised columns (see `COLUMNS`) of a csv file as arrays of `dtype`.
+
+    The other columns are never parsed. Accepts the same **kwargs as pandas.read_csv();
+    the engine defaults to the fastest available for the size of the file and the kwargs.
+
+    Returns a dictionary of column name: numpy.ndarray
+    """
+    engine = kwargs.pop('engine', None) or _csv_engine(filename, kwargs)
+
+    if engine == 'pyarrow':
+        # The pyarrow engine does not accept a callable for `usecols` so the header is read first
+        header = pd.read_csv(filename, nrows=0, engine='c', **kwargs).columns
+        usecols = [name for name in header if name in _COLUMN_INDEX]
+    else:
+        usecols = lambda name: name in _COLUMN_INDEX
+
+    temp_df = pd.read_csv(filename, usecols=usecols, engine=engine, dtype=dtype, **kwargs)
+    _log_missing_columns(filename, temp_df.columns)
+
+    return dict((name, temp_df[name].values) for name in temp_df.columns)
+
+
+def _iter_csv_columns(filename, chunksize, dtype=np.float64, **kwargs):
+    """
+    Same as `_read_csv_columns` but yields dictionaries of (at most) `chunksize` rows.
+    Uses the C engine, the only one that can read in chunks.
+    """
+    kwargs.pop('engine', None)
+    reader = pd.read_csv(filename, usecols=lambda name: name in _COLUMN_INDEX, engine='c',
+                         dtype=dtype, chunksize=chunksize, **kwargs)
+    first = True
+    for temp_df in reader:
+        if first:
+            _log_missing_columns(filename, temp_df.columns)
+            first = False
+        yield dict((name, temp_df[name].values) for name in temp_df.columns)
+
+
+def _log_missing_columns(filename, names):
+    """ Logs the columns of `COLUMNS` which are not in `names` """
+    missing = [name for name in COLUMNS if name not in names]
+    if len(missing) == len(COLUMNS):
+        logger.warning("No recognised column in %s. Accepted column names (case sensitive): %s",
+                       filename, ", ".join(COLUMNS))
+    elif missing:
+        logger.debug("Columns not found in %s: %s", filename, ", ".join(missing))
+
+
+def _split_columns_by_wl(chunks, wl_step, wl_start=None):
+    """
+    Re-splits a stream of column dictionaries (sorted by wavelength) into wavelength bins
+    [wl_start + k*wl_step, wl_start + (k+1)*wl_step). Only the last incomplete bin is kept in
+    memory between chunks. Empty bins are skipped.
+    """
+    carry = None
+    for columns in chunks:
+        if carry is not None:
+            columns = dict((name, np.concatenate((carry[name], values)))
+                           for name, values in columns.items())
+        wl = columns['wl']
+        if len(wl) == 0:
+            continue
+        if wl_start is None:
+            wl_start = wl[0]
+
+        # Index of the bin of each pixel, computed once per pixel so that all the pixels of a bin
+        # agree, and split where it changes. The last bin may continue in the next chunk.
+        bins = np.floor((wl - wl_start) / wl_step)
+        start = 0
+        for stop in np.flatnonzero(np.diff(bins)) + 1:
+            yield dict((name, values[start:stop]) for name, values in columns.items())
+            start = stop
+        carry = dict((name, values[start:]) for name, values in columns.items())
+
+    if carry is not None and len(carry['wl']) > 0:
+        yield carry
+
+
+# Binary PolData format: magic string, header length (uint32, little endian), JSON header,
+# padding up to `_BINARY_ALIGN`, then one block of `stride` values per column of `COLUMNS`.
+# `stride` is n_pixels rounded up so that every column starts on a page boundary.
+_BINARY_MAGIC = b'\x93PYSPECPOL'
+_BINARY_VERSION = 1
+_BINARY_ALIGN = 4096
+
+
+def _create_binary(filename, n_pixels, filled, dtype=np.dtype(np.float64)):
+    """
+    Writes the header of a binary file for `n_pixels` pixels and the `filled` columns, and
+    sizes the file (the columns are holes until written). Returns (data offset, column stride
+    in bytes).
+    """
+    dtype = np.dtype(dtype)
+    per_page = _BINARY_ALIGN // dtype.itemsize
+    stride = -(-n_pixels // per_page) * per_page
+
+    header = json.dumps({'version': _BINARY_VERSION,
+                         'dtype': dtype.str,
+                         'n_pixels': n_pixels,
+                         'stride': stride,
+                         'columns': list(COLUMNS),
+                         'filled': [name for name, f in zip(COLUMNS, filled) if f]}).encode('utf-8')
+    offset = _binary_data_offset(len(header))
+
+    row_bytes = stride * dtype.itemsize
+    with open(filename, 'wb') as f:
+        f.write(_BINARY_MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        # Columns that are not filled are left as holes in the file (sparse on most file systems)
+        f.truncate(offset + len(COLUMNS) * row_bytes)
+    return offset, row_bytes
+
+
+def _write_binary(filename, data, filled, rows=None):
+    """
+    Writes the `filled` columns of a data block in the binary format, column i being the row
+    rows[i] of `data` (default: row i, see `PolData`)
+    """
+    if rows is None:
+        rows = np.arange(len(filled))
+    offset, row_bytes = _create_binary(filename, data.shape[1], filled, data.dtype)
+    with open(filename, 'r+b') as f:
+        for index in np.flatnonzero(filled):
+            f.seek(offset + index * row_bytes)
+            f.write(np.ascontiguousarray(data[rows[index]]).tobytes())
+
+
+def _binary_data_offset(header_length):
+    """ Position of the first column block: the end of the header rounded up to `_BINARY_ALIGN` """
+    prefix_length = len(_BINARY_MAGIC) + 4 + header_length
+    return -(-prefix_length // _BINARY_ALIGN) * _BINARY_ALIGN
+
+
+def _open_binary(filename, mmap_mode='c'):
+    """
+    Memory maps a binary PolData file. Returns the (n_columns, n_pixels) block, with one row per
+    column of `COLUMNS` (up to the number of columns of the file), and the filled mask.
+    """
+    with open(filename, 'rb') as f:
+        magic = f.read(len(_BINARY_MAGIC))
+        if magic != _BINARY_MAGIC:
+            raise ValueError("{0} is not a binary PolData file".format(filename))
+        header_length, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(header_length).decode('utf-8'))
+
+    if header['version'] > _BINARY_VERSION:
+        raise ValueError("{0} was written with a more recent version of the binary PolData format"
+                         " ({1})".format(filename, header['version']))
+    n_columns = len(header['columns'])
+    if list(header['columns']) != list(COLUMNS[:n_columns]):
+        raise ValueError("The columns of {0} do not match PolData columns".format(filename))
+
+    # Files written before the last columns were added have fewer rows: the missing columns
+    # are unfilled, and their rows are only allocated if they get set (see `PolData._add_rows`)
+    block = np.memmap(filename, dtype=np.dtype(header['dtype']), mode=mmap_mode,
+                      offset=_binary_data_offset(header_length), shape=(n_columns, header['stride']))
+    filled = np.array([name in header['filled'] for name in COLUMNS], dtype=bool)
+    return block[:, :header['n_pixels']], filled
+
+
+def _rows_of(filled):
+    """ Row of each column in a block of the `filled` columns only (-1 if none) """
+    rows = np.full(len(filled), -1, dtype=np.intp)
+    rows[filled] = np.arange(np.count_nonzero(filled))
+    return rows
+
+
+def _compact_block(data, rows, filled, copy=False):
+    """
+    Block of the `filled` columns only, in the order of the columns: `data` itself if it is
+    already (copied if `copy` is True). Column i is the row rows[i] of `data`.
+    """
+    rows = rows[filled]
+    if len(rows) == len(data) and np.array_equal(rows, np.arange(len(rows))):
+        return np.array(data) if copy else data
+    return data[rows]
+
+
+def _add_block_rows(data, rows, filled, indices):
+    """
+    Makes sure the columns `indices` have a row in the block `data` (column i being the row
+    rows[i], -1 if none), updating `rows` in place. Missing rows are taken from the rows of the
+    emptied columns if there are enough, otherwise the block is reallocated with exactly the
+    rows of the filled columns and of `indices`. Returns the block.
+    """
+    new = [index for index in np.unique(indices) if rows[index] < 0]
+    if not new:
+        return data
+    # Rows mapped to unfilled columns other than `indices` are spare
+    mapped = filled.copy()
+    mapped[indices] = True
+    taken = np.zeros(len(data), dtype=bool)
+    taken[rows[mapped & (rows >= 0)]] = True
+    rows[~mapped] = -1
+    spare = np.flatnonzero(~taken)
+    if len(spare) >= len(new):
+        rows[new] = spare[:len(new)]
+        return data
+
+    keep = np.flatnonzero(mapped & (rows >= 0))
+    block = np.empty((len(keep) + len(new),) + data.shape[1:], dtype=data.dtype)
+    block[:len(keep)] = data[rows[keep]]
+    rows[keep] = np.arange(len(keep))
+    rows[new] = np.arange(len(keep), len(keep) + len(new))
+    return block
+
+
+def _column(name):
+    """ Property giving access to one row of the PolData data block (None if not filled) """
+    index = _COLUMN_INDEX[name]
+
+    def getter(self):
+        if not self._filled[index]:
+            return None
+        return self._data[self._rows[index]]
+
+    def setter(self, value):
+        self._set_column(index, value)
+
+    return property(getter, setter, doc="Column '{0}' -- view into the data block or None"
+                                        .format(name))
+
+
+def _derived_column(name):
+    """ Like `_column`, but calculated from the Stokes parameters when first accessed """
+    index = _COLUMN_INDEX[name]
+
+    def getter(self):
+        if not self._filled[index]:
+            return self._calc_derived(index)
+        return self._data[self._rows[index]]
+
+    def setter(self, value):
+        self._set_column(index, value)
+
+    return property(getter, setter, doc="Column '{0}' -- view into the data block, calculated "
+                                        "from q and u if needed, or None".format(name))
+
+
 class PolData(object):
-    # TODO: Give it a __add__, __sub__, __truediv__, etc...
+    """
+    Spectropolarimetric data: one spectrum (or time series) per object.
+
+    Notes
+    -----
+    All the per-pixel columns (see `COLUMNS`) are rows of a single C-contiguous 2D float array
+    of shape (n_rows, n_pixels) stored in `_data`, column i being the row `_rows[i]`. The
+    attributes `wl`, `q`, `dq`, etc... are views into that block, and are None when the column
+    has not been filled (see `_filled`). Assigning an array to a column copies it into the block.
+
+    The rows are only allocated for the columns that get filled, so a spectrum with q and u
+    only does not pay for the other columns. Copying, pickling or sending a PolData object to
+    another process only involves one buffer, of the filled columns.
+
+    The derived columns p, dp, pa and dpa are calculated from the Stokes parameters the first
+    time they are accessed (as `calc_pol` does, with the default Wang debiasing, or without
+    errors if dq or du is missing, with the q-u covariance `covqu` if filled) and cached in the
+    block. Assigning q, dq, u, du or covqu clears them. Modifying the Stokes parameters in place
+    (e.g. `poldata.q[0] = 1.`) does not: call `calc_pol` again in that case.
+
+    The data block is float64 by default, or float32 to halve the memory (see `precision`).
+
+    Parameters
+    ----------
+    filename : str, optional
+        csv file to load, see `load_file`
+    dtype : str or numpy.dtype, optional
+        Precision of the data block: 'float32' or 'float64'. Default is the precision set with
+        `precision.set_precision` (float64 unless changed). A block memory mapped from a binary
+        file (`load_binary`) keeps the precision of the file.
+    """
     # TODO: plotting methods??
-    # TODO: ISP related methods??
 
-    def __init__(self, filename=None):
+    __slots__ = ('_data', '_rows', '_filled', '_dtype')
+
+    wl, time = _column('wl'), _column('time')
+    q, dq, u, du = _column('q'), _column('dq'), _column('u'), _column('du')
+    p, dp = _derived_column('p'), _derived_column('dp')
+    pa, dpa = _derived_column('pa'), _derived_column('dpa')
+    nq, dnq, nu, dnu = _column('nq'), _column('dnq'), _column('nu'), _column('dnu')
+    hwp_chi2, hwp_flux_dev = _column('hwp_chi2'), _column('hwp_flux_dev')
+    covqu = _column('covqu')
+
+    def __init__(self, filename=None, dtype=None):
+        self._data = None
+        self._rows = np.full(len(COLUMNS), -1, dtype=np.intp)
+        self._filled = np.zeros(len(COLUMNS), dtype=bool)
+        self._dtype = _float_dtype(dtype)
+
         if filename is not None:
             self.load_file(filename)
 
-        if filename is None:
-            self.wl, self.time = False, False
-            self.p, self.dp, self.q, self.dq, self.u, self.du, self.pa, self.dpa = False, False, \
-                                                                                   False, False, \
-                                                                                   False, False, \
-                                                                                   False, False
+    def __len__(self):
+        return 0 if self._data is None else self._data.shape[1]
+
+    def __getstate__(self):
+        # Only the filled rows, in the order of COLUMNS
+        data = None if self._data is None else self._compact_data()
+        return data, self._filled, self._dtype
+
+    def __setstate__(self, state):
+        self._data, self._filled, self._dtype = state
+        if self._data is not None and len(self._data) != np.count_nonzero(self._filled):
+            # Pickled with one row per column
+            self._rows = np.full(len(COLUMNS), -1, dtype=np.intp)
+            self._rows[:len(self._data)] = np.arange(len(self._data))
+        else:
+            self._rows = _rows_of(self._filled)
+
+    @property
+    def columns(self):
+        """ Names of the filled columns """
+        return tuple(name for name, filled in zip(COLUMNS, self._filled) if filled)
+
+    @property
+    def dtype(self):
+        """ Precision of the data block (numpy.dtype) """
+        return self._dtype if self._data is None else self._data.dtype
+
+    def copy(self):
+        """ Returns a deep copy of the object (a single copy of the filled rows of the block) """
+        new = PolData(dtype=self.dtype)
+        if self._data is not None:
+            new._data = self._compact_data(copy=True)
+        new._filled = self._filled.copy()
+        new._rows = _rows_of(new._filled)
+        return new
+
+    def astype(self, dtype):
+        """
+        Returns a copy of the object with its data block converted to `dtype`.
+
+        Parameters
+        ----------
+        dtype : str or numpy.dtype
+            'float32' or 'float64'
+
+        Returns
+        -------
+        PolData
+        """
+        new = PolData(dtype=dtype)
+        if self._data is not None:
+            new._data = self._compact_data().astype(new._dtype)
+        new._filled = self._filled.copy()
+        new._rows = _rows_of(new._filled)
+        return new
+
+    def select_wl(self, wl_min=None, wl_max=None):
+        """
+        Selects a wavelength range (wavelengths must be sorted in increasing order).
+
+        The returned PolData object shares the data block of this one: no data is copied, and
+        for memory mapped data only the selected range is read from disk. The shared block is
+        read-only in the selection, which copies it the first time one of its columns is
+        modified, so this object is never changed through the selection. Modifying this object
+        does show in the selection: take a `copy` of the selection if both are modified.
+
+        Parameters
+        ----------
+        wl_min, wl_max : float, optional
+            Limits of the wavelength range (inclusive). Default is no limit.
+
+        Returns
+        -------
+        PolData
+        """
+        if self.wl is None:
+            raise ValueError("The PolData object has no wavelength column.")
+        # searchsorted only touches log(n_pixels) values of the wavelength column
+        start = 0 if wl_min is None else np.searchsorted(self.wl, wl_min, side='left')
+        stop = len(self) if wl_max is None else np.searchsorted(self.wl, wl_max, side='right')
+
+        new = PolData(dtype=self.dtype)
+        new._data = self._data[:, start:stop]
+        new._data.flags.writeable = False
+        new._rows = self._rows.copy()
+        new._filled = self._filled.copy()
+        return new
+
+    def resample(self, wl):
+        """
+        Linearly resamples the data on a new wavelength grid (both grids must be increasing).
 
+        Notes
+        -----
+        The errors are resampled by propagating the variance. Pixels outside of the current
+        wavelength range are NaN. The interpolation plan is cached (see
+        `utils.interpolation.interpolation_plan`), so resampling many spectra with the same
+        wavelengths onto the same grid only searches the grid once.
+
+        Parameters
+        ----------
+        wl : numpy.ndarray
+            The new wavelength grid
+
+        Returns
+        -------
+        PolData
+        """
+        if self.wl is None:
+            raise ValueError("The PolData object has no wavelength column.")
+        wl = np.asarray(wl, dtype=float)
+        plan = interpolation_plan(self.wl, wl)
+
+        new = PolData(dtype=self.dtype)
+        new._empty_block(self.columns, len(wl))
+        new.wl[:] = wl
+        for name in self.columns:
+            if name != 'wl':
+                plan.apply(getattr(self, name), error=name in _ERROR_COLUMNS,
+                           variance=name in _VARIANCE_COLUMNS, out=getattr(new, name))
+        return new
+
+    ### ARITHMETIC ON THE STOKES PARAMETERS ###
+    # The operators act on q and u, the errors dq and du are propagated (missing errors count
+    # as 0) and p, dp, pa and dpa (and the reduction diagnostics) are cleared since they no
+    # longer match q and u.
+    # The in-place operators work within the data block and allocate at most one temporary array.
+
+    def __add__(self, other):
+        if not isinstance(other, PolData):
+            return NotImplemented
+        return self.copy().__iadd__(other)
+
+    def __sub__(self, other):
+        if not isinstance(other, PolData):
+            return NotImplemented
+        return self.copy().__isub__(other)
+
+    def __truediv__(self, other):
+        if not isinstance(other, (PolData, int, float, np.ndarray, np.number)):
+            return NotImplemented
+        return self.copy().__itruediv__(other)
+
+    def __iadd__(self, other):
+        if not isinstance(other, PolData):
+            return NotImplemented
+        return self._add_stokes(other, np.add)
+
+    def __isub__(self, other):
+        if not isinstance(other, PolData):
+            return NotImplemented
+        return self._add_stokes(other, np.subtract)
+
+    def __itruediv__(self, other):
+        if isinstance(other, PolData):
+            return self._divide_stokes(other)
+        if not isinstance(other, (int, float, np.ndarray, np.number)):
+            return NotImplemented
+
+        # Division by a number (or an array of one number per pixel)
+        self._check_stokes()
+        self._own_data()
+        for x, dx in (('q', 'dq'), ('u', 'du')):
+            np.divide(getattr(self, x), other, out=getattr(self, x))
+            if getattr(self, dx) is not None:
+                np.divide(getattr(self, dx), np.abs(other), out=getattr(self, dx))
+        if self.covqu is not None:
+            np.divide(self.covqu, np.square(other), out=self.covqu)
+        self._filled[_STOKES_DEPENDENT] = False
+        return self
+
+    def _check_stokes(self, other=None):
+        """ Checks q and u are filled and, if `other` is given, that the wavelengths match """
+        for poldata in (self, other):
+            if poldata is not None and (poldata.q is None or poldata.u is None):
+                raise ValueError("Arithmetic operations need Stokes q and u.")
+        if other is None:
+            return
+        if len(self) != len(other) or (self.wl is not None and other.wl is not None and
+                                       not np.array_equal(self.wl, other.wl)):
+            raise ValueError("The PolData objects are on different wavelength grids. "
+                             "Resample one of them first, e.g. `a + b.resample(a.wl)`.")
+
+    def _add_stokes(self, other, operation):
+        """ In-place addition or subtraction (`operation`) of the Stokes parameters of `other` """
+        self._check_stokes(other)
+        self._own_data()
+        for x, dx in (('q', 'dq'), ('u', 'du')):
+            operation(getattr(self, x), getattr(other, x), out=getattr(self, x))
+            # dx = sqrt(dx_self**2 + dx_other**2)
+            error, other_error = getattr(self, dx), getattr(other, dx)
+            if other_error is None:
+                continue
+            if error is None:
+                setattr(self, dx, other_error)
+            else:
+                np.hypot(error, other_error, out=error)
+        # The covariances add up, whether adding or subtracting
+        if other.covqu is not None:
+            if self.covqu is None:
+                self.covqu = other.covqu
+            else:
+                self.covqu += other.covqu
+        self._filled[_STOKES_DEPENDENT] = False
+        return self
+
+    def _divide_stokes(self, other):
+        """ In-place division of the Stokes parameters by those of `other` """
+        self._check_stokes(other)
+        self._own_data()
+        covqu, other_covqu = self.covqu, other.covqu
+        if covqu is not None or other_covqu is not None:
+            # cov(qa/qb, ua/ub) = (cov_a + qa/qb * ua/ub * cov_b) / (qb * ub)
+            product = other.q * other.u
+            ratios = (self.q / other.q) * (self.u / other.u)
+        for x, dx in (('q', 'dq'), ('u', 'du')):
+            values, other_values = getattr(self, x), getattr(other, x)
+            np.divide(values, other_values, out=values)
+
+            # d(a/b) = sqrt(da**2 + (a/b * db)**2) / |b|
+            error, other_error = getattr(self, dx), getattr(other, dx)
+            if error is None and other_error is None:
+                continue
+            if other_error is not None:
+                scaled = values * other_error
+                if error is None:
+                    setattr(self, dx, scaled)
+                    error = getattr(self, dx)
+                    np.abs(error, out=error)
+                else:
+                    np.hypot(error, scaled, out=error)
+            np.divide(error, other_values, out=error)
+            np.abs(error, out=error)
+        if other_covqu is not None:
+            ratios *= other_covqu
+            if covqu is not None:
+                ratios += covqu
+            self.covqu = ratios
+        if self.covqu is not None:
+            np.divide(self.covqu, product, out=self.covqu)
+        self._filled[_STOKES_DEPENDENT] = False
+        return self
+
+    def _set_column(self, index, value):
+        """ Copies `value` in the data block or clears the column if `value` is None """
+        if value is None:
+            self._filled[index] = False
+            return
+
+        value = np.asarray(value, dtype=self.dtype)
+        if self._data is None or not self._filled.any():
+            # The first column filled sets the number of pixels
+            self._empty_block([COLUMNS[index]], value.size)
+        elif value.ndim != 0 and value.shape != (self._data.shape[1],):
+            raise ValueError("Column '{0}' has {1} values but the PolData object has {2} pixels"
+                             .format(COLUMNS[index], value.size, self._data.shape[1]))
+        else:
+            self._own_data()
+            self._add_rows([index])
+        self._data[self._rows[index]] = value
+        self._filled[index] = True
+        if index in _STOKES_INDICES:
+            # The cached p, dp, pa and dpa no longer match
+            self._filled[_DERIVED_INDICES] = False
+
+    def _empty_block(self, names, n_pixels):
+        """ Replaces all the data with an uninitialised block of the columns `names` (filled) """
+        self._filled = np.zeros(len(COLUMNS), dtype=bool)
+        self._filled[[_COLUMN_INDEX[name] for name in names]] = True
+        self._rows = _rows_of(self._filled)
+        self._data = np.empty((len(names), n_pixels), dtype=self.dtype)
+
+    def _compact_data(self, copy=False):
+        """ Block of the filled columns only, see `_compact_block` """
+        return _compact_block(self._data, self._rows, self._filled, copy=copy)
+
+    def _add_rows(self, indices):
+        """ Makes sure the columns `indices` have a row in the block, see `_add_block_rows` """
+        self._data = _add_block_rows(self._data, self._rows, self._filled, indices)
+
+    def _own_data(self):
+        """
+        Copies the data block if it is read-only: a block shared with another PolData object
+        (see `select_wl`) or a read-only memory map is copied before it is modified.
+        """
+        if not self._data.flags.writeable:
+            self._data = np.array(self._data)
+
+    def _calc_derived(self, index):
+        """ Calculates and caches the derived columns, returns column `index` (or None) """
+        if self.q is None or self.u is None:
+            return None
+        q, u, dq, du, covqu = self.q, self.u, self.dq, self.du, self.covqu
+        writeable = self._data.flags.writeable
+
+        if dq is None or du is None:
+            # Without errors only p and pa can be calculated
+            if index == _COLUMN_INDEX['p']:
+                values = {index: _pol_deg(q, u)}
+            elif index == _COLUMN_INDEX['pa']:
+                values = {index: _pol_ang(q, u)}
+            else:
+                return None
+        elif writeable:
+            self.calc_pol()
+            return self._data[self._rows[index]]
+        else:
+            values = dict(zip(_DERIVED_INDICES, calc_p_and_pa(q, u, dq, du, covqu=covqu)))
+
+        if not writeable:
+            # e.g. memory mapped read-only: calculated at every access
+            return values[index]
+        self._add_rows([index])
+        self._data[self._rows[index]] = values[index]
+        self._filled[index] = True
+        return self._data[self._rows[index]]
+
+    def _set_columns(self, columns):
+        """ Replaces all the data with `columns`, a dictionary of column name: array """
+        n_pixels = set(len(values) for values in columns.values())
+        if len(n_pixels) > 1:
+            raise ValueError("The columns do not all have the same length.")
+
+        self._empty_block(list(columns), n_pixels.pop() if n_pixels else 0)
+        for name, values in columns.items():
+            self._data[self._rows[_COLUMN_INDEX[name]]] = values
+
+    @instrumented('load_file', count=lambda args, result: len(args[0]))
     def load_file(self, filename, force=False, **kwargs):
 
     # TODO: check the file exists and create test for the case in which it doesn't
@@ -44,9 +715,12 @@ class PolData(object):
 
         Notes
         ------
-        1) Accepts same **kwargs as pandas.read_csv()
+        1) Accepts same **kwargs as pandas.read_csv(). Only the accepted columns are read, in
+        the precision of the object (see `dtype`), with the fastest pandas engine available
+        (pyarrow for large files if installed).
 
         2) The column names are what the function uses to fill things in the right place.
+        Missing columns are reported through the `pyspecpol.misc` logger, not printed.
 
         Accepted column names:
            wl = Wavelength
@@ -59,6 +733,9 @@ class PolData(object):
            du = Error on Stokes u
            pa = Polarisation Angle
            dpa = Error on P.A.
+           nq, dnq, nu, dnu, hwp_chi2, hwp_flux_dev = Beam reduction diagnostics
+                                                     (see `reduction.beams_to_stokes`)
+           covqu = Covariance of Stokes q and u
 
         Parameters
         ----------
@@ -75,103 +752,251 @@ class PolData(object):
 
         """
 
-        print("Accepted column names: \n "
-              "wl = Wavelength / time = time / p = Degree or polarisation / dp = Error on p / "
-              "q =  Stokes q / dq =  Error on Stokes q / u =  Stokes u / du = Error on Stokes u /"
-              "pa = Polarisation Angle / dpa = Error on P.A.\n"
-              "The column names are case sensitive.")
-
-
-        # Here I am checking whether some attributes have already been filled.
-        try:
-            # If all attributes are False then they should sum to 0
-            if sum(self.__dict__.values()) != 0 and not force:
-                return "Some attributes already contain values and loading data from a file may " \
-                       "overwrite them. If you're sure you want to do this set force=True."
-
-        # If some attributes filled with arrays the sum is undefined, but we still don't
-        # want to overwrite, so there is an exception for ValueErrors and a check for `force`
-        except ValueError:
-            if not force:
-                return "Some attributes already contain values and loading data from a file may " \
-                       "overwrite them. If you're sure you want to do this set force=True."
-            if force:
-                pass
+        # Here I am checking whether some columns have already been filled.
+        if self._filled.any() and not force:
+            return "Some attributes already contain values and loading data from a file may " \
+                   "overwrite them. If you're sure you want to do this set force=True."
 
         # If the code has gotten this far we actually start loading the file.
+        self._set_columns(_read_csv_columns(filename, dtype=self.dtype, **kwargs))
 
-        # Reading csv with pandas
-        temp_df = pd.read_csv(filename, **kwargs)
+        return "Data successfully loaded form "+filename
 
-        # Not all files wil contain data for all attributes, so need exceptions.
+    def save_csv(self, filename, **kwargs):
+        """
+        Saves the filled columns to a CSV file that can be read back by `load_file`.
 
-        # WAVELENGTH
-        try:
-            self.wl = temp_df.wl.values
-        except AttributeError:
-            print("Column 'wl' not found. Ignore this if you don't have a wavelength dimension, "
-                  "otherwise check your file has the right column format.")
+        Parameters
+        ----------
+        filename : str
+            path to the file to write
+        kwargs : optional
+            Keyword arguments to parse to pandas.DataFrame.to_csv(). E.g. sep='\t'
 
-        # TIME
-        try:
-            self.time = temp_df.time.values
-        except AttributeError:
-            print("Column 'time' not found. Ignore this if you don't have a time dimension, "
-                  "otherwise check your file has the right column format. ")
+        Returns
+        -------
 
-        # DEGREE OF POLARISATION
-        try:
-            self.p = temp_df.p.values
-        except AttributeError:
-            print("Column 'p' not found. Ignore this if you don't have a p value, "
-                  "otherwise check your file has the right column format. ")
-        try:
-            self.dp = temp_df.dp.values
-        except AttributeError:
-            print("Column 'dp' not found. Ignore this if you don't have a dp value, "
-                  "otherwise check your file has the right column format. ")
-
-        # STOKES Q
-        try:
-            self.q = temp_df.q.values
-        except AttributeError:
-            print("Column 'q' not found. Ignore this if you don't have a Stokes q value, "
-                  "otherwise check your file has the right column format. ")
-        try:
-            self.dq = temp_df.dq.values
-        except AttributeError:
-            print("Column 'dq' not found. Ignore this if you don't have an error on Stokes q value,"
-                  " otherwise check your file has the right column format. ")
-
-        # STOKES U
-        try:
-            self.u = temp_df.u.values
-        except AttributeError:
-            print("Column 'u' not found. Ignore this if you don't have a Stokes u value, "
-                  "otherwise check your file has the right column format. ")
-        try:
-            self.du = temp_df.du.values
-        except AttributeError:
-            print("Column 'du' not found. Ignore this if you don't have an error on Stokes u, "
-                  "otherwise check your file has the right column format. ")
-
-        # POLARISATION ANGLE
-        try:
-            self.pa = temp_df.pa.values
-        except AttributeError:
-            print("Column 'pa' not found. Ignore this if you don't have a polarisation angle value,"
-                  " otherwise check your file has the right column format. ")
-        try:
-            self.dpa = temp_df.dpa.values
-        except AttributeError:
-            print("Column 'dpa' not found. Ignore this if you don't have an error on "
-                  "the polarisation angle, otherwise check your file has the right column format. ")
+        """
+        if self._data is None:
+            raise ValueError("There is no data to save.")
+        frame = pd.DataFrame(self._compact_data().T, columns=self.columns)
+        frame.to_csv(filename, index=False, **kwargs)
+
+    def save_binary(self, filename):
+        """
+        Saves the data in the pyspecpol binary format, which can be memory mapped by `load_binary`.
+
+        Notes
+        -----
+        The file contains a header followed by one page-aligned block per column.
+
+        Parameters
+        ----------
+        filename : str
+            path to the file to write (conventionally with a .pspol extension)
+
+        Returns
+        -------
+
+        """
+        if self._data is None:
+            raise ValueError("There is no data to save.")
+        _write_binary(filename, self._data, self._filled, self._rows)
+
+    def load_binary(self, filename, force=False, mmap_mode='c'):
+        """
+        Loads data from a pyspecpol binary file (see `save_binary`) by memory mapping it.
+
+        Notes
+        -----
+        Opening the file only reads the header: the columns are read from disk when (and where)
+        they are accessed, e.g. only the selected range after `select_wl`.
+
+        Parameters
+        ----------
+        filename : str
+            path to the file to load data from
+        force : bool, optional
+            Whether to force laoding the data even if it might overwrite already defined attributes.
+            Default is False.
+        mmap_mode : str, optional
+            Mode of the numpy.memmap: 'c' (default, copy on write, changes are not written to the
+            file), 'r' (read only) or 'r+' (changes are written to the file).
+
+        Returns
+        -------
+
+        """
+        if self._filled.any() and not force:
+            return "Some attributes already contain values and loading data from a file may " \
+                   "overwrite them. If you're sure you want to do this set force=True."
+
+        self._data, self._filled = _open_binary(filename, mmap_mode=mmap_mode)
+        self._rows = np.full(len(COLUMNS), -1, dtype=np.intp)
+        self._rows[:len(self._data)] = np.arange(len(self._data))
 
         return "Data successfully loaded form "+filename
 
+    def save_fits(self, filename, overwrite=False):
+        """
+        Saves the filled columns to a FITS file, one image HDU per column (see `fitsio`).
+
+        Parameters
+        ----------
+        filename : str
+            path to the file to write
+        overwrite : bool, optional
+            Whether to overwrite an existing file. Default is False.
+
+        Returns
+        -------
+
+        """
+        from .fitsio import write_fits
+        write_fits(self, filename, overwrite=overwrite)
+
+    def load_fits(self, filename, force=False, columns=None, extnames=None):
+        """
+        Loads data from a FITS file (see `fitsio.read_fits`).
+
+        Notes
+        -----
+        The file is memory mapped: only the HDUs of the selected columns are read. Linear
+        wavelengths are taken from the WCS keywords of the header.
+
+        Parameters
+        ----------
+        filename : str
+            path to the file to load data from
+        force : bool, optional
+            Whether to force laoding the data even if it might overwrite already defined attributes.
+            Default is False.
+        columns : list of str, optional
+            Columns to read. Default is all the columns in the file.
+        extnames : dict, optional
+            column name: EXTNAME of the HDUs when they are not named after the columns,
+            e.g. {'q': 'STOKES_Q'}
+
+        Returns
+        -------
+
+        """
+        if self._filled.any() and not force:
+            return "Some attributes already contain values and loading data from a file may " \
+                   "overwrite them. If you're sure you want to do this set force=True."
+
+        from .fitsio import read_fits
+        poldata = read_fits(filename, columns=columns, extnames=extnames, dtype=self.dtype)
+        self._data, self._rows, self._filled = poldata._data, poldata._rows, poldata._filled
+
+        return "Data successfully loaded form "+filename
+
+    def calc_pol(self, debiased=True, method='wang'):
+        """
+        Fills p, dp, pa and dpa from the Stokes parameters and their errors (see `calc_p_and_pa`),
+        with the q-u covariance if the covqu column is filled.
+
+        The results are written directly in the data block, no new array is allocated for them.
+
+        Parameters
+        ----------
+        debiased : Bool, optional
+            Default is True. Debiases the degree of polarisation.
+        method : str, optional
+            Debiasing estimator, see `debias_polarisation`. Default is 'wang'.
+
+        Returns
+        -------
+        self
+        """
+        if any(getattr(self, name) is None for name in ('q', 'dq', 'u', 'du')):
+            raise ValueError("q, dq, u and du are needed to calculate the polarisation.")
+
+        indices = [_COLUMN_INDEX[name] for name in ('p', 'dp', 'pa', 'dpa')]
+        self._own_data()
+        self._add_rows(indices)
+        calc_p_and_pa(self.q, self.u, self.dq, self.du, debiased=debiased, method=method,
+                      covqu=self.covqu, out=tuple(self._data[self._rows[index]]
+                                                  for index in indices))
+        self._filled[indices] = True
+        return self
+
+
+### STREAMING LARGE FILES ###
+
+def read_chunks(filename, chunksize=100000, wl_step=None, wl_start=None, dtype=None, **kwargs):
+    """
+    Reads a csv file piece by piece and yields PolData objects, so that files which do not fit
+    in memory can be processed with a constant memory footprint.
+
+    Notes
+    -----
+    1) Accepts same **kwargs as pandas.read_csv() and the same column names as
+    `PolData.load_file`.
+
+    2) By default the chunks have `chunksize` rows. If `wl_step` is given they cover the
+    wavelength ranges [wl_start + k*wl_step, wl_start + (k+1)*wl_step) instead, and the file
+    must be sorted by wavelength.
+
+    Parameters
+    ----------
+    filename : str
+        path to the file to load data from
+    chunksize : int, optional
+        Number of rows per chunk (number of rows read at a time if `wl_step` is given).
+        Default is 100000.
+    wl_step : float, optional
+        Width of the wavelength ranges.
+    wl_start : float, optional
+        Start of the first wavelength range. Default is the first wavelength of the file.
+    dtype : str or numpy.dtype, optional
+        Precision of the chunks, 'float32' or 'float64'. Default is the current precision (see
+        `precision.set_precision`).
+    kwargs : optional
+        Keyword arguments to parse to pandas.read_csv(). E.g. sep='\t'
+
+    Returns
+    -------
+    Generator of PolData objects
+    """
+    dtype = _float_dtype(dtype)
+    chunks = _iter_csv_columns(filename, chunksize, dtype=dtype, **kwargs)
+    if wl_step is not None:
+        chunks = _split_columns_by_wl(chunks, wl_step, wl_start=wl_start)
+
+    for columns in chunks:
+        poldata = PolData(dtype=dtype)
+        poldata._set_columns(columns)
+        yield poldata
+
+
+def calc_pol_chunks(chunks, debiased=True, method='wang'):
+    """
+    Generator stage filling p, dp, pa and dpa of each PolData chunk (see `PolData.calc_pol`).
+
+    E.g.: for chunk in calc_pol_chunks(read_chunks('night.csv')): ...
+
+    Parameters
+    ----------
+    chunks : iterable of PolData
+        e.g. the output of `read_chunks`
+    debiased : Bool, optional
+        Default is True. Debiases the degree of polarisation.
+    method : str, optional
+        Debiasing estimator, see `debias_polarisation`. Default is 'wang'.
+
+    Returns
+    -------
+    Generator of PolData objects
+    """
+    for chunk in chunks:
+        yield chunk.calc_pol(debiased=debiased, method=method)
+
 
 ### CALCULATING THE DEGREE OF POLARISATION P ###
-def calc_p(q, u, dq=None, du=None, debiased=True):
+@instrumented('calc_p')
+def calc_p(q, u, dq=None, du=None, debiased=True, n_draws=None, seed=None, covqu=None,
+           n_jobs=1):
     """
     Calculates the degree of polarisation
 
@@ -196,19 +1021,33 @@ def calc_p(q, u, dq=None, du=None, debiased=True):
     debiased : Bool, optional
         Default is True. Debiases the degree of polarisation for the bias
         using a heavy side function
+    n_draws : int, optional
+        If given, the error is estimated by Monte Carlo with this many draws of q and u (half
+        the width of the central 68% interval, see `mc_p_and_pa`) instead of to first order.
+    seed : int, optional
+        Seed of the Monte Carlo draws.
+    covqu : numpy.ndarray, float or int, optional
+        Covariance of q and u. Default is none (independent q and u).
+    n_jobs : int, optional
+        Number of processes for the Monte Carlo draws (see `mc_p_and_pa`). Default is 1.
 
     Returns
     -------
     Degree of polarisation -- if no errors given
     Tuple(Degree of polarisation, Error(s) on the degree of polarisation) -- if errors given
 
-    Scalars or arrays are returned depending on the input type.
+    Scalars or arrays are returned depending on the input type, in the precision of the input
+    arrays (see `precision`).
 
     """
 
     # Checks whether these parameters are lists and warns that calculations may fail
     _warn_if_list([q, u, dq, du])
 
+    if _is_dask(q) and n_draws is None:
+        from . import daskdata
+        return daskdata.calc_p(q, u, dq, du, debiased=debiased, covqu=covqu)
+
     if dq is None and du is None:
         # if no errors are given just calculate a raw degree of polarisation
         return _pol_deg(q,u)
@@ -224,7 +1063,10 @@ def calc_p(q, u, dq=None, du=None, debiased=True):
         # not the point
         # assert type(q) == type(dq) == type(u) == type(du), "Types of parsed data should be the same."
 
-        p, dp = _pol_deg_and_err(q,u, dq, du)
+        p, dp = _pol_deg_and_err(q,u, dq, du, covqu)
+        if n_draws is not None:
+            dp = _mc_half_width(mc_p_and_pa(q, u, dq, du, covqu=covqu, n_draws=n_draws,
+                                            seed=seed, n_jobs=n_jobs)[0])
         if debiased:
             p_debiased = debias_polarisation(p, dp)
             return p_debiased, dp
@@ -233,47 +1075,115 @@ def calc_p(q, u, dq=None, du=None, debiased=True):
             return p, dp
 
 
-def debias_polarisation(p, dp):
+@instrumented('debias')
+def debias_polarisation(p, dp, method='wang', out=None):
     """
     Function for debiasing polarisation
 
+    Notes
+    -----
+    Available estimators (`method`):
+       'wang' = Step function: p - dp**2/p where p > dp, p otherwise.
+                (See: Polarimetry of the Type IA Supernova SN 1996X -- Wang et al. (1997) -- Eq. 3)
+       'wardle-kronberg' = sqrt(p**2 - dp**2) where p > dp, 0 otherwise.
+                (See: Wardle & Kronberg (1974))
+       'mas' = Modified ASymptotic estimator: p - dp**2 * (1 - exp(-p**2/dp**2)) / (2p)
+                (See: Plaszczynski et al. (2014) -- Eq. 37)
+
+    The estimators work element-wise on arrays of any shape (p and dp are broadcast together).
+
     Parameters
     ----------
     p : int, float or numpy.ndarray
         Degree of polarisation
     dp : int, float or numpy.ndarray
         Errors on the degree of polarisation
+    method : str, optional
+        Which estimator to use. Default is 'wang'.
+    out : numpy.ndarray, optional
+        Array in which to write the result. Must have the broadcast shape of p and dp.
+        It can be `p` itself to debias in place.
 
     Returns
     -------
-    Debiased degree of polarisation (int, float or numpy.ndarray)
+    Debiased degree of polarisation (float or numpy.ndarray)
 
     """
-
-    # The intention is good but this will fail if a float and an int are parsed and that's a pblm
-    # assert type(p) == type(dp), "Polarisation and polarisation error parameters are " \
-    #                              "not the same type"
-
-    # Asking for forgiveness not permission. In most cases I expect this opperation will
-    # be performed on lists or arrays of values. If single values are given a TypeError will
-    # be risen and caught by the except.
-
     try:
-        # List comprehension to replace the list or array of polarisation degree values
-        # by the debiased polarisation degree.
-
-        # Pseudo code of the list comprehension:
-        # --> For a given value p, if it is greater than its associated error, then:
-        # debiased_ p = p - (p_error**2 / p)
-        # (See: Polarimetry of the Type IA Supernova SN 1996X -- Wang et al. (1997) -- Eq. 3)
-
-        p = [p[i] - (dp[i]**2)/p[i] if p[i] - dp[i] > 0 else p[i] for i in range(len(p))]
-
-    except TypeError:
-        # Same logic as discribed above but for a single value.
-        if p - dp > 0: p -= (dp**2)/p
-
-    return p
+        estimator = _DEBIAS_ESTIMATORS[method]
+    except KeyError:
+        raise ValueError("Unknown debiasing method '{0}'. Choose from: {1}"
+                         .format(method, ", ".join(sorted(_DEBIAS_ESTIMATORS))))
+
+    if _is_dask(p) and out is None:
+        from . import daskdata
+        return daskdata.debias_polarisation(p, dp, method=method)
+
+    dtype = _result_dtype(p, dp)
+    p = np.asarray(p, dtype=dtype)
+    dp = np.asarray(dp, dtype=dtype)
+
+    if out is None:
+        out = np.empty(np.broadcast(p, dp).shape, dtype=dtype)
+        scalar_input = out.ndim == 0
+    else:
+        scalar_input = False
+
+    # The estimators divide by p and dp everywhere and then mask the undefined pixels,
+    # hence the local errstate.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        estimator(p, dp, out)
+
+    if scalar_input:
+        return out[()]
+    return out
+
+
+def _debias_wang(p, dp, out):
+    """ Step function debiasing of Wang et al. (1997). Writes in `out`, which may alias p or dp."""
+    mask = p > dp
+    # A single temporary holds the correction dp**2/p, computed before `out` is written to
+    # so that `out` can be `p` or `dp`. The correction is computed for all pixels (masked ufuncs
+    # are much slower than a full pass) and then zeroed for the pixels below their error.
+    correction = np.square(dp, out=np.empty(out.shape, dtype=out.dtype))
+    correction /= p
+    np.copyto(correction, 0., where=~mask)
+    np.subtract(p, correction, out=out)
+    return out
+
+
+def _debias_wardle_kronberg(p, dp, out):
+    """ Wardle & Kronberg (1974) debiasing. Writes in `out`, which may alias p or dp."""
+    mask = p > dp
+    temp = np.square(p, out=np.empty(out.shape, dtype=out.dtype))
+    temp -= np.square(dp)
+    np.sqrt(temp, out=out)
+    np.copyto(out, 0., where=~mask)
+    return out
+
+
+def _debias_mas(p, dp, out):
+    """ Modified ASymptotic estimator of Plaszczynski et al. (2014). `out` may alias p or dp."""
+    dp2 = np.square(dp, out=np.empty(out.shape, dtype=out.dtype))
+    # exponent -p**2/dp**2 -> -inf if dp = 0, in which case no correction is applied.
+    temp = np.square(p, out=np.empty(out.shape, dtype=out.dtype))
+    temp /= dp2
+    np.copyto(temp, np.inf, where=dp2 == 0)
+    np.negative(temp, out=temp)
+    np.expm1(temp, out=temp)
+    # dp**2 * (1 - exp(-p**2/dp**2)) / (2p); when p = 0 the limit of the correction is 0
+    temp *= dp2
+    temp /= p
+    np.copyto(temp, 0., where=p == 0)
+    temp *= 0.5
+    # temp holds -correction at this point
+    np.add(p, temp, out=out)
+    return out
+
+
+_DEBIAS_ESTIMATORS = {'wang': _debias_wang,
+                      'wardle-kronberg': _debias_wardle_kronberg,
+                      'mas': _debias_mas}
 
 
 def _pol_deg(q, u):
@@ -281,82 +1191,241 @@ def _pol_deg(q, u):
     return np.sqrt(q * q + u * u)
 
 
-def _pol_deg_and_err(q, u, dq, du):
-    """ Adds Stokes parameters in quadrature and propagates errors"""
+def _pol_deg_and_err(q, u, dq, du, covqu=None):
+    """ Adds Stokes parameters in quadrature and propagates errors (and the q-u covariance)"""
     p = _pol_deg(q,u)
-    dp = (1 / p) * np.sqrt((q * dq) ** 2 + (u * du) ** 2)
+    variance = (q * dq) ** 2 + (u * du) ** 2
+    if covqu is not None:
+        # Clipped at 0 against rounding errors when q and u are almost fully correlated
+        variance = np.maximum(variance + 2 * q * u * covqu, 0.)
+    dp = (1 / p) * np.sqrt(variance)
     return p, dp
 
 ####### Calculating the Polarisation Angle (P.A.)  #####
-def calc_pa(q, u, dq=None, du=None):
+def calc_pa(q, u, dq=None, du=None, n_draws=None, seed=None, covqu=None, n_jobs=1):
+    """
+    Calculates the polarisation angle in degrees (range 0 to 180)
+
+    Parameters
+    ----------
+    q : numpy.ndarray, float or int
+        Stokes parameters q
+    u : numpy.ndarray, float or int
+        Stokes parameters u
+    dq : numpy.ndarray, float or int, optional
+        Error(s) on Stokes q
+    du : numpy.ndarray, float or int, optional
+        Error(s) on Stokes u
+    n_draws : int, optional
+        If given, the error is estimated by Monte Carlo with this many draws of q and u (half
+        the width of the central 68% interval, see `mc_p_and_pa`) instead of to first order.
+    seed : int, optional
+        Seed of the Monte Carlo draws.
+    covqu : numpy.ndarray, float or int, optional
+        Covariance of q and u. Default is none (independent q and u).
+    n_jobs : int, optional
+        Number of processes for the Monte Carlo draws (see `mc_p_and_pa`). Default is 1.
+
+    Returns
+    -------
+    Polarisation angle -- if no errors given
+    Tuple(Polarisation angle, Error(s) on the polarisation angle) -- if errors given
+
+    """
     # Checks whether these parameters are lists and warns that calculations may fail
     _warn_if_list([q, u, dq, du])
 
+    if _is_dask(q) and n_draws is None:
+        from . import daskdata
+        return daskdata.calc_pa(q, u, dq, du, covqu=covqu)
+
     if dq is None and du is None:
-        # if no errors are given just calculate a raw degree of polarisation
-        return _pol_deg(q,u)
+        # if no errors are given just calculate the angle
+        return _pol_ang(q, u)
 
     elif (dq is not None and du is None) or (du is not None and dq is None):
-        # if errors are missing give warning and return raw degree of pol
-        warnings.warn('It seems one set of error is missing (either for q or u)\nOnly p will be '
-                      + 'returned without being debiased. If this is unexpected check your input.')
-        return _pol_deg(q,u)
+        # if errors are missing give warning and return the angle alone
+        warnings.warn('It seems one set of error is missing (either for q or u)\nOnly P.A. will be '
+                      + 'returned without its error. If this is unexpected check your input.')
+        return _pol_ang(q, u)
 
     elif dq is not None and du is not None:
-        # The intention is good but this will fail if a float and an int are parsed an that's
-        # not the point
-        # assert type(q) == type(dq) == type(u) == type(du), "Types of parsed data should be the same."
+        if n_draws is not None:
+            pa_percentiles = mc_p_and_pa(q, u, dq, du, covqu=covqu, n_draws=n_draws,
+                                         seed=seed, n_jobs=n_jobs)[1]
+            return _pol_ang(q, u), _mc_half_width(pa_percentiles)
+        return _pol_ang_and_err(q, u, dq, du, covqu)
 
-        p, dp = _pol_deg_and_err(q,u, dq, du)
 
+def _mc_half_width(percentiles):
+    """ Half the width of the +/- 1 sigma interval from `mc_p_and_pa` percentiles """
+    half_width = 0.5 * (percentiles[-1] - percentiles[0])
+    return half_width[()] if half_width.ndim == 0 else half_width
 
-def _pol_ang(q, u):
-    pa = 0.5*(np.arctan2(u, q))
 
-    # I want a range from 0 to 2 pi
-    try:
-        pa = np.array([angle if angle >= 0 else angle + np.pi for angle in pa])
-    except TypeError:
-        if pa < 0: pa += np.pi
+@instrumented('p_and_pa')
+def calc_p_and_pa(q, u, dq, du, debiased=True, method='wang', out=None, covqu=None):
+    """
+    Calculates the degree of polarisation, the polarisation angle and their errors in one go.
 
-    return pa*180/np.pi # returns the polarisation angle in degrees
+    Notes
+    -----
+    1) This gives the same results as `calc_p` and `calc_pa` but the intermediate
+    products (q*dq, u*du, ...) are shared and written directly in the output arrays,
+    so it is the function to use in reduction loops.
 
+    2) The `out` arrays must not overlap with the inputs.
 
-def _pol_ang_and_err(q, u, dq, du):
-    _warn_if_list([q, u, dq, du])
+    3) With the q-u covariance c, the variances are (q**2 dq**2 + u**2 du**2 + 2 q u c) / p**2
+    for p and (u**2 dq**2 + q**2 du**2 - 2 q u c) / (4 p**4) for the P.A. (in radians).
+    Without `covqu` nothing more is computed.
 
-    # #### Calculating the POL. ANGLE.
-    pa = _pol_ang(q,u)
+    Parameters
+    ----------
+    q : numpy.ndarray, float or int
+        Stokes parameters q
+    u : numpy.ndarray, float or int
+        Stokes parameters u
+    dq : numpy.ndarray, float or int
+        Error(s) on Stokes q
+    du : numpy.ndarray, float or int
+        Error(s) on Stokes u
+    debiased : Bool, optional
+        Default is True. Debiases the degree of polarisation.
+    method : str, optional
+        Debiasing estimator, see `debias_polarisation`. Default is 'wang'.
+    out : tuple of 4 numpy.ndarray, optional
+        Arrays in which to write p, dp, pa and dpa. They must have the broadcast shape
+        of the inputs.
+    covqu : numpy.ndarray, float or int, optional
+        Covariance of q and u. Default is none (independent q and u).
 
-    # #### Calculating the ERRORS on the Pol. Angle
+    Returns
+    -------
+    Tuple(p, dp, pa, dpa) -- angles in degrees.
 
-    # The line below to ignore the runtime warnings that occur when I get Nan values in the errors.
-    # This occurs if q and u are both 0 , later we change the nan error values to be 90 degrees
-    # so the full plus minus uncertainty covers the full 180 degree range that P.A. can have
-    # since P.A. is technically not defined for q = u = 0
-    np.seterr(divide='ignore', invalid='ignore')
+    """
+    _warn_if_list([q, u, dq, du])
 
-    # This try/except catches the division by zero occurring when scalar inouts q = u = 0 are given
-    try:
-        # error formula from propagation of uncertainty neglecting the qu covariance and
-        # converting to degrees
-        dpa =  ( 0.5*np.sqrt( ((u*dq)**2 + (q*du)**2) / (q**2+u**2)**2) ) * 180 / np.pi
-    except ZeroDivisionError as e:
-        print("ZeroDivision Exception Triggered:", e,
-              "-- Returning an error of +/- 90 degrees on P.A.")
-        dpa = 90
-        return pa, dpa
-
-    # This try/except goes through an array and replaces nan values by 90
-    try:
-        dpa = np.array([err if not np.isnan(err) else 90 for err in dpa])
-    except TypeError:
-        # This exception is triggered if can't iterate over dpa, e.g. when input was scalar.
-        if q == 0 and u == 0 : dpa = 90
+    if _is_dask(q) and out is None:
+        from . import daskdata
+        return daskdata.calc_p_and_pa(q, u, dq, du, debiased=debiased, method=method,
+                                      covqu=covqu)
+
+    # float32 inputs give float32 results (see `precision`)
+    dtype = _result_dtype(q, u, dq, du, covqu)
+    q, u = np.asarray(q, dtype=dtype), np.asarray(u, dtype=dtype)
+
+    if out is None:
+        shape = np.broadcast(q, u, dq, du, 0. if covqu is None else covqu).shape
+        out = tuple(np.empty(shape, dtype=dtype) for _ in range(4))
+        scalar_input = len(shape) == 0
+    else:
+        scalar_input = False
+    p, dp, pa, dpa = out
+
+    # A single scratch array and a single mask are needed on top of the output buffers
+    scratch = np.empty(p.shape, dtype=p.dtype)
+    mask = np.empty(p.shape, dtype=bool)
+    if covqu is not None:
+        # 2 q u cov(q, u), added to the variance of p and subtracted from that of the P.A.
+        cross = np.multiply(q, u)
+        cross *= covqu
+        cross *= 2.
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # q**2 + u**2 is shared by p and the error on the P.A.
+        np.multiply(q, q, out=p)
+        np.multiply(u, u, out=scratch)
+        p += scratch
+
+        # ERROR ON P.A.: 0.5 * sqrt((u*dq)**2 + (q*du)**2) / (q**2 + u**2) in degrees
+        np.multiply(u, dq, out=dpa)
+        np.multiply(dpa, dpa, out=dpa)
+        np.multiply(q, du, out=scratch)
+        np.multiply(scratch, scratch, out=scratch)
+        dpa += scratch
+        if covqu is not None:
+            dpa -= cross
+            # Clipped at 0 against rounding errors when q and u are almost fully correlated
+            np.maximum(dpa, 0., out=dpa)
+        np.sqrt(dpa, out=dpa)
+        np.divide(dpa, p, out=dpa)
+        dpa *= 90 / np.pi
+        # P.A. undefined when q = u = 0, see _pol_ang_and_err
+        np.isnan(dpa, out=mask)
+        np.copyto(dpa, 90., where=mask)
+
+        # DEGREE OF POLARISATION
+        np.sqrt(p, out=p)
+
+        # ERROR ON P: sqrt((q*dq)**2 + (u*du)**2) / p
+        np.multiply(q, dq, out=dp)
+        np.multiply(dp, dp, out=dp)
+        np.multiply(u, du, out=scratch)
+        np.multiply(scratch, scratch, out=scratch)
+        dp += scratch
+        if covqu is not None:
+            dp += cross
+            np.maximum(dp, 0., out=dp)
+        np.sqrt(dp, out=dp)
+        np.divide(dp, p, out=dp)
+
+        # POLARISATION ANGLE, wrapped into [0, 180)
+        np.arctan2(u, q, out=pa)
+        pa *= 90 / np.pi
+        np.less(pa, 0., out=mask)
+        np.add(pa, 180., out=pa, where=mask)
+
+    if debiased:
+        debias_polarisation(p, dp, method=method, out=p)
+
+    if scalar_input:
+        return p[()], dp[()], pa[()], dpa[()]
+    return p, dp, pa, dpa
+
+
+@instrumented('pa')
+def _pol_ang(q, u):
+    """ Polarisation angle in degrees, in the range [0, 180) -- No errors """
+    # 0.5 * arctan2 is in (-90, 90] degrees. The negative angles are wrapped into the
+    # range [0, 180) in place with a mask, for any shape of input.
+    pa = np.asarray(np.arctan2(u, q))
+    pa *= 90 / np.pi
+    np.add(pa, 180., out=pa, where=np.less(pa, 0.))
+    return pa[()]
+
+
+@instrumented('pa_err')
+def _pol_ang_and_err(q, u, dq, du, covqu=None):
+    """ Polarisation angle and its error in degrees. Broadcasts inputs of any shape. """
+    _warn_if_list([q, u, dq, du])
 
-    return pa, dpa
+    # #### Calculating the POL. ANGLE.
+    pa = _pol_ang(q, u)
 
+    # #### Calculating the ERRORS on the Pol. Angle
 
+    # Error formula from propagation of uncertainty, converted to degrees:
+    # 0.5 * sqrt((u*dq)**2 + (q*du)**2 - 2*q*u*covqu) / (q**2 + u**2)
+    dtype = _result_dtype(q, u, dq, du, covqu)
+    q, u = np.asarray(q, dtype=dtype), np.asarray(u, dtype=dtype)
+    dpa = np.asarray(np.square(u * dq) + np.square(q * du))
+    if covqu is not None:
+        dpa = np.asarray(dpa - 2 * q * u * covqu)
+        # Clipped at 0 against rounding errors when q and u are almost fully correlated
+        np.maximum(dpa, 0., out=dpa)
+    np.sqrt(dpa, out=dpa)
+
+    # When q = u = 0 the P.A. is not defined and the division returns NaN. The NaN errors are
+    # set to 90 degrees so the full plus minus uncertainty covers the 180 degree range P.A. can
+    # have. The errstate is local so the global numpy error settings are left untouched.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(dpa, np.square(q) + np.square(u), out=dpa)
+    dpa *= 90 / np.pi
+    np.copyto(dpa, 90., where=np.isnan(dpa))
+
+    return pa, dpa[()]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,146 @@
+"""
+Monte Carlo error propagation for the degree and angle of polarisation.
+
+First order error propagation (`_pol_deg_and_err`, `_pol_ang_and_err`) is biased at low S/N.
+Here realisations of (q, u) are drawn from (correlated) normal distributions and the
+percentiles of p and P.A. are measured on the draws.
+
+The pixels are processed in chunks sized to stay within a memory budget. Each chunk has its own
+random stream, spawned from the user seed, so the results only depend on the seed and the
+budget -- not on the number of processes.
+"""
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from .precision import _result_dtype
+
+# Percentiles matching +/- 1 sigma of a normal distribution
+ONE_SIGMA_PERCENTILES = (15.865525393145708, 50., 84.13447460685429)
+
+# Default memory budget (bytes) for the draws of one chunk
+_MC_MEMORY = 256 * 2**20
+# Number of (chunk_size, n_draws) single precision arrays alive at the same time in `_mc_chunk`
+_MC_ARRAYS_PER_CHUNK = 3
+
+
+def mc_p_and_pa(q, u, dq, du, covqu=None, n_draws=10000, percentiles=ONE_SIGMA_PERCENTILES,
+                seed=None, max_memory=_MC_MEMORY, n_jobs=1):
+    """
+    Monte Carlo percentiles of the degree of polarisation and of the polarisation angle.
+
+    Notes
+    -----
+    1) q and u are drawn from a bivariate normal distribution centred on the measured values
+    with standard deviations dq and du and covariance covqu (default 0).
+
+    2) The P.A. percentiles are measured relative to the measured angle (differences wrapped
+    into [-90, 90) degrees) so the 0/180 degree wrap does not split the distribution. They can
+    therefore be below 0 or above 180.
+
+    Parameters
+    ----------
+    q, u : numpy.ndarray, float or int
+        Stokes parameters
+    dq, du : numpy.ndarray, float or int
+        Errors on the Stokes parameters
+    covqu : numpy.ndarray, float or int, optional
+        Covariance of q and u. Default is 0.
+    n_draws : int, optional
+        Number of realisations per pixel. Default is 10000.
+    percentiles : sequence of float, optional
+        Percentiles to return. Default is the median and +/- 1 sigma.
+    seed : int, optional
+        Seed of the random streams, for reproducible results.
+    max_memory : int, optional
+        Memory budget in bytes for the draws held at once by each process. Default is 256 MiB.
+    n_jobs : int, optional
+        Number of processes. Default is 1 (no process pool).
+
+    Returns
+    -------
+    Tuple(p percentiles, P.A. percentiles) -- arrays of shape (len(percentiles),) + shape of
+    the broadcast inputs, P.A. in degrees, in the precision of the inputs.
+    """
+    dtype = _result_dtype(q, u, dq, du, covqu)
+    covqu = 0. if covqu is None else covqu
+    arrays = np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in (q, u, dq, du, covqu)])
+    shape = arrays[0].shape
+    flat = [array.ravel() for array in arrays]
+    n_pixels = flat[0].size
+
+    chunk_size = max(1, int(max_memory // (4 * n_draws * _MC_ARRAYS_PER_CHUNK)))
+    bounds = list(range(0, n_pixels, chunk_size)) + [n_pixels]
+    streams = np.random.SeedSequence(seed).spawn(len(bounds) - 1)
+    tasks = [(tuple(x[start:stop] for x in flat), n_draws, tuple(percentiles), stream)
+             for start, stop, stream in zip(bounds[:-1], bounds[1:], streams)]
+
+    if n_jobs == 1 or len(tasks) == 1:
+        results = [_mc_chunk(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(_mc_chunk, tasks))
+
+    p_percentiles = np.concatenate([result[0] for result in results], axis=1)
+    pa_percentiles = np.concatenate([result[1] for result in results], axis=1)
+    out_shape = (len(percentiles),) + shape
+    return p_percentiles.reshape(out_shape).astype(dtype, copy=False), \
+        pa_percentiles.reshape(out_shape).astype(dtype, copy=False)
+
+
+def _mc_chunk(task):
+    """ Draws the realisations of one chunk of pixels and returns the p and P.A. percentiles """
+    (q, u, dq, du, covqu), n_draws, percentiles, stream = task
+    rng = np.random.Generator(np.random.PCG64(stream))
+
+    # Correlated draws: u = u0 + du (rho z1 + sqrt(1 - rho**2) z2). The draws are single
+    # precision (plenty for percentiles) and laid out (pixel, draw) so that the draws of each
+    # pixel are contiguous for the selection of the percentiles.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rho = np.where(dq * du > 0, covqu / (dq * du), 0.)
+    np.clip(rho, -1., 1., out=rho)
+    column = (slice(None), None)
+
+    q_draws = rng.standard_normal((len(q), n_draws), dtype=np.float32)
+    u_draws = rng.standard_normal((len(q), n_draws), dtype=np.float32)
+    # Third and last array of the chunk (see _MC_ARRAYS_PER_CHUNK), reused for p then P.A.
+    work = np.empty_like(q_draws)
+    u_draws *= np.sqrt(1. - rho * rho)[column]
+    np.multiply(q_draws, rho[column], out=work)
+    u_draws += work
+    u_draws *= du[column]
+    u_draws += u[column]
+    q_draws *= dq[column]
+    q_draws += q[column]
+
+    p_draws = np.hypot(q_draws, u_draws, out=work)
+    p_percentiles = _percentiles_in_place(p_draws, percentiles)
+
+    # P.A. of the draws relative to the measured one, wrapped into [-90, 90) degrees
+    pa = np.arctan2(u, q) * (90. / np.pi)
+    pa_draws = np.arctan2(u_draws, q_draws, out=p_draws)
+    pa_draws *= 90. / np.pi
+    pa_draws -= pa[column]
+    pa_draws += 90.
+    np.remainder(pa_draws, 180., out=pa_draws)
+    pa_draws -= 90.
+    pa_percentiles = _percentiles_in_place(pa_draws, percentiles)
+    pa_percentiles += np.remainder(pa, 180.)
+
+    return p_percentiles, pa_percentiles
+
+
+def _percentiles_in_place(draws, percentiles):
+    """
+    Percentiles along the last axis of `draws` (linear interpolation, as numpy.percentile).
+    Only the order statistics needed are selected, in place, so `draws` is scrambled.
+    """
+    n_draws = draws.shape[-1]
+    positions = np.asarray(percentiles, dtype=float) / 100. * (n_draws - 1)
+    lower = np.floor(positions).astype(int)
+    upper = np.minimum(lower + 1, n_draws - 1)
+    draws.partition(np.unique(np.concatenate((lower, upper))), axis=-1)
+
+    fraction = (positions - lower)[:, None]
+    lower_values = draws[:, lower].T.astype(float)
+    upper_values = draws[:, upper].T.astype(float)
+    return lower_values + fraction * (upper_values - lower_values)
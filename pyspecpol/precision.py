@@ -0,0 +1,97 @@
+"""
+Floating point precision of the arrays created by pyspecpol.
+
+By default everything is double precision (float64). In single precision (float32) the data
+take half the memory and the kernels move half the bytes, which is plenty for the S/N of
+spectropolarimetry (a relative precision of 6e-8).
+
+    set_precision('float32')          # for the whole session
+    with use_precision('float32'):    # for a block of code
+        poldata = PolData('night.csv')
+    poldata = PolData(dtype='float32')  # for one object
+
+The policy is:
+
+1) The precision applies to what is created: PolData objects and collections, the data read
+from files (csv, FITS) and arrays made from Python numbers or lists.
+
+2) The kernels (`calc_p`, `calc_p_and_pa`, `debias_polarisation`, binning, resampling, ...)
+work in the precision of the arrays they are given: float32 in, float32 out. The sums over
+many pixels (binning, averages) are accumulated in float64 whatever the precision.
+
+3) In single precision the wavelengths and times stored in a PolData object lose precision too
+(about 5e-4 A at 9000 A, but a few minutes on a MJD): keep float64 when the time column matters.
+Collections and cubes keep their wavelength and time axes in float64.
+"""
+
+import contextlib
+import numpy as np
+
+# Precision of the arrays created by pyspecpol, see `set_precision`
+_PRECISION = np.dtype(np.float64)
+_FLOAT_DTYPES = (np.dtype(np.float32), np.dtype(np.float64))
+
+
+def _float_dtype(dtype=None):
+    """ numpy dtype of `dtype` (float32 or float64), the current precision if None """
+    if dtype is None:
+        return _PRECISION
+    dtype = np.dtype(dtype)
+    if dtype not in _FLOAT_DTYPES:
+        raise ValueError("The precision should be float32 or float64, not {0}.".format(dtype))
+    return dtype
+
+
+def get_precision():
+    """ Precision (numpy dtype) of the arrays created by pyspecpol, see `set_precision` """
+    return _PRECISION
+
+
+def set_precision(dtype):
+    """
+    Sets the precision of the arrays created by pyspecpol (see the module docstring).
+
+    Parameters
+    ----------
+    dtype : str or numpy.dtype
+        'float32' or 'float64' (default of pyspecpol)
+    """
+    global _PRECISION
+    _PRECISION = _float_dtype(dtype)
+
+
+@contextlib.contextmanager
+def use_precision(dtype):
+    """
+    Context manager setting the precision (see `set_precision`) within a block of code.
+
+    Parameters
+    ----------
+    dtype : str or numpy.dtype
+        'float32' or 'float64'
+    """
+    global _PRECISION
+    previous = _PRECISION
+    set_precision(dtype)
+    try:
+        yield
+    finally:
+        _PRECISION = previous
+
+
+def _result_dtype(*values):
+    """
+    Precision of a calculation on `values`: that of the float arrays among them (float64 if
+    they are mixed), or the current precision if there are only numbers, lists or integers.
+    """
+    dtypes = [value.dtype for value in values
+              if getattr(value, 'ndim', 0) > 0 and value.dtype.kind == 'f']
+    if not dtypes:
+        return _PRECISION
+    dtype = np.result_type(*dtypes)
+    return _FLOAT_DTYPES[0] if dtype.itemsize <= 4 else _FLOAT_DTYPES[1]
+
+
+def _as_float(value, dtype=None):
+    """ `value` as a numpy array of `dtype` (default: its own precision, see `_result_dtype`) """
+    return np.asarray(value, dtype=_result_dtype(value) if dtype is None else dtype)
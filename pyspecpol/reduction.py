@@ -0,0 +1,294 @@
+"""
+Reduction of dual beam (ordinary / extraordinary) spectropolarimetry, FORS style.
+
+The ordinary (o) and extraordinary (e) beam fluxes observed at a set of half-wave plate (HWP)
+angles theta_i give the normalised flux differences
+
+    F_i = (o_i - e_i) / (o_i + e_i)
+
+from which (Patat & Romaniello 2006, eq. 5-6)
+
+    q = 2/N sum_i F_i cos(4 theta_i)        u = 2/N sum_i F_i sin(4 theta_i)
+
+q and u are then corrected for the chromatic zero angle of the HWP, by a rotation of
+2 theta_0(wl) in the q, u plane.
+
+The same pass gives the null parameters and diagnostics of the consistency of the HWP angles
+(see `beams_to_stokes`), without reading the fluxes again.
+
+All the functions work on arrays of shape (..., n_hwp, n_wl), so the observation sets of a
+whole night can be reduced in one call by stacking them along the leading axes.
+
+The reduction runs in the precision of the fluxes (float32 or float64, see `precision`): the
+sums over the HWP angles only have a handful of terms, so they do not need a float64
+accumulator.
+"""
+
+import functools
+import numpy as np
+import pandas as pd
+from .misc import PolData
+from .precision import _result_dtype
+
+# HWP angles (degrees) of a standard FORS linear spectropolarimetry sequence
+HWP_ANGLES = (0., 22.5, 45., 67.5)
+
+# Chromatic zero angle tables: (instrument, grism) -> file with columns 'wl' and 'theta0'
+ZERO_ANGLE_TABLES = {}
+
+
+def register_zero_angle_table(instrument, grism, filename):
+    """
+    Registers the chromatic zero angle table of an instrument and grism.
+
+    Parameters
+    ----------
+    instrument, grism : str
+        Names used to look the table up, e.g. 'FORS2', '300V'
+    filename : str
+        CSV file with columns 'wl' (same units as the spectra, increasing) and 'theta0'
+        (zero angle in degrees).
+    """
+    ZERO_ANGLE_TABLES[(instrument, grism)] = filename
+    _load_zero_angle_table.cache_clear()
+
+
+@functools.lru_cache(maxsize=None)
+def _load_zero_angle_table(instrument, grism):
+    """ Reads a registered zero angle table once -- read-only (wl, theta0) arrays """
+    try:
+        filename = ZERO_ANGLE_TABLES[(instrument, grism)]
+    except KeyError:
+        raise KeyError("No zero angle table registered for instrument '{0}' and grism '{1}', "
+                       "see `register_zero_angle_table`.".format(instrument, grism))
+    table = pd.read_csv(filename, usecols=['wl', 'theta0'], dtype=np.float64)
+    wl, theta0 = table['wl'].to_numpy(), table['theta0'].to_numpy()
+    for array in (wl, theta0):
+        array.setflags(write=False)
+    return wl, theta0
+
+
+def zero_angle(wl, instrument, grism):
+    """
+    Chromatic zero angle (degrees) of an instrument and grism, interpolated on `wl`.
+
+    Parameters
+    ----------
+    wl : numpy.ndarray
+        Wavelengths
+    instrument, grism : str
+        Names of a table registered with `register_zero_angle_table`
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    table_wl, table_theta0 = _load_zero_angle_table(instrument, grism)
+    return np.interp(wl, table_wl, table_theta0)
+
+
+def flux_differences(o, e, do=None, de=None):
+    """
+    Normalised flux differences F = (o - e) / (o + e) and their errors.
+
+    Parameters
+    ----------
+    o, e : numpy.ndarray
+        Ordinary and extraordinary beam fluxes
+    do, de : numpy.ndarray, optional
+        Errors on the fluxes. Default is Poisson noise, sqrt(o) and sqrt(e), for fluxes in counts.
+
+    Returns
+    -------
+    Tuple(F, dF) -- numpy.ndarrays
+    """
+    dtype = _result_dtype(o, e, do, de)
+    o = np.asarray(o, dtype=dtype)
+    e = np.asarray(e, dtype=dtype)
+    total = o + e
+    f = (o - e) / total
+
+    # dF/do = 2 e / (o + e)**2 and dF/de = -2 o / (o + e)**2
+    if do is None and de is None:
+        # Poisson noise: var = 4 (e**2 o + o**2 e) / (o + e)**4 = 4 o e / (o + e)**3
+        df = 2 * np.sqrt(o * e / total) / total
+    else:
+        do = np.sqrt(np.abs(o)) if do is None else np.asarray(do, dtype=dtype)
+        de = np.sqrt(np.abs(e)) if de is None else np.asarray(de, dtype=dtype)
+        df = 2 * np.sqrt((e * do) ** 2 + (o * de) ** 2) / (total * total)
+    return f, df
+
+
+def _rotate(q, u, dq, du, covqu, theta0):
+    """ Rotates q and u by 2 theta0 (degrees) in the q, u plane, with their covariance matrix """
+    two_theta0 = np.deg2rad(2 * np.asarray(theta0, dtype=float))
+    # In the precision of q and u, so the rotated arrays keep it
+    cos, sin = np.cos(two_theta0).astype(q.dtype), np.sin(two_theta0).astype(q.dtype)
+    q_rot = q * cos - u * sin
+    u_rot = q * sin + u * cos
+    var_q, var_u = dq * dq, du * du
+    cross = 2 * cos * sin * covqu
+    dq_rot = np.sqrt(np.maximum(cos * cos * var_q + sin * sin * var_u - cross, 0.))
+    du_rot = np.sqrt(np.maximum(sin * sin * var_q + cos * cos * var_u + cross, 0.))
+    covqu_rot = cos * sin * (var_q - var_u) + (cos * cos - sin * sin) * covqu
+    return q_rot, u_rot, dq_rot, du_rot, covqu_rot
+
+
+def beams_to_stokes(o, e, do=None, de=None, hwp_angles=HWP_ANGLES, theta0=None,
+                    diagnostics=False, covariance=False):
+    """
+    Stokes q and u (fractions, not percent) and their errors from o and e beam fluxes.
+
+    Notes
+    -----
+    1) The flux arrays are of shape (..., n_hwp, n_wl), with one row per HWP angle. The
+    leading axes (e.g. one per observation set of a night) are all reduced in one pass.
+
+    2) The sums over the HWP angles are matrix products with the (n, n_hwp) matrix of the
+    weights of q, u (and of the null parameters), so they are all computed together.
+    q and u share the F_i, so they are correlated unless the errors of the F_i are the same at
+    all the angles: covqu = sum_i wq_i wu_i dF_i**2. The zero angle rotation also mixes dq and
+    du, and correlates q and u when dq != du.
+
+    3) The diagnostics (for HWP angles evenly spaced by 22.5 degrees) are:
+        - nq, nu: null parameters 2/N sum_i F_i |cos(4 theta_i)| and the same with sin, which
+          vanish since F(theta + 45) = -F(theta), e.g. nq = (F_0 + F_45) / 2 with 4 angles.
+          Like dq and du, their errors dnq and dnu are propagated from the flux errors.
+        - hwp_chi2: reduced chi-square of the F_i against F = q cos(4 theta) + u sin(4 theta)
+          (NaN with 2 angles or fewer).
+        - hwp_flux_dev: largest relative deviation of the total flux (o + e) at one HWP angle
+          from its mean over the angles, e.g. from changes of transparency or slit losses.
+    They are not corrected for the zero angle.
+
+    Parameters
+    ----------
+    o, e : numpy.ndarray
+        Ordinary and extraordinary beam fluxes, (..., n_hwp, n_wl)
+    do, de : numpy.ndarray, optional
+        Errors on the fluxes. Default is Poisson noise (see `flux_differences`).
+    hwp_angles : sequence of float, optional
+        HWP angles in degrees, one per row. Default is `HWP_ANGLES`.
+    theta0 : float or numpy.ndarray, optional
+        Zero angle of the HWP in degrees (e.g. from `zero_angle`), (n_wl,) or broadcastable to
+        the output. Default is no correction.
+    diagnostics : bool, optional
+        Whether to also return the null parameters and HWP diagnostics. Default is False.
+    covariance : bool, optional
+        Whether to also return the covariance of q and u. Default is False.
+
+    Returns
+    -------
+    Tuple(q, u, dq, du) -- numpy.ndarrays of shape (..., n_wl)
+    Tuple(q, u, dq, du, covqu) -- if covariance is True
+    Tuple(q, u, dq, du[, covqu], diagnostics) -- if diagnostics is True, diagnostics is a
+    dictionary of column name ('nq', 'dnq', 'nu', 'dnu', 'hwp_chi2', 'hwp_flux_dev') to array.
+    """
+    hwp_angles = np.asarray(hwp_angles, dtype=float)
+    n_hwp = len(hwp_angles)
+    dtype = _result_dtype(o, e, do, de)
+    o = np.asarray(o, dtype=dtype)
+    e = np.asarray(e, dtype=dtype)
+    if o.ndim < 2 or o.shape[-2] != n_hwp:
+        raise ValueError("The fluxes should be (..., n_hwp, n_wl) arrays with one row per HWP "
+                         "angle ({0} angles given).".format(n_hwp))
+
+    f, df = flux_differences(o, e, do, de)
+
+    four_theta = np.deg2rad(4 * hwp_angles)
+    basis = np.stack((np.cos(four_theta), np.sin(four_theta)))
+    if diagnostics:
+        basis = np.concatenate((basis, np.abs(basis)))
+    weights = ((2. / n_hwp) * basis).astype(dtype)
+    # (n, n_hwp) @ (..., n_hwp, n_wl) -> (..., n, n_wl)
+    sums = np.matmul(weights, f)
+    variances = df * df
+    errors = np.sqrt(np.matmul(weights * weights, variances))
+    q, u, dq, du = sums[..., 0, :], sums[..., 1, :], errors[..., 0, :], errors[..., 1, :]
+    covqu = np.matmul(weights[0] * weights[1], variances) if covariance or \
+        theta0 is not None else None
+
+    if diagnostics:
+        # Residuals of the F_i from the q, u model: (n_hwp, 2) @ (..., 2, n_wl)
+        residuals = f - np.matmul(basis[:2].T.astype(dtype), sums[..., :2, :])
+        residuals /= df
+        hwp_chi2 = np.sum(residuals * residuals, axis=-2)
+        # q and u use up 2 degrees of freedom
+        hwp_chi2 /= n_hwp - 2 if n_hwp > 2 else np.nan
+
+        total = o + e
+        mean_total = total.mean(axis=-2, keepdims=True)
+        hwp_flux_dev = np.max(np.abs(total - mean_total), axis=-2) / mean_total[..., 0, :]
+
+        diagnostic_columns = {'nq': sums[..., 2, :], 'dnq': errors[..., 2, :],
+                              'nu': sums[..., 3, :], 'dnu': errors[..., 3, :],
+                              'hwp_chi2': hwp_chi2, 'hwp_flux_dev': hwp_flux_dev}
+
+    if theta0 is not None:
+        q, u, dq, du, covqu = _rotate(q, u, dq, du, covqu, theta0)
+    results = (q, u, dq, du) + ((covqu,) if covariance else ())
+    if diagnostics:
+        return results + (diagnostic_columns,)
+    return results
+
+
+def reduce_beams(wl, o, e, do=None, de=None, hwp_angles=HWP_ANGLES, instrument=None,
+                 grism=None, theta0=None, time=None, diagnostics=True):
+    """
+    Reduces o and e beam fluxes at several HWP angles to PolData objects.
+
+    Notes
+    -----
+    The zero angle correction uses `theta0` if given, otherwise the table registered for
+    `instrument` and `grism` (if given). See `beams_to_stokes` for the shapes of the fluxes.
+    The covariance of q and u is stored in the covqu column. The PolData objects have the
+    precision of the fluxes (the current precision for integer counts, see `precision`).
+
+    Parameters
+    ----------
+    wl : numpy.ndarray
+        Wavelengths, (n_wl,)
+    o, e : numpy.ndarray
+        Ordinary and extraordinary beam fluxes, (n_hwp, n_wl) or (n_sets, n_hwp, n_wl)
+    do, de : numpy.ndarray, optional
+        Errors on the fluxes. Default is Poisson noise.
+    hwp_angles : sequence of float, optional
+        HWP angles in degrees. Default is `HWP_ANGLES`.
+    instrument, grism : str, optional
+        Instrument and grism of a registered zero angle table.
+    theta0 : float or numpy.ndarray, optional
+        Zero angle in degrees, instead of a registered table.
+    time : float or sequence of float, optional
+        Time of the observation (set(s)), stored in the time column.
+    diagnostics : bool, optional
+        Whether to fill the null parameter and HWP diagnostic columns (nq, dnq, nu, dnu,
+        hwp_chi2, hwp_flux_dev), see `beams_to_stokes`. Default is True.
+
+    Returns
+    -------
+    PolData for one observation set, list of PolData for (n_sets, n_hwp, n_wl) fluxes.
+    """
+    wl = np.asarray(wl, dtype=float)
+    if theta0 is None and instrument is not None:
+        theta0 = zero_angle(wl, instrument, grism)
+
+    results = beams_to_stokes(o, e, do, de, hwp_angles=hwp_angles, theta0=theta0,
+                              diagnostics=diagnostics, covariance=True)
+    columns = dict(zip(('q', 'u', 'dq', 'du', 'covqu'), results[:5]))
+    if diagnostics:
+        columns.update(results[5])
+
+    single = results[0].ndim == 1
+    columns = dict((name, np.reshape(values, (-1, len(wl)))) for name, values in columns.items())
+    n_sets = len(columns['q'])
+    times = np.broadcast_to(np.nan if time is None else np.asarray(time, dtype=float), n_sets)
+
+    poldatas = []
+    for i in range(n_sets):
+        poldata = PolData(dtype=results[0].dtype)
+        poldata.wl = wl
+        for name, values in columns.items():
+            setattr(poldata, name, values[i])
+        if not np.isnan(times[i]):
+            poldata.time = times[i]
+        poldatas.append(poldata)
+    return poldatas[0] if single else poldatas
@@ -0,0 +1,25 @@
+"""
+Helpers shared by the tests.
+"""
+
+import numpy as np
+import pyspecpol.misc as polmisc
+
+
+def make_poldata(wl=None, q=None, u=None, dq=0.3, du=0.4, n=50, seed=0, time=None, dtype=None):
+    """
+    PolData object for the tests. The wavelengths default to `n` pixels between 4000 and
+    8000 A, q and u to normal draws (seeded by `seed`), and dq and du (scalars or arrays) to
+    uniform draws between 0.1 and 0.3 if None. `time` is the time of all the pixels.
+    """
+    rng = np.random.RandomState(seed)
+    poldata = polmisc.PolData(dtype=dtype)
+    poldata.wl = np.linspace(4000., 8000., n) if wl is None else wl
+    n = len(poldata.wl)
+    poldata.q = rng.normal(0., 1., n) if q is None else q
+    poldata.u = rng.normal(0., 1., n) if u is None else u
+    poldata.dq = rng.uniform(0.1, 0.3, n) if dq is None else np.broadcast_to(dq, (n,))
+    poldata.du = rng.uniform(0.1, 0.3, n) if du is None else np.broadcast_to(du, (n,))
+    if time is not None:
+        poldata.time = np.full(n, time)
+    return poldata
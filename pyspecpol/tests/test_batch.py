@@ -0,0 +1,92 @@
+import pyspecpol.misc as polmisc
+from pyspecpol import batch
+import numpy as np
+import pytest
+import os
+
+
+def write_inputs(tmpdir, n_files=3, n=50):
+    rng = np.random.RandomState(0)
+    for i in range(n_files):
+        poldata = polmisc.PolData()
+        poldata.wl = np.linspace(4000., 8000., n)
+        poldata.q, poldata.u = rng.normal(1., 0.1, n), rng.normal(0., 0.1, n)
+        poldata.dq, poldata.du = np.full(n, 0.1), np.full(n, 0.1)
+        poldata.save_csv(str(tmpdir.join('obs{0}.csv'.format(i))))
+    tmpdir.join('notes.log').write('not data')
+
+
+class TestBatch(object):
+    def test_find_files(self, tmpdir):
+        write_inputs(tmpdir)
+        files = batch.find_files([str(tmpdir), str(tmpdir.join('obs1*'))])
+        assert [f.split('/')[-1] for f in files] == ['obs0.csv', 'obs1.csv', 'obs2.csv']
+
+    @pytest.mark.parametrize('output_format', ['binary', 'csv', 'fits'])
+    def test_run_batch(self, tmpdir, output_format):
+        write_inputs(tmpdir)
+        files = batch.find_files([str(tmpdir)])
+        output_dir = str(tmpdir.join('out'))
+        results = batch.run_batch(files, output_dir, output_format=output_format, n_jobs=2)
+        assert [result[0] for result in results] == files
+        assert all(error is None for _, _, _, error in results)
+
+        reduced = polmisc.PolData()
+        if output_format == 'binary':
+            reduced.load_binary(results[1][1])
+        elif output_format == 'fits':
+            reduced.load_fits(results[1][1])
+        else:
+            reduced.load_file(results[1][1])
+        expected = polmisc.PolData(files[1]).calc_pol()
+        assert np.allclose(reduced.p, expected.p) and np.allclose(reduced.pa, expected.pa)
+
+    def test_output_names(self, tmpdir):
+        for night in ('night1', 'night2'):
+            write_inputs(tmpdir.mkdir(night), n_files=1)
+        polmisc.PolData(str(tmpdir.join('night1', 'obs0.csv'))).save_fits(
+            str(tmpdir.join('night1', 'obs0.fits')))
+        files = batch.find_files([str(tmpdir.join('night1')), str(tmpdir.join('night2'))])
+        output_dir = str(tmpdir.join('out'))
+
+        outputs = batch.output_paths(files, output_dir, 'binary')
+        assert [output[len(output_dir) + 1:] for output in outputs] == \
+            ['night1/obs0_csv_pol.pspol', 'night1/obs0_fits_pol.pspol', 'night2/obs0_pol.pspol']
+        results = batch.run_batch(files, output_dir, n_jobs=2)
+        assert all(error is None for _, _, _, error in results)
+        assert all(os.path.isfile(output) for output in outputs)
+
+        # Outputs written next to the inputs are not taken as inputs by the next run
+        batch.run_batch(files[2:], str(tmpdir.join('night2')), output_format='csv')
+        assert tmpdir.join('night2', 'obs0_pol.csv').check()
+        assert batch.find_files([str(tmpdir.join('night2'))], output_dir=str(tmpdir)) == files[2:]
+
+    def test_isp_and_errors(self, tmpdir):
+        write_inputs(tmpdir, n_files=1)
+        tmpdir.join('broken.csv').write('wl,q\n1,2,3\n')
+        files = batch.find_files([str(tmpdir.join('*.csv'))])
+        results = batch.run_batch(files, str(tmpdir), isp={'p_max': 1., 'wl_max': 5500.,
+                                                           'theta': 0.})
+        assert results[0][3] is not None and results[1][3] is None
+        reduced = polmisc.PolData()
+        reduced.load_binary(results[1][1])
+        assert np.isclose(reduced.q.mean(), 1. - 0.96, atol=0.05)
+
+    def test_main(self, tmpdir, capsys):
+        write_inputs(tmpdir, n_files=2)
+        status = batch.main([str(tmpdir.join('*.csv')), '-o', str(tmpdir), '-j', '1',
+                             '--format', 'csv', '--no-debias'])
+        out = capsys.readouterr().out
+        assert status == 0 and '2 files processed' in out and 'obs0_pol.csv' in out
+        assert tmpdir.join('obs1_pol.csv').check()
+
+    def test_float32(self, tmpdir):
+        write_inputs(tmpdir, n_files=2)
+        output_dir = str(tmpdir.join('out'))
+        assert batch.main([str(tmpdir.join('*.csv')), '-o', output_dir, '-j', '2',
+                           '--float32']) == 0
+        reduced = polmisc.PolData()
+        reduced.load_binary(str(tmpdir.join('out', 'obs0_pol.pspol')))
+        assert reduced.dtype == np.float32
+        expected = polmisc.PolData(str(tmpdir.join('obs0.csv'))).calc_pol()
+        assert np.allclose(reduced.p, expected.p, rtol=1e-5)
@@ -0,0 +1,127 @@
+import pyspecpol.misc as polmisc
+from pyspecpol.collection import PolDataCollection
+from pyspecpol import binning
+import numpy as np
+
+
+class TestRebin(object):
+    def setup_method(self):
+        self.wl = np.arange(4000., 4006.)
+        self.q = np.array([1., 3., 2., 2., 5., 7.])
+        self.u = np.array([0., 2., 1., 1., 1., 1.])
+        self.dq = np.full(6, 0.2)
+        self.du = np.full(6, 0.1)
+
+    def test_rebin_stokes(self):
+        wl, q, u, dq, du = binning.rebin_stokes(self.wl, self.q, self.u, self.dq, self.du,
+                                                bins=2.)
+        assert np.allclose(wl, [4001., 4003., 4005.]), "Bin centres are wrong"
+        assert np.allclose(q, [2., 2., 6.]) and np.allclose(u, [1., 1., 1.])
+        assert np.allclose(dq, 0.2 / np.sqrt(2)) and np.allclose(du, 0.1 / np.sqrt(2)), \
+            "Errors of a mean of 2 pixels should be divided by sqrt(2)"
+
+    def test_rebin_stokes_flux_weighted(self):
+        flux = np.array([1., 3., 1., 1., 1., 1.])
+        wl, q, u, dq, du = binning.rebin_stokes(self.wl, self.q, self.u, self.dq, self.du,
+                                                bins=[4000., 4002., 4010.], flux=flux)
+        assert np.isclose(q[0], (1. + 9.) / 4.), "Flux weighted mean is wrong"
+        assert np.isclose(dq[0], np.sqrt(0.2**2 + 0.6**2) / 4.), "Flux weighted error is wrong"
+        assert np.isclose(q[1], 4.)
+
+    def test_empty_bins(self):
+        wl, q, u, dq, du = binning.rebin_stokes(self.wl, self.q, self.u,
+                                                bins=[3990., 3995., 4002., 4003.5])
+        assert np.isnan(q[0]) and np.isclose(q[1], 2.) and np.isclose(q[2], 2.)
+        assert dq is None and du is None
+
+    def test_rebin_stack_and_objects(self):
+        poldata = polmisc.PolData()
+        poldata.wl, poldata.q, poldata.u, poldata.dq, poldata.du = \
+            self.wl, self.q, self.u, self.dq, self.du
+        binned = binning.rebin(poldata, 3.)
+        assert isinstance(binned, polmisc.PolData) and np.allclose(binned.q, [2., 14. / 3.])
+
+        collection = PolDataCollection.from_poldata([poldata, poldata / 2.], times=[0., 1.])
+        binned = binning.rebin(collection, 3.)
+        assert binned.q.shape == (2, 2)
+        assert np.allclose(binned.q, [[2., 14. / 3.], [1., 7. / 3.]])
+
+    def test_rebin_covariance(self):
+        covqu = np.array([0.01, 0.03, 0.02, -0.02, 0., 0.])
+        flux = np.array([1., 3., 1., 1., 1., 1.])
+        binned = binning.rebin_covariance(self.wl, covqu, [3990., 4000., 4002., 4010.], flux)
+        assert np.isnan(binned[0])
+        assert np.allclose(binned[1:], [(0.01 + 9 * 0.03) / 16., 0.])
+
+        poldata = polmisc.PolData()
+        poldata.wl, poldata.q, poldata.u, poldata.dq, poldata.du = \
+            self.wl, self.q, self.u, self.dq, self.du
+        poldata.covqu = covqu
+        assert np.allclose(binning.rebin(poldata, 2.).covqu, [0.01, 0., 0.])
+
+    def test_velocity_edges(self):
+        edges = binning.velocity_edges(4000., 5000., 1000.)
+        assert edges[0] == 4000. and edges[-1] >= 5000.
+        assert np.allclose(np.diff(edges) / edges[:-1] * binning.C_KMS, 1000.), \
+            "Bins should have a constant velocity width"
+
+
+class TestAdaptiveBinning(object):
+    def setup_method(self):
+        self.wl = np.arange(4000., 4010.)
+        self.q = np.ones(10)
+        self.u = np.zeros(10)
+        self.dq = np.full(10, 0.5)
+        self.du = np.full(10, 0.5)
+
+    def test_adaptive_edges(self):
+        # Each pixel has p/dp = 2: 4 pixels are needed for S/N = 4
+        edges = binning.adaptive_edges(self.wl, self.q, self.u, self.dq, self.du, 4.)
+        assert np.allclose(edges, [3999.5, 4003.5, 4009.5]), \
+            "The last 2 pixels should be merged with the previous bin"
+
+        edges = binning.adaptive_edges(self.wl, self.q, self.u, self.dq, self.du, 4.,
+                                       merge_last=False)
+        assert np.allclose(edges, [3999.5, 4003.5, 4007.5, 4009.5])
+
+        # A target already reached by single pixels gives one bin per pixel
+        edges = binning.adaptive_edges(self.wl, self.q, self.u, self.dq, self.du, 1.)
+        assert len(edges) == 11
+
+    def test_adaptive_edges_varying_noise(self):
+        dq = np.array([0.1, 0.1, 0.5, 0.5, 0.5, 0.5, 0.1, 0.1, 0.1, 0.1])
+        edges = binning.adaptive_edges(self.wl, self.q, self.u, dq, dq, 5.)
+        wl, q, u, dq_bin, du_bin = binning.rebin_stokes(self.wl, self.q, self.u, dq, dq,
+                                                        bins=edges)
+        p, dp = polmisc._pol_deg_and_err(q, u, dq_bin, du_bin)
+        assert np.all(p / dp >= 5.), "All the bins should reach the target S/N"
+        assert np.allclose(edges, [3999.5, 4000.5, 4001.5, 4007.5, 4008.5, 4009.5]), \
+            "The noisy pixels should be grouped with the next clean ones only"
+
+    def test_adaptive_edges_covariance(self):
+        # q = u = 1 with fully correlated errors: p/dp = 2 per pixel, sqrt(8) if uncorrelated
+        u, covqu = np.ones(10), np.full(10, 0.25)
+        edges = binning.adaptive_edges(self.wl, self.q, u, self.dq, self.du, 4.)
+        assert len(edges) == 6
+        edges = binning.adaptive_edges(self.wl, self.q, u, self.dq, self.du, 4., covqu=covqu)
+        assert np.allclose(edges, [3999.5, 4003.5, 4009.5])
+
+        poldata = polmisc.PolData()
+        poldata.wl, poldata.q, poldata.u, poldata.dq, poldata.du, poldata.covqu = \
+            self.wl, self.q, u, self.dq, self.du, covqu
+        assert np.array_equal(binning.adaptive_rebin(poldata, 4.)[1], edges)
+
+    def test_adaptive_rebin_collection(self):
+        poldata = polmisc.PolData()
+        poldata.wl, poldata.q, poldata.u, poldata.dq, poldata.du = \
+            self.wl, self.q, self.u, self.dq, self.du
+        collection = PolDataCollection.from_poldata([poldata, poldata], times=[0., 1.])
+
+        # The mean of 2 epochs has a S/N of 2*sqrt(2) per pixel, so 2 pixels per bin reach 3.5
+        binned, edges = binning.adaptive_rebin(collection, 3.5)
+        assert np.allclose(edges, [3999.5, 4001.5, 4003.5, 4005.5, 4007.5, 4009.5])
+        assert binned.q.shape == (2, 5)
+
+        # Reusing the edges on a single epoch
+        binned_epoch, same_edges = binning.adaptive_rebin(poldata, 3.5, edges=edges)
+        assert same_edges is edges and np.allclose(binned_epoch.q, binned.q[0])
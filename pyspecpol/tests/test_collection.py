@@ -0,0 +1,88 @@
+import pyspecpol.misc as polmisc
+from pyspecpol.collection import PolDataCollection
+import numpy as np
+import pytest
+from pyspecpol.tests.helpers import make_poldata
+
+
+class TestPolDataCollection(object):
+    def setup_method(self):
+        self.wl = np.array([4000., 4010., 4020.])
+        self.epochs = [make_poldata(self.wl, np.array([1., 2., 3.]) * i,
+                                    np.array([1., 1., 1.]) * i, dq=0.1, du=0.2, time=time)
+                       for i, time in zip([1, 2, 3], [20., 10., 30.])]
+
+    def test_from_poldata(self):
+        collection = PolDataCollection.from_poldata(self.epochs)
+
+        assert len(collection) == 3 and collection.q.shape == (3, 3)
+        assert np.array_equal(collection.time, [10., 20., 30.]), "Epochs should be sorted by time"
+        assert np.array_equal(collection.q[0], [2., 4., 6.]), "Epochs stacked in the wrong order"
+        assert collection.columns == ('q', 'dq', 'u', 'du') and collection.p is None
+
+    def test_different_grids(self):
+        other = make_poldata(self.wl + 5, np.ones(3), np.ones(3), dq=0.1, du=0.2, time=40.)
+        with pytest.raises(ValueError):
+            PolDataCollection.from_poldata(self.epochs + [other])
+
+        # Resampling on a common grid
+        collection = PolDataCollection.from_poldata(self.epochs + [other], wl=self.wl)
+        assert np.allclose(collection.q[1], [1., 2., 3.]), "Epochs on the grid should not change"
+        assert np.isnan(collection.q[3, 0]) and np.allclose(collection.q[3, 1:], 1.), \
+            "Resampled values or out of range pixels wrong"
+        assert np.allclose(collection.dq[3, 1:], 0.1 * np.sqrt(0.5)), \
+            "Errors should be resampled by propagating the variance"
+
+    def test_resample(self):
+        collection = PolDataCollection.from_poldata(self.epochs)
+        resampled = collection.resample(self.wl + 5)
+        assert resampled.columns == collection.columns and len(resampled) == 3
+        for i in range(len(collection)):
+            expected = collection.epoch(i).resample(self.wl + 5)
+            assert np.allclose(resampled.q[i], expected.q, equal_nan=True)
+            assert np.allclose(resampled.du[i], expected.du, equal_nan=True)
+
+    def test_calc_pol(self):
+        collection = PolDataCollection.from_poldata(self.epochs).calc_pol()
+
+        for i in range(len(collection)):
+            p, dp, pa, dpa = polmisc.calc_p_and_pa(collection.q[i], collection.u[i],
+                                                   collection.dq[i], collection.du[i])
+            assert np.allclose(collection.p[i], p) and np.allclose(collection.dpa[i], dpa), \
+                "Stacked calculation differs from epoch by epoch"
+
+    def test_only_filled_columns_are_stored(self):
+        import pickle
+        collection = PolDataCollection.from_poldata(self.epochs)
+        assert collection._data.shape == (4, 3, 3), "Rows allocated for the unfilled columns"
+
+        collection.calc_pol()
+        assert collection._data.shape == (8, 3, 3)
+        collection.dq = None
+        for new in (collection.copy(), pickle.loads(pickle.dumps(collection))):
+            assert new._data.shape == (7, 3, 3) and new.columns == collection.columns
+            assert np.array_equal(new.u, collection.u) and np.array_equal(new.pa, collection.pa)
+
+    def test_sort_epochs(self):
+        rng = np.random.RandomState(0)
+        epochs = [make_poldata(self.wl, rng.normal(size=3), rng.normal(size=3), dq=0.1, du=0.2,
+                                time=i)
+                  for i in range(10)]
+        expected = PolDataCollection.from_poldata(epochs)
+        collection = expected.copy()
+        # Several cycles, and fixed points
+        order = np.array([3, 1, 0, 2, 5, 4, 6, 9, 7, 8])
+        collection._sort_epochs(order)
+        assert np.array_equal(collection.time, expected.time[order])
+        assert np.array_equal(collection.q, expected.q[order])
+        assert np.array_equal(collection.du, expected.du[order])
+
+    def test_select_time(self):
+        collection = PolDataCollection.from_poldata(self.epochs)
+        selection = collection.select_time(15., 30.)
+
+        assert np.array_equal(selection.time, [20., 30.])
+        assert np.shares_memory(selection.q, collection.q), "select_time should return a view"
+
+        epoch = selection.epoch(0)
+        assert isinstance(epoch, polmisc.PolData) and np.array_equal(epoch.q, [1., 2., 3.])
@@ -0,0 +1,70 @@
+import pyspecpol.misc as polmisc
+from pyspecpol.cube import PolCube
+import numpy as np
+import pytest
+
+
+def make_cube(ny=5, nx=4, n_wl=30, seed=0):
+    rng = np.random.RandomState(seed)
+    shape = (ny, nx, n_wl)
+    return PolCube(np.linspace(4000., 7000., n_wl), rng.normal(0., 1., shape),
+                   rng.normal(0., 1., shape), rng.uniform(0.1, 0.5, shape),
+                   rng.uniform(0.1, 0.5, shape))
+
+
+class TestPolCube(object):
+    def test_shape_check(self):
+        with pytest.raises(ValueError):
+            PolCube(np.arange(3.), np.zeros((2, 2, 4)), np.zeros((2, 2, 4)))
+
+    def test_save_and_open(self, tmpdir):
+        cube = make_cube()
+        cube.save(str(tmpdir))
+        opened = PolCube.open(str(tmpdir))
+        assert isinstance(opened.q, np.memmap) and opened.shape == cube.shape
+        for name in ('wl', 'q', 'dq', 'u', 'du'):
+            assert np.array_equal(getattr(opened, name), getattr(cube, name))
+
+    def test_calc_pol_matches_kernels(self, tmpdir):
+        cube = make_cube()
+        cube.save(str(tmpdir.join('cube')))
+        opened = PolCube.open(str(tmpdir.join('cube')))
+        # Tiles of a single row of spaxels
+        maps = opened.calc_pol(directory=str(tmpdir.join('pol')), max_memory=1)
+        expected = polmisc.calc_p_and_pa(cube.q, cube.u, cube.dq, cube.du)
+        for value, reference in zip(maps, expected):
+            assert isinstance(value, np.memmap)
+            assert np.allclose(value, reference)
+        assert np.allclose(np.load(str(tmpdir.join('pol', 'pa.npy'))), expected[2])
+
+        p, dp = polmisc.calc_p(cube.q[1, 2], cube.u[1, 2], cube.dq[1, 2], cube.du[1, 2])
+        assert np.allclose(maps[0][1, 2], p) and np.allclose(maps[1][1, 2], dp)
+
+    def test_integrate(self):
+        cube = make_cube()
+        p, dp, pa, dpa = cube.integrate(4500., 6000., debiased=False, max_memory=1)
+        assert p.shape == (5, 4)
+
+        window = (cube.wl >= 4500.) & (cube.wl <= 6000.)
+        n = window.sum()
+        q, u = cube.q[..., window].mean(-1), cube.u[..., window].mean(-1)
+        dq = np.sqrt((cube.dq[..., window]**2).sum(-1)) / n
+        du = np.sqrt((cube.du[..., window]**2).sum(-1)) / n
+        assert np.allclose(p, polmisc.calc_p(q, u, dq, du, debiased=False)[0])
+        assert np.allclose(pa, polmisc.calc_pa(q, u, dq, du)[0])
+        assert np.allclose(dpa, polmisc.calc_pa(q, u, dq, du)[1])
+
+        with pytest.raises(ValueError):
+            cube.integrate(100., 200.)
+
+    def test_spaxel(self):
+        cube = make_cube()
+        spectrum = cube.spaxel(2, 3)
+        assert np.array_equal(spectrum.q, cube.q[2, 3]) and np.array_equal(spectrum.wl, cube.wl)
+        assert np.allclose(spectrum.p, cube.calc_pol()[0][2, 3])
+
+    def test_needs_errors(self):
+        cube = make_cube()
+        cube.dq = None
+        with pytest.raises(ValueError):
+            cube.calc_pol()
@@ -0,0 +1,83 @@
+import pyspecpol.misc as polmisc
+import numpy as np
+import pytest
+
+da = pytest.importorskip('dask.array')
+from pyspecpol import daskdata  # noqa: E402
+
+
+def make_stokes(n=1000, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.normal(0., 1., n), rng.normal(0., 1., n), np.full(n, 0.3), np.full(n, 0.4)
+
+
+class TestDaskKernels(object):
+    def test_lazy_and_equal(self):
+        q, u, dq, du = make_stokes()
+        lazy = [da.from_array(x, chunks=128) for x in (q, u, dq, du)]
+        p, dp = polmisc.calc_p(*lazy)
+        assert isinstance(p, da.Array) and p.chunks == lazy[0].chunks
+        expected = polmisc.calc_p(q, u, dq, du)
+        assert np.allclose(p.compute(), expected[0]) and np.allclose(dp.compute(), expected[1])
+
+        pa, dpa = polmisc.calc_pa(*lazy)
+        assert np.allclose(pa.compute(), polmisc.calc_pa(q, u))
+        assert np.allclose(polmisc.calc_pa(lazy[0], lazy[1]).compute(), polmisc.calc_pa(q, u))
+        assert np.allclose(polmisc.debias_polarisation(lazy[0], lazy[2], method='mas').compute(),
+                           polmisc.debias_polarisation(q, dq, method='mas'))
+
+        fused = polmisc.calc_p_and_pa(*lazy)
+        computed = da.compute(*fused, scheduler='threads')
+        for value, reference in zip(computed, polmisc.calc_p_and_pa(q, u, dq, du)):
+            assert np.allclose(value, reference)
+
+
+class TestDaskPolData(object):
+    def test_from_poldata_and_compute(self):
+        q, u, dq, du = make_stokes()
+        poldata = polmisc.PolData()
+        poldata.wl = np.arange(1000.)
+        poldata.q, poldata.u, poldata.dq, poldata.du = q, u, dq, du
+
+        lazy = daskdata.DaskPolData.from_poldata(poldata, chunks=300)
+        assert lazy.columns == ('wl', 'q', 'dq', 'u', 'du') and len(lazy) == 1000
+        assert isinstance(lazy.p, da.Array), "Derived columns are built lazily"
+        computed = lazy.compute(scheduler='threads')
+        assert np.allclose(computed.p, poldata.p) and np.allclose(computed.dpa, poldata.dpa)
+
+        lazy.q = q * 2
+        assert 'p' not in lazy.columns
+        with pytest.raises(ValueError):
+            lazy.u = np.ones(10)
+
+    @pytest.mark.parametrize('scheduler', ['threads', 'processes'])
+    def test_binary_round_trip(self, tmpdir, scheduler):
+        q, u, dq, du = make_stokes(5000)
+        poldata = polmisc.PolData()
+        poldata.q, poldata.u, poldata.dq, poldata.du = q, u, dq, du
+        filename, output = str(tmpdir.join('in.pspol')), str(tmpdir.join('out.pspol'))
+        poldata.save_binary(filename)
+
+        lazy = daskdata.DaskPolData.from_binary(filename, chunks=1024)
+        assert lazy.q.numblocks == (5,)
+        lazy.calc_pol(method='wardle-kronberg').to_binary(output, scheduler=scheduler)
+
+        reduced = polmisc.PolData()
+        reduced.load_binary(output)
+        assert reduced.columns == ('q', 'dq', 'u', 'du', 'p', 'dp', 'pa', 'dpa')
+        poldata.calc_pol(method='wardle-kronberg')
+        assert np.allclose(reduced.p, poldata.p) and np.allclose(reduced.pa, poldata.pa)
+        assert np.array_equal(reduced.q, q)
+
+    def test_float32(self, tmpdir):
+        q, u, dq, du = (x.astype(np.float32) for x in make_stokes())
+        lazy = daskdata.DaskPolData(chunks=300)
+        lazy.q, lazy.u, lazy.dq, lazy.du = q, u, dq, du
+        assert lazy.calc_pol().p.dtype == np.float32
+
+        filename = str(tmpdir.join('single.pspol'))
+        lazy.to_binary(filename, scheduler='threads')
+        assert daskdata.DaskPolData.from_binary(filename).dpa.dtype == np.float32
+        computed = lazy.compute(scheduler='threads')
+        assert computed.dtype == np.float32
+        assert np.allclose(computed.dp, polmisc.calc_p(q, u, dq, du)[1])
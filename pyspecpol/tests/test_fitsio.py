@@ -0,0 +1,100 @@
+import pyspecpol.misc as polmisc
+from pyspecpol import fitsio
+from pyspecpol.collection import PolDataCollection
+from astropy.io import fits
+import numpy as np
+import pytest
+from pyspecpol.tests.helpers import make_poldata
+
+
+class TestPolDataFits(object):
+    def test_round_trip_linear_wcs(self, tmpdir):
+        filename = str(tmpdir.join('obs.fits'))
+        poldata = make_poldata().calc_pol()
+        poldata.save_fits(filename)
+
+        with fits.open(filename) as hdul:
+            # Linear wavelengths are only written as WCS keywords
+            assert 'WL' not in [hdu.name for hdu in hdul]
+            assert hdul['Q'].header['CDELT1'] == pytest.approx(4000. / 49)
+
+        loaded = polmisc.PolData()
+        loaded.load_fits(filename)
+        assert loaded.columns == poldata.columns
+        assert np.allclose(loaded.wl, poldata.wl, rtol=1e-12)
+        for name in ('q', 'dq', 'u', 'du', 'p', 'dp', 'pa', 'dpa'):
+            assert np.array_equal(getattr(loaded, name), getattr(poldata, name))
+
+    def test_irregular_wl_and_selected_columns(self, tmpdir):
+        filename = str(tmpdir.join('obs.fits'))
+        wl = np.sort(np.random.RandomState(1).uniform(4000., 8000., 50))
+        make_poldata(wl=wl).save_fits(filename)
+
+        loaded = fitsio.read_fits(filename, columns=['wl', 'q', 'u'])
+        assert loaded.columns == ('wl', 'q', 'u')
+        assert np.array_equal(loaded.wl, wl)
+
+    def test_overwrite(self, tmpdir):
+        filename = str(tmpdir.join('obs.fits'))
+        make_poldata().save_fits(filename)
+        with pytest.raises(OSError):
+            make_poldata().save_fits(filename)
+        make_poldata(seed=3).save_fits(filename, overwrite=True)
+        assert np.array_equal(fitsio.read_fits(filename).q, make_poldata(seed=3).q)
+
+    def test_pipeline_product(self, tmpdir):
+        # One HDU per Stokes parameter, wavelengths in the primary header
+        filename = str(tmpdir.join('pipeline.fits'))
+        primary = fits.PrimaryHDU()
+        primary.header.update({'CRVAL1': 3000., 'CD1_1': 2., 'CRPIX1': 2.})
+        fits.HDUList([primary, fits.ImageHDU(np.arange(10.), name='STOKES_Q'),
+                      fits.ImageHDU(-np.arange(10.), name='STOKES_U')]).writeto(filename)
+
+        loaded = fitsio.read_fits(filename, extnames={'q': 'STOKES_Q', 'u': 'STOKES_U'})
+        assert np.allclose(loaded.wl, 2998. + 2. * np.arange(10))
+        assert np.array_equal(loaded.u, -np.arange(10.))
+
+    def test_float32_and_other_hdus(self, tmpdir):
+        # Tables and later HDUs of the same name are ignored, as by astropy
+        filename = str(tmpdir.join('obs.fits'))
+        q = np.linspace(-1., 1., 20, dtype=np.float32)
+        fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(q, name='Q'),
+                      fits.BinTableHDU.from_columns([fits.Column('x', 'E', array=q)], name='U'),
+                      fits.ImageHDU(q[::-1], name='U'), fits.ImageHDU(q * 2., name='Q')]
+                     ).writeto(filename)
+
+        loaded = fitsio.read_fits(filename)
+        assert loaded.columns == ('q', 'u') and loaded.q.dtype == np.float64
+        assert np.array_equal(loaded.q, q) and np.array_equal(loaded.u, q[::-1])
+
+
+class TestCollectionFits(object):
+    def test_round_trip(self, tmpdir):
+        filename = str(tmpdir.join('stack.fits'))
+        collection = PolDataCollection.from_poldata([make_poldata(seed=i) for i in range(3)],
+                                                    times=[3., 1., 2.]).calc_pol()
+        fitsio.write_fits(collection, filename)
+        loaded = fitsio.read_fits_collection(filename)
+        assert loaded.columns == collection.columns
+        assert np.array_equal(loaded.time, collection.time)
+        assert np.array_equal(loaded.pa, collection.pa)
+
+        loaded = fitsio.read_fits_collection(filename, columns=['q'])
+        assert loaded.columns == ('q',)
+
+    def test_stack_fits(self, tmpdir):
+        filenames = []
+        for i, time in enumerate([5., 2., 9.]):
+            filenames.append(str(tmpdir.join('obs{0}.fits'.format(i))))
+            make_poldata(seed=i, time=time).save_fits(filenames[-1])
+
+        stacked = fitsio.stack_fits(filenames)
+        expected = PolDataCollection.from_poldata([fitsio.read_fits(f) for f in filenames])
+        assert np.array_equal(stacked.time, [2., 5., 9.])
+        assert stacked.columns == expected.columns
+        assert np.array_equal(stacked.wl, expected.wl)
+        assert np.array_equal(stacked.q, expected.q)
+
+        make_poldata(n=40).save_fits(filenames[0], overwrite=True)
+        with pytest.raises(ValueError):
+            fitsio.stack_fits(filenames)
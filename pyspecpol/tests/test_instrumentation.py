@@ -0,0 +1,66 @@
+import pyspecpol.misc as polmisc
+from pyspecpol import instrumentation
+import numpy as np
+import pkg_resources
+import json
+
+data_path = pkg_resources.resource_filename('pyspecpol', 'data')
+
+
+class TestInstrumentation(object):
+    def test_off_by_default(self):
+        polmisc.calc_p(np.ones(10), np.ones(10), np.ones(10), np.ones(10))
+        assert instrumentation._REPORT is None
+
+    def test_records_stages(self):
+        q = np.ones(100)
+        with instrumentation.instrument() as report:
+            polmisc.calc_p(q, q, q * 0.1, q * 0.1)
+            polmisc.calc_pa(q, q, q * 0.1, q * 0.1)
+            polmisc.calc_pa(1., 2.)
+            polmisc.PolData(data_path + '/poldata.csv')
+        assert instrumentation._REPORT is None
+
+        stats = report.stats
+        assert stats['calc_p']['calls'] == 1 and stats['calc_p']['elements'] == 100
+        assert stats['debias']['calls'] == 1, "Nested stages are recorded too"
+        # _pol_ang_and_err calls _pol_ang
+        assert stats['pa_err']['elements'] == 100 and stats['pa']['elements'] == 101
+        assert stats['load_file']['calls'] == 1 and stats['load_file']['elements'] == 1
+        assert stats['calc_p']['time'] >= stats['debias']['time'] > 0
+        assert stats['calc_p']['bytes'] is None
+
+        dumped = json.loads(report.to_json())
+        assert dumped['calc_p']['elements_per_second'] > 0
+        assert 'calc_p' in report.summary()
+
+    def test_trace_memory(self):
+        q = np.ones(10**5)
+        with instrumentation.instrument(trace_memory=True) as report:
+            polmisc.calc_p(q, q, q, q)
+        # p and dp (and temporaries) of 10^5 float64
+        assert report.stats['calc_p']['bytes'] >= 2 * 8 * 10**5
+        assert report.stats['calc_p']['bytes'] >= report.stats['debias']['bytes']
+
+    def test_to_json_file(self, tmpdir):
+        with instrumentation.instrument() as report:
+            polmisc.debias_polarisation(np.ones(5), np.ones(5) * 0.1)
+        filename = str(tmpdir.join('report.json'))
+        report.to_json(filename)
+        with open(filename) as f:
+            assert json.load(f)['debias']['calls'] == 1
+
+    def test_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+        q = np.ones(1000)
+
+        def work(i):
+            for _ in range(50):
+                polmisc.calc_p(q, q, q * 0.1, q * 0.1)
+
+        with instrumentation.instrument(trace_memory=True) as report:
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                list(pool.map(work, range(8)))
+            assert report._memory_stack == [], "Each thread should unwind its own stages"
+        assert report.stats['calc_p']['calls'] == 400 and report.stats['debias']['calls'] == 400
+        assert report.stats['calc_p']['elements'] == 400 * 1000
@@ -0,0 +1,47 @@
+from pyspecpol.utils import interpolation
+from pyspecpol.utils.interpolation import InterpolationPlan, interpolation_plan, resample
+import numpy as np
+
+
+class TestInterpolationPlan(object):
+    def setup_method(self):
+        self.wl_from = np.linspace(4000., 8000., 101)
+        self.wl_to = np.linspace(3990., 7995., 77)
+
+    def test_apply(self):
+        values = np.sin(self.wl_from / 300.)
+        plan = InterpolationPlan(self.wl_from, self.wl_to)
+        resampled = plan.apply(values)
+        inside = self.wl_to >= 4000.
+        assert np.isnan(resampled[~inside]).all()
+        assert np.allclose(resampled[inside], np.interp(self.wl_to[inside], self.wl_from, values))
+
+        # Stacks of epochs are resampled at once, errors by propagating the variance
+        errors = np.abs(np.vstack([values, 2 * values]))
+        resampled = plan.apply(errors, error=True)
+        left = np.searchsorted(self.wl_from, self.wl_to[inside], side='right') - 1
+        weight = (self.wl_to[inside] - self.wl_from[left]) / 40.
+        expected = np.sqrt(((1 - weight) * errors[:, left])**2 + (weight * errors[:, left + 1])**2)
+        assert resampled.shape == (2, 77) and np.allclose(resampled[:, inside], expected)
+
+        out = np.empty((2, 77))
+        assert plan.apply(errors, error=True, out=out) is out
+
+    def test_cache(self):
+        interpolation._PLAN_CACHE.clear()
+        plan = interpolation_plan(self.wl_from, self.wl_to)
+        # Matched by value, not by identity
+        assert interpolation_plan(self.wl_from.copy(), self.wl_to.copy()) is plan
+        shifted = self.wl_to.copy()
+        shifted[5] += 1.
+        assert interpolation_plan(self.wl_from, shifted) is not plan
+
+        for i in range(interpolation._PLAN_CACHE_SIZE):
+            interpolation_plan(self.wl_from, self.wl_to + i + 1)
+        assert sum(len(plans) for plans in interpolation._PLAN_CACHE.values()) == \
+            interpolation._PLAN_CACHE_SIZE
+        assert interpolation_plan(self.wl_from, self.wl_to) is not plan
+
+    def test_resample(self):
+        values = np.arange(101.)
+        assert np.allclose(resample(values, self.wl_from, self.wl_from), values)
@@ -0,0 +1,98 @@
+import pyspecpol.misc as polmisc
+from pyspecpol.collection import PolDataCollection
+from pyspecpol import isp
+import numpy as np
+import pytest
+from pyspecpol.tests.helpers import make_poldata
+
+
+class TestSerkowski(object):
+    def test_serkowski(self):
+        # p = p_max at wl_max
+        assert np.isclose(isp.serkowski(5500., 1.5, 5500.), 1.5)
+        p = isp.serkowski(np.array([4000., 5500., 7000.]), 1.5, 5500., k=1.15)
+        assert np.allclose(p, 1.5 * np.exp(-1.15 * np.log(5500. / np.array([4000., 5500., 7000.]))**2))
+
+    def test_isp_stokes(self):
+        wl = np.linspace(4000., 8000., 5)
+        q, u, dq, du = isp.isp_stokes(wl, 1., 5500., 22.5)
+        p = isp.serkowski(wl, 1., 5500.)
+        assert np.allclose(q, p * np.cos(np.pi / 4)) and np.allclose(u, p * np.sin(np.pi / 4))
+        assert np.allclose(dq, 0) and np.allclose(du, 0), "No parameter errors means no ISP error"
+
+        # Error on p_max only: dq = cos(2 theta) * p/p_max * dp_max
+        q, u, dq, du = isp.isp_stokes(wl, 1., 5500., 0., dp_max=0.1)
+        assert np.allclose(dq, 0.1 * p) and np.allclose(du, 0)
+
+        # q and u share the error on p_max: fully correlated. The error on theta anti-correlates
+        covqu = isp.isp_stokes(wl, 1., 5500., 22.5, dp_max=0.1, covariance=True)[4]
+        assert np.allclose(covqu, (0.1 * p) ** 2 / 2)
+        q, u, dq, du, covqu = isp.isp_stokes(wl, 1., 5500., 22.5, dtheta=1., covariance=True)
+        assert np.allclose(covqu, -dq * du)
+
+    def test_isp_stokes_cache(self):
+        wl = np.linspace(4000., 8000., 100)
+        first = isp.isp_stokes(wl, 1., 5500., 10.)
+        second = isp.isp_stokes(wl.copy(), 1., 5500., 10.)
+        assert first[0] is second[0], "The same parameters and grid should hit the cache"
+        assert not first[0].flags.writeable, "Cached arrays should be read-only"
+
+        third = isp.isp_stokes(wl, 1.1, 5500., 10.)
+        assert third[0] is not first[0]
+
+        # Same shape, ends and first step: only the comparison of the grids tells them apart
+        other = wl.copy()
+        other[50] += 1.
+        assert not np.array_equal(isp.isp_stokes(other, 1., 5500., 10.)[0], first[0])
+
+        # Modifying the grid afterwards does not change the cached key
+        wl[50] += 1.
+        assert isp.isp_stokes(np.linspace(4000., 8000., 100), 1., 5500., 10.)[0] is first[0]
+
+
+class TestRemoveISP(object):
+    def setup_method(self):
+        self.wl = np.linspace(4000., 8000., 5)
+        self.q_isp, self.u_isp, _, _ = isp.isp_stokes(self.wl, 1., 5500., 30.)
+
+    def test_remove_isp_poldata(self):
+        poldata = make_poldata(self.wl, self.q_isp + 0.5, self.u_isp - 0.2, dq=0.1, du=0.1)
+        poldata.calc_pol()
+
+        corrected = isp.remove_isp(poldata, 1., 5500., 30., dtheta=1.)
+        assert np.allclose(corrected.q, 0.5) and np.allclose(corrected.u, -0.2)
+        assert np.all(corrected.dq > 0.1), "ISP errors should be added to dq"
+        assert 'p' not in corrected.columns, "Derived columns should be cleared"
+        assert np.allclose(poldata.q, self.q_isp + 0.5), "in_place=False should not modify data"
+
+        isp.remove_isp(poldata, 1., 5500., 30., in_place=True)
+        assert np.allclose(poldata.q, 0.5) and np.allclose(poldata.dq, 0.1)
+        assert poldata.covqu is None, "No ISP error, no covariance"
+
+    def test_remove_isp_covariance(self):
+        _, _, dq_isp, du_isp, covqu_isp = isp.isp_stokes(self.wl, 1., 5500., 30., dp_max=0.2,
+                                                         covariance=True)
+        poldata = make_poldata(self.wl, self.q_isp + 0.5, self.u_isp - 0.2, dq=0.1, du=0.1)
+        corrected = isp.remove_isp(poldata, 1., 5500., 30., dp_max=0.2)
+        assert np.allclose(corrected.covqu, dq_isp * du_isp), "dp_max correlates q and u fully"
+
+        poldata.covqu = np.full(len(self.wl), 0.001)
+        corrected = isp.remove_isp(poldata, 1., 5500., 30., dp_max=0.2)
+        assert np.allclose(corrected.covqu, 0.001 + covqu_isp)
+
+        collection = PolDataCollection.from_poldata([poldata, poldata], times=[0., 1.])
+        corrected = isp.remove_isp(collection, 1., 5500., 30., dp_max=0.2)
+        assert corrected.covqu.shape == (2, len(self.wl))
+        assert np.allclose(corrected.covqu, 0.001 + covqu_isp)
+
+    def test_remove_isp_collection(self):
+        epochs = [make_poldata(self.wl, self.q_isp + i, self.u_isp, dq=0.1, du=0.1)
+                  for i in range(3)]
+        collection = PolDataCollection.from_poldata(epochs, times=[0., 1., 2.])
+
+        corrected = isp.remove_isp(collection, 1., 5500., 30.)
+        assert np.allclose(corrected.q, np.arange(3)[:, None]) and np.allclose(corrected.u, 0)
+
+    def test_remove_isp_bad_input(self):
+        with pytest.raises(TypeError):
+            isp.remove_isp(np.zeros(3), 1., 5500., 30.)
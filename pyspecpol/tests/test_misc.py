@@ -1,6 +1,9 @@
 import pyspecpol.misc as polmisc
+from pyspecpol import instrumentation
+from pyspecpol.collection import PolDataCollection
 import numpy as np
 import pkg_resources
+import pytest
 
 data_path = pkg_resources.resource_filename('pyspecpol', 'data')
 
@@ -20,6 +23,39 @@ class TestPolData(object):
         poldata.q[0] == 1.0 and poldata.dq[0] == 0.0 and poldata.u[0] == 1.0 and poldata.du[0] == 0.0\
         and poldata.pa[0] == 45 and poldata.dpa[0] == 0.0, 'The file has not been read correctly'
 
+    def test_load_file_is_quiet(self, capsys, caplog):
+        import logging
+        # Missing columns are reported through logging, nothing goes to stdout
+        with caplog.at_level(logging.DEBUG, logger='pyspecpol.misc'):
+            poldata = polmisc.PolData(data_path+'/poldata.csv')
+        assert capsys.readouterr().out == "", "load_file should not print"
+        assert "time" in caplog.text, "The missing 'time' column should be logged"
+        assert poldata.q.dtype == np.float64
+
+    def test_load_file_ignores_unknown_columns(self, tmpdir):
+        filename = str(tmpdir.join('extra_columns.csv'))
+        with open(filename, 'w') as f:
+            f.write("wl,comment,q,u\n4000,first,0.1,0.2\n4010,second,0.3,0.4\n")
+
+        poldata = polmisc.PolData(filename)
+        assert poldata.columns == ('wl', 'q', 'u'), "Only the recognised columns should be read"
+        assert np.allclose(poldata.u, [0.2, 0.4])
+
+    def test_load_file_large_file_kwargs(self, tmpdir, monkeypatch):
+        # Every file counts as large: pyarrow (if installed) must not break the read_csv kwargs
+        monkeypatch.setattr(polmisc, '_PYARROW_MIN_SIZE', 0)
+        filename = str(tmpdir.join('spaces.csv'))
+        with open(filename, 'w') as f:
+            f.write("# reduced spectrum\nwl  q   u\n4000 0.1  0.2\n4010  0.3 0.4\n")
+
+        poldata = polmisc.PolData()
+        poldata.load_file(filename, sep=r'\s+', comment='#')
+        assert np.allclose(poldata.u, [0.2, 0.4])
+        assert polmisc._csv_engine(filename, {'sep': ','}) == 'c'
+
+        poldata = polmisc.PolData(data_path+'/poldata.csv')
+        assert poldata.wl[0] == 4000 and poldata.pa[0] == 45
+
     def test_init_from_file_force(self):
         # Checking that the `force` parameter does its job
 
@@ -39,6 +75,227 @@ class TestPolData(object):
 
 
 
+class TestPolDataStorage(object):
+    def test_blank_columns_are_none(self):
+        poldata = polmisc.PolData()
+        assert all(getattr(poldata, name) is None for name in polmisc.COLUMNS), \
+            "Columns of a blank PolData should be None"
+        assert len(poldata) == 0 and poldata.columns == ()
+
+    def test_slots(self):
+        poldata = polmisc.PolData()
+        assert not hasattr(poldata, '__dict__'), "PolData should not have a __dict__"
+        with pytest.raises(AttributeError):
+            poldata.not_a_column = np.array([1., 2.])
+
+    def test_columns_are_views_of_one_block(self):
+        poldata = polmisc.PolData(data_path+'/poldata.csv')
+        assert poldata.time is None, "The test file has no time column"
+        assert poldata._data.flags['C_CONTIGUOUS']
+        for name in poldata.columns:
+            assert np.shares_memory(getattr(poldata, name), poldata._data), \
+                "Column {0} is not a view of the data block".format(name)
+
+    def test_set_and_clear_columns(self):
+        poldata = polmisc.PolData()
+        poldata.q = np.array([1., 2., 3.])
+        poldata.u = [0., 1., 2.]
+        assert len(poldata) == 3 and poldata.columns == ('q', 'u')
+
+        with pytest.raises(ValueError):
+            poldata.dq = np.array([0.1, 0.1])
+
+        poldata.u = None
+        assert poldata.u is None and poldata.columns == ('q',)
+
+    def test_copy_and_pickle(self):
+        import pickle
+        poldata = polmisc.PolData(data_path+'/poldata.csv')
+
+        copied = poldata.copy()
+        copied.q[0] = 5.
+        assert poldata.q[0] == 1.0, "The copy should not share its data block"
+
+        unpickled = pickle.loads(pickle.dumps(poldata))
+        assert unpickled.columns == poldata.columns
+        for name in poldata.columns:
+            assert np.array_equal(getattr(unpickled, name), getattr(poldata, name))
+
+    def test_only_filled_columns_are_stored(self):
+        import pickle
+        poldata = polmisc.PolData()
+        poldata.wl = np.linspace(4000., 9000., 100)
+        poldata.q = np.zeros(100)
+        poldata.u = np.ones(100)
+        assert poldata._data.shape[1] == 100 and len(poldata._data) < len(polmisc.COLUMNS)
+
+        poldata.p
+        for new in (poldata.copy(), pickle.loads(pickle.dumps(poldata))):
+            assert new._data.shape == (len(poldata.columns), 100)
+            for name in poldata.columns:
+                assert np.array_equal(getattr(new, name), getattr(poldata, name))
+        assert pickle.dumps(poldata) == pickle.dumps(poldata.copy()), \
+            "The pickle should not depend on the spare rows of the block"
+
+
+class TestPolDataBinary(object):
+    def test_save_and_load_binary(self, tmpdir):
+        filename = str(tmpdir.join('poldata.pspol'))
+        poldata = polmisc.PolData()
+        poldata.wl = np.linspace(4000., 9000., 1001)
+        poldata.q = np.random.normal(0., 1., 1001)
+        poldata.u = np.random.normal(0., 1., 1001)
+        poldata.save_binary(filename)
+
+        loaded = polmisc.PolData()
+        loaded.load_binary(filename)
+        assert isinstance(loaded._data, np.memmap), "The binary file should be memory mapped"
+        assert loaded.columns == ('wl', 'q', 'u') and loaded.dq is None
+        assert np.array_equal(loaded.wl, poldata.wl) and np.array_equal(loaded.q, poldata.q) and \
+            np.array_equal(loaded.u, poldata.u), "Binary round trip changed the data"
+
+        # Without force the data should not be overwritten
+        message = loaded.load_binary(filename)
+        assert "force=True" in message
+
+        # Copy on write by default: the file is left untouched
+        loaded.q[0] = 100.
+        reloaded = polmisc.PolData()
+        reloaded.load_binary(filename)
+        assert reloaded.q[0] == poldata.q[0], "The file should not be modified in mode 'c'"
+
+    def test_load_binary_with_fewer_columns(self, tmpdir, monkeypatch):
+        # Files written before the last columns were appended to COLUMNS
+        filename = str(tmpdir.join('old.pspol'))
+        block, filled = np.zeros((10, 5)), np.zeros(10, dtype=bool)
+        block[2], filled[2] = np.arange(5.), True
+        monkeypatch.setattr(polmisc, 'COLUMNS', polmisc.COLUMNS[:10])
+        polmisc._write_binary(filename, block, filled)
+        monkeypatch.undo()
+
+        loaded = polmisc.PolData()
+        loaded.load_binary(filename)
+        assert loaded.columns == ('q',) and loaded.nq is None
+        loaded.nq = np.ones(5)
+        assert loaded.columns == ('q', 'nq') and np.array_equal(loaded.q, np.arange(5.))
+
+    def test_load_binary_rejects_other_files(self):
+        with pytest.raises(ValueError):
+            polmisc.PolData().load_binary(data_path+'/poldata.csv')
+
+    def test_select_wl(self):
+        poldata = polmisc.PolData()
+        poldata.wl = np.arange(4000., 4010.)
+        poldata.q = np.arange(10.)
+
+        selection = poldata.select_wl(4002, 4005)
+        assert np.array_equal(selection.wl, [4002., 4003., 4004., 4005.])
+        assert np.array_equal(selection.q, [2., 3., 4., 5.])
+        assert np.shares_memory(selection._data, poldata._data), "select_wl should return a view"
+
+
+class TestPolDataArithmetic(object):
+    def make_poldata(self, q, u, dq, du, wl=(4000., 4010.)):
+        poldata = polmisc.PolData()
+        poldata.wl, poldata.q, poldata.u = np.array(wl), np.array(q), np.array(u)
+        poldata.dq, poldata.du = np.array(dq), np.array(du)
+        return poldata
+
+    def setup_method(self):
+        self.a = self.make_poldata([1., 2.], [3., 4.], [0.3, 0.3], [0.4, 0.4])
+        self.b = self.make_poldata([2., 4.], [1., 1.], [0.4, 0.4], [0.3, 0.3])
+
+    def test_add_and_subtract(self):
+        total = self.a + self.b
+        assert np.allclose(total.q, [3., 6.]) and np.allclose(total.u, [4., 5.])
+        assert np.allclose(total.dq, 0.5) and np.allclose(total.du, 0.5), \
+            "Errors should be added in quadrature"
+        assert np.allclose(self.a.q, [1., 2.]), "Out of place addition modified its operand"
+
+        difference = self.a - self.b
+        assert np.allclose(difference.q, [-1., -2.]) and np.allclose(difference.dq, 0.5)
+
+    def test_divide(self):
+        ratio = self.a / self.b
+        assert np.allclose(ratio.q, [0.5, 0.5])
+        # sqrt(0.3**2 + (0.5*0.4)**2) / 2
+        assert np.allclose(ratio.dq, np.sqrt(0.3**2 + 0.2**2) / np.array([2., 4.]))
+
+        half = self.a / 2
+        assert np.allclose(half.q, [0.5, 1.]) and np.allclose(half.dq, 0.15)
+
+    def test_in_place(self):
+        a = self.a.copy()
+        a.calc_pol()
+        block = a._data
+        a -= self.b
+        assert a._data is block, "In place subtraction should reuse the data block"
+        assert np.allclose(a.q, [-1., -2.]) and np.allclose(a.du, 0.5)
+        assert 'p' not in a.columns and 'pa' not in a.columns, "Derived columns should be cleared"
+        assert np.allclose(a.p, polmisc.calc_p(a.q, a.u, a.dq, a.du)[0]), \
+            "p should be recalculated from the new q and u"
+
+        a /= 2.
+        assert np.allclose(a.q, [-0.5, -1.]) and np.allclose(a.dq, 0.25)
+
+    def test_mismatched_grids(self):
+        other = self.make_poldata([1., 1.], [1., 1.], [0.1, 0.1], [0.1, 0.1], wl=(4005., 4015.))
+        with pytest.raises(ValueError):
+            self.a + other
+
+        resampled = other.resample(self.a.wl)
+        assert np.isnan(resampled.q[0]) and np.isclose(resampled.q[1], 1.)
+        assert np.isclose(resampled.dq[1], 0.1 * np.sqrt(0.5)), "Resampled error is wrong"
+        assert np.isclose((self.a + resampled).q[1], 3.)
+
+
+class TestStreaming(object):
+    def _write_file(self, tmpdir, n=10, step=10.):
+        filename = str(tmpdir.join('stream.csv'))
+        wl = 4000. + step * np.arange(n)
+        q, u = np.linspace(-1, 1, n), np.linspace(1, 2, n)
+        with open(filename, 'w') as f:
+            f.write("wl,q,dq,u,du\n")
+            for row in zip(wl, q, np.full(n, 0.1), u, np.full(n, 0.2)):
+                f.write(",".join(str(value) for value in row) + "\n")
+        return filename, wl, q, u
+
+    def test_read_chunks_by_rows(self, tmpdir):
+        filename, wl, q, u = self._write_file(tmpdir)
+        chunks = list(polmisc.read_chunks(filename, chunksize=3))
+
+        assert [len(chunk) for chunk in chunks] == [3, 3, 3, 1], "Chunks of 3 rows expected"
+        assert all(isinstance(chunk, polmisc.PolData) for chunk in chunks)
+        assert np.array_equal(np.concatenate([chunk.wl for chunk in chunks]), wl)
+
+    def test_read_chunks_by_wavelength(self, tmpdir):
+        filename, wl, q, u = self._write_file(tmpdir)
+        # Bins of 25 A starting at 4000 A: 3 pixels per bin, straddling the 4-row reads
+        chunks = list(polmisc.read_chunks(filename, chunksize=4, wl_step=25.))
+
+        assert [len(chunk) for chunk in chunks] == [3, 2, 3, 2], "Wavelength bins wrongly split"
+        assert [chunk.wl[0] for chunk in chunks] == [4000., 4030., 4050., 4080.]
+        assert np.allclose(np.concatenate([chunk.q for chunk in chunks]), q)
+
+    def test_read_chunks_by_wavelength_fine_grid(self, tmpdir):
+        # Pixel wavelengths falling on bin edges up to rounding used to stall the split
+        filename, wl, q, u = self._write_file(tmpdir, n=5000, step=0.1)
+        chunks = list(polmisc.read_chunks(filename, chunksize=1000, wl_step=0.3))
+
+        bins = [np.unique(np.floor((chunk.wl - 4000.) / 0.3)) for chunk in chunks]
+        assert all(len(chunk_bins) == 1 for chunk_bins in bins), "A chunk spans several bins"
+        assert len(np.unique(np.concatenate(bins))) == len(chunks), "A bin was split"
+        assert np.array_equal(np.concatenate([chunk.wl for chunk in chunks]), wl)
+
+    def test_calc_pol_chunks(self, tmpdir):
+        filename, wl, q, u = self._write_file(tmpdir)
+        chunks = polmisc.calc_pol_chunks(polmisc.read_chunks(filename, chunksize=4))
+        p = np.concatenate([chunk.p for chunk in chunks])
+
+        p_ref, dp_ref = polmisc.calc_p(q, u, np.full(10, 0.1), np.full(10, 0.2))
+        assert np.allclose(p, p_ref), "Chunk by chunk p differs from calc_p"
+
+
 class TestDegreeOfPolarisation(object):
     def test_pol_deg(self):
            # Inputs: Scalar
@@ -73,12 +330,52 @@ class TestDegreeOfPolarisation(object):
 
            # Inputs: list of values
            debiased_p_list = polmisc.debias_polarisation([2.,2.,2.], [1.,2.,1.])
-           assert debiased_p_list == [1.5, 2., 1.5], "Debiasing list of values. Wrong."
+           assert isinstance(debiased_p_list, np.ndarray), "Debiasing list should return an array."
+           assert np.allclose(debiased_p_list, [1.5, 2., 1.5]), "Debiasing list of values. Wrong."
 
            # Inputs: 1D numpy.ndarray
            debiased_p_list = polmisc.debias_polarisation(np.array([2.,2.,2.]),
                                                          np.array([1.,2.,1.]))
-           assert debiased_p_list == [1.5, 2., 1.5], "Debiasing numpy.ndarray of values. Wrong."
+           assert np.allclose(debiased_p_list, [1.5, 2., 1.5]), \
+               "Debiasing numpy.ndarray of values. Wrong."
+
+           # Inputs: 2D numpy.ndarray
+           debiased_p_2d = polmisc.debias_polarisation(np.array([[2., 2.], [2., 0.]]),
+                                                       np.array([[1., 2.], [1., 0.]]))
+           assert debiased_p_2d.shape == (2, 2), "Debiasing 2D array changed the shape."
+           assert np.allclose(debiased_p_2d, [[1.5, 2.], [1.5, 0.]]), "Debiasing 2D array. Wrong."
+
+    def test_debias_polarisation_out(self):
+           p = np.array([2., 2., 2.])
+           dp = np.array([1., 2., 1.])
+
+           # Writing into a separate buffer
+           out = np.empty(3)
+           result = polmisc.debias_polarisation(p, dp, out=out)
+           assert result is out, "The `out` buffer should be returned."
+           assert np.allclose(out, [1.5, 2., 1.5]), "Debiasing into `out`. Wrong."
+
+           # Debiasing in place
+           polmisc.debias_polarisation(p, dp, out=p)
+           assert np.allclose(p, [1.5, 2., 1.5]), "Debiasing in place. Wrong."
+
+    def test_debias_polarisation_methods(self):
+           p = np.array([2., 2., 0., 1.])
+           dp = np.array([1., 2., 1., 0.])
+
+           # Wardle & Kronberg: sqrt(p**2 - dp**2) above the error, 0 below
+           p_wk = polmisc.debias_polarisation(p, dp, method='wardle-kronberg')
+           assert np.allclose(p_wk, [np.sqrt(3), 0., 0., 1.]), "Wardle-Kronberg debiasing. Wrong."
+
+           # MAS: p - dp**2 * (1 - exp(-p**2/dp**2)) / (2p)
+           p_mas = polmisc.debias_polarisation(p, dp, method='mas')
+           expected = [2 - 0.25*(1 - np.exp(-4)), 2 - (1 - np.exp(-1)), 0., 1.]
+           assert np.allclose(p_mas, expected), "MAS debiasing. Wrong."
+           assert np.isclose(polmisc.debias_polarisation(2, 1, method='mas'), expected[0]), \
+               "MAS debiasing of a single value. Wrong."
+
+           with pytest.raises(ValueError):
+               polmisc.debias_polarisation(p, dp, method='not-a-method')
 
     def test_calculate_pol_deg(self):
         #### Inputs: Scalars
@@ -133,6 +430,39 @@ class TestDegreeOfPolarisation(object):
                 "Combining arrays and NOT debiasing, dp is wrong"
 
 
+class TestFusedPolarisation(object):
+    def test_calc_p_and_pa(self):
+        q = np.array([[1., 2., 3.], [0., 2., -1.]])
+        u = np.array([[1., 2., 3.], [0., 0., 0.]])
+        dq = np.array([.8, 1.2, .5])
+        du = np.array([.1, .2, .3])
+
+        p, dp, pa, dpa = polmisc.calc_p_and_pa(q, u, dq, du)
+        p_ref, dp_ref = polmisc.calc_p(q, u, dq, du)
+        pa_ref, dpa_ref = polmisc.calc_pa(q, u, dq, du)
+
+        assert np.allclose(p, p_ref) and np.allclose(dp, dp_ref, equal_nan=True), \
+            "Fused p and dp differ from calc_p"
+        assert np.allclose(pa, pa_ref) and np.allclose(dpa, dpa_ref), \
+            "Fused P.A. and its error differ from calc_pa"
+
+    def test_calc_p_and_pa_scalar(self):
+        p, dp, pa, dpa = polmisc.calc_p_and_pa(2, 3, 0.5, 0.7, debiased=False)
+        assert np.isclose(p, 3.6055512754639891) and np.isclose(dp, 0.64509987300715388), \
+            "Fused calculation from scalars, p or dp wrong."
+        assert np.isclose(pa, polmisc._pol_ang(2, 3)), "Fused calculation from scalars, P.A. wrong."
+        assert np.isclose(dpa, polmisc._pol_ang_and_err(2, 3, 0.5, 0.7)[1]), \
+            "Fused calculation from scalars, P.A. error wrong."
+
+    def test_calc_p_and_pa_out(self):
+        out = tuple(np.empty(3) for _ in range(4))
+        result = polmisc.calc_p_and_pa(np.array([1., 2., 3.]), np.array([1., 2., 3.]),
+                                       np.array([.8, 1.2, .5]), np.array([.1, .2, .3]), out=out)
+        assert all(res is buf for res, buf in zip(result, out)), "The `out` buffers were not used"
+        assert np.allclose(out[0], [1.1844038, 2.5667976, 4.20257130]), "Fused debiased p is wrong."
+        assert np.allclose(out[2], 22.5), "Fused P.A. is wrong."
+
+
 class TestPolarisationAngle(object):
     def test_pol_ang(self):
         # Inputs: Scalar
@@ -190,3 +520,168 @@ class TestPolarisationAngle(object):
         "P.A. error safeguards for q = u = 0 in array input failed"
 
 
+    def test_pol_ang_and_error_stacked(self):
+        # Inputs: 2D numpy.ndarray, e.g. (n_epochs, n_wl)
+        q = np.array([[0, 2, -1, 0], [0, 2, 0, 0]])
+        u = np.array([[2, 0, 0, -1], [0, 0, 0, -1]])
+        dq = np.array([0.1, 0.2, 0.05, 0.3])
+        du = np.array([0.05, 0.1, 0.1, 0.2])
+        pa, dpa = polmisc._pol_ang_and_err(q, u, dq, du)
+
+        assert pa.shape == dpa.shape == (2, 4), "P.A. calculation changed the shape of the stack"
+        assert np.allclose(pa, [[45, 0, 90, 135], [0, 0, 0, 135]]), \
+        "P.A. calculation from stacked arrays failing"
+        assert np.allclose(dpa, [[1.43239449, 1.43239449, 2.86478898, 8.59436693],
+                                 [90, 1.43239449, 90, 8.59436693]]), \
+        "P.A. error calculation from stacked arrays failing"
+
+    def test_pol_ang_and_error_keeps_numpy_error_state(self):
+        # The q = u = 0 safeguards should not change the global numpy error settings
+        before = np.geterr()
+        polmisc._pol_ang_and_err(np.array([0, 1]), np.array([0, 1]),
+                                 np.array([0.1, 0.1]), np.array([0.1, 0.1]))
+        assert np.geterr() == before, "The global numpy error state has been modified"
+
+    def test_calc_pa(self):
+        # Without errors the angle alone is returned
+        assert polmisc.calc_pa(1, 1) == 22.5, "calc_pa without errors failing"
+
+        pa, dpa = polmisc.calc_pa(0, 1, 0.1, 0.1)
+        assert pa == 45 and np.isclose(dpa, 2.8647889756), "calc_pa with errors failing"
+
+
+class TestCovariance(object):
+    def setup_method(self):
+        rng = np.random.RandomState(0)
+        self.q, self.u = rng.normal(0., 1., 20), rng.normal(0., 1., 20)
+        self.dq, self.du = rng.uniform(0.1, 0.3, 20), rng.uniform(0.1, 0.3, 20)
+        self.covqu = rng.uniform(-0.9, 0.9, 20) * self.dq * self.du
+
+    def test_first_order_propagation(self):
+        q, u, dq, du, covqu = self.q, self.u, self.dq, self.du, self.covqu
+        p, dp = polmisc.calc_p(q, u, dq, du, debiased=False, covqu=covqu)
+        pa, dpa = polmisc.calc_pa(q, u, dq, du, covqu=covqu)
+
+        # J cov J^T with the Jacobians of p and of the P.A. (in degrees)
+        p2 = q * q + u * u
+        jacobians = {'p': (q / np.sqrt(p2), u / np.sqrt(p2)),
+                     'pa': (-u / p2 * 90 / np.pi, q / p2 * 90 / np.pi)}
+        for error, (jq, ju) in ((dp, jacobians['p']), (dpa, jacobians['pa'])):
+            variance = jq * jq * dq * dq + ju * ju * du * du + 2 * jq * ju * covqu
+            assert np.allclose(error, np.sqrt(variance))
+
+        fused = polmisc.calc_p_and_pa(q, u, dq, du, debiased=False, covqu=covqu)
+        for value, expected in zip(fused, (p, dp, pa, dpa)):
+            assert np.allclose(value, expected)
+
+    def test_zero_covariance(self):
+        args = (self.q, self.u, self.dq, self.du)
+        for with_cov, without in ((polmisc.calc_p_and_pa(*args, covqu=0.),
+                                   polmisc.calc_p_and_pa(*args)),
+                                  (polmisc.calc_pa(*args, covqu=np.zeros(20)),
+                                   polmisc.calc_pa(*args))):
+            for value, expected in zip(with_cov, without):
+                assert np.allclose(value, expected)
+
+    def test_monte_carlo_agrees(self):
+        q, u, dq, du = np.array([0.5]), np.array([0.3]), np.array([0.02]), np.array([0.03])
+        covqu = 0.8 * dq * du
+        dp = polmisc.calc_p(q, u, dq, du, debiased=False, covqu=covqu)[1]
+        dp_mc = polmisc.calc_p(q, u, dq, du, debiased=False, covqu=covqu, n_draws=100000,
+                               seed=1)[1]
+        assert np.allclose(dp, dp_mc, rtol=0.03)
+
+    def test_poldata_and_collection(self):
+        poldata = polmisc.PolData()
+        poldata.wl = np.arange(20.)
+        poldata.q, poldata.u, poldata.dq, poldata.du = self.q, self.u, self.dq, self.du
+        poldata.p
+        poldata.covqu = self.covqu
+        assert 'p' not in poldata.columns, "Setting covqu should clear the derived columns"
+        expected = polmisc.calc_p_and_pa(self.q, self.u, self.dq, self.du, covqu=self.covqu)
+        assert np.allclose(poldata.dp, expected[1]) and np.allclose(poldata.dpa, expected[3])
+
+        collection = PolDataCollection.from_poldata([poldata, poldata], times=[1., 2.])
+        assert np.allclose(collection.calc_pol().dpa[1], expected[3])
+        assert np.allclose(collection.epoch(0).dp, expected[1])
+
+        # Resampling propagates the covariance with the squared weights
+        resampled = poldata.resample([0.5])
+        assert np.isclose(resampled.covqu[0], 0.25 * (self.covqu[0] + self.covqu[1]))
+
+    def test_arithmetic(self):
+        a = polmisc.PolData()
+        a.q, a.u, a.dq, a.du = self.q, self.u, self.dq, self.du
+        a.covqu = self.covqu
+        b = a.copy()
+        b.covqu = None
+        assert np.allclose((a + b).covqu, self.covqu) and np.allclose((a - a).covqu,
+                                                                     2 * self.covqu)
+        assert np.allclose((a / 2.).covqu, self.covqu / 4)
+        # cov(qa/qb, ua/ub) with qa/qb = ua/ub = 1
+        assert np.allclose((b / a).covqu, self.covqu / (self.q * self.u))
+
+
+class TestLazyDerivedColumns(object):
+    def setup_method(self):
+        self.poldata = polmisc.PolData()
+        self.poldata.q, self.poldata.u = np.array([1., 0.5]), np.array([0., 2.])
+        self.poldata.dq, self.poldata.du = np.array([0.1, 0.2]), np.array([0.1, 0.1])
+
+    def test_calculated_once(self):
+        poldata = self.poldata
+        assert poldata.columns == ('q', 'dq', 'u', 'du'), "Nothing calculated before access"
+        p, dp = polmisc.calc_p(poldata.q, poldata.u, poldata.dq, poldata.du)
+        assert np.allclose(poldata.p, p) and np.allclose(poldata.dp, dp)
+        assert 'pa' in poldata.columns and 'dpa' in poldata.columns
+        assert np.shares_memory(poldata.p, poldata._data), "Cached in the data block"
+
+        with instrumentation.instrument() as report:
+            poldata.p, poldata.pa, poldata.dp
+        assert report.stats == {}, "Cached values should not be recalculated"
+
+    def test_invalidated(self):
+        poldata = self.poldata
+        poldata.p
+        poldata.q = np.array([0., -1.])
+        assert 'p' not in poldata.columns
+        assert np.allclose(poldata.pa, polmisc.calc_pa(poldata.q, poldata.u))
+
+    def test_selection_copied_on_write(self):
+        from pyspecpol.isp import remove_isp
+        poldata = polmisc.PolData()
+        poldata.wl = np.arange(4000., 4005.)
+        poldata.q, poldata.u = np.ones(5), np.zeros(5)
+        poldata.dq, poldata.du = np.full(5, 0.01), np.full(5, 0.01)
+        p = poldata.p.copy()
+
+        for modify in (lambda sub: setattr(sub, 'q', [5., 5., 5.]),
+                       lambda sub: sub.__isub__(sub.copy()),
+                       lambda sub: remove_isp(sub, 1., 5500., 0., in_place=True),
+                       lambda sub: sub.calc_pol(debiased=False)):
+            sub = poldata.select_wl(4001., 4003.)
+            modify(sub)
+            assert not np.shares_memory(sub._data, poldata._data), "The selection was not copied"
+            assert np.array_equal(poldata.q, np.ones(5)) and np.array_equal(poldata.p, p)
+        assert np.allclose(sub.p, 1.)
+
+        # Reading a selection does not copy it
+        sub = poldata.select_wl(4001., 4003.)
+        assert np.allclose(sub.p, p[1:4]) and np.shares_memory(sub._data, poldata._data)
+
+    def test_without_errors(self):
+        poldata = self.poldata
+        poldata.dq = None
+        assert np.allclose(poldata.p, polmisc.calc_p(poldata.q, poldata.u))
+        assert poldata.dp is None and poldata.dpa is None
+        assert poldata.columns == ('q', 'u', 'du', 'p')
+
+        assert polmisc.PolData().p is None
+
+    def test_read_only(self, tmpdir):
+        filename = str(tmpdir.join('poldata.pspol'))
+        self.poldata.save_binary(filename)
+        loaded = polmisc.PolData()
+        loaded.load_binary(filename, mmap_mode='r')
+        assert np.allclose(loaded.pa, polmisc.calc_pa(self.poldata.q, self.poldata.u))
+        assert 'pa' not in loaded.columns
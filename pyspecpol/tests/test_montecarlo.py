@@ -0,0 +1,82 @@
+import pyspecpol.misc as polmisc
+from pyspecpol import montecarlo
+import numpy as np
+
+
+class TestMonteCarlo(object):
+    def test_high_snr_matches_first_order(self):
+        # At high S/N the MC errors are the first order errors
+        q, u = np.array([5., -3., 0.]), np.array([0., 4., 6.])
+        p_pct, pa_pct = montecarlo.mc_p_and_pa(q, u, 0.1, 0.1, n_draws=20000, seed=0)
+        p, dp = polmisc._pol_deg_and_err(q, u, 0.1, 0.1)
+        pa, dpa = polmisc._pol_ang_and_err(q, u, 0.1, 0.1)
+        assert p_pct.shape == (3, 3) and pa_pct.shape == (3, 3)
+        assert np.allclose(p_pct[1], p, rtol=1e-2)
+        assert np.allclose(0.5 * (p_pct[2] - p_pct[0]), dp, rtol=5e-2)
+        assert np.allclose(pa_pct[1], pa, atol=0.1)
+        assert np.allclose(0.5 * (pa_pct[2] - pa_pct[0]), dpa, rtol=5e-2)
+
+    def test_percentiles_match_numpy(self):
+        draws = np.random.RandomState(0).normal(size=(4, 101)).astype(np.float32)
+        expected = np.percentile(draws, [10., 50., 97.3], axis=1)
+        assert np.allclose(montecarlo._percentiles_in_place(draws.copy(), [10., 50., 97.3]),
+                           expected)
+
+    def test_angle_wrap(self):
+        # Angle close to 0: the distribution straddles 0/180 and must not be split
+        p_pct, pa_pct = montecarlo.mc_p_and_pa(1., -0.01, 0.05, 0.05, n_draws=10000, seed=0)
+        assert pa_pct.shape == (3,)
+        assert pa_pct[2] - pa_pct[0] < 5.
+
+    def test_correlation(self):
+        # Fully correlated q and u along (1, 1): p varies, the angle does not
+        p_pct, pa_pct = montecarlo.mc_p_and_pa(1., 1., 0.1, 0.1, covqu=0.01, n_draws=10000,
+                                               seed=0)
+        assert np.allclose(pa_pct, 22.5, atol=1e-3)
+        assert np.isclose(0.5 * (p_pct[2] - p_pct[0]), 0.1 * np.sqrt(2), rtol=5e-2)
+
+    def test_reproducible_and_chunked(self):
+        q = np.random.RandomState(1).normal(size=(3, 50))
+        kwargs = dict(n_draws=1000, seed=42, max_memory=4 * 1000 * 3 * 7)
+        first = montecarlo.mc_p_and_pa(q, q.T[::-1].T, 0.3, 0.3, **kwargs)
+        second = montecarlo.mc_p_and_pa(q, q.T[::-1].T, 0.3, 0.3, n_jobs=2, **kwargs)
+        assert first[0].shape == (3, 3, 50)
+        assert np.array_equal(first[0], second[0]) and np.array_equal(first[1], second[1])
+
+    def test_memory_budget(self):
+        import tracemalloc
+        q = np.random.RandomState(2).normal(size=4000)
+        budget = 4 * 1000 * montecarlo._MC_ARRAYS_PER_CHUNK * 1000
+        montecarlo.mc_p_and_pa(q[:2], q[:2], 0.3, 0.3, n_draws=10, seed=0)
+        tracemalloc.start()
+        try:
+            montecarlo.mc_p_and_pa(q, q, 0.3, 0.3, covqu=0.01, n_draws=1000, seed=0,
+                                   max_memory=budget)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        assert peak < 1.1 * budget, "The draws of a chunk exceed the memory budget"
+
+    def test_calc_p_and_calc_pa(self):
+        q, u = np.array([5., 0.]), np.array([0., 6.])
+        p, dp = polmisc.calc_p(q, u, 0.1, 0.1, n_draws=10000, seed=0)
+        assert np.allclose(p, polmisc.calc_p(q, u, 0.1, 0.1)[0])
+        assert np.allclose(dp, 0.1, rtol=5e-2)
+        pa, dpa = polmisc.calc_pa(1., 1., 0.1, 0.1, n_draws=10000, seed=0)
+        assert np.isclose(pa, 22.5)
+        assert isinstance(dpa, float) and np.isclose(dpa, polmisc.calc_pa(1., 1., 0.1, 0.1)[1],
+                                                     rtol=5e-2)
+
+    def test_calc_p_and_calc_pa_n_jobs(self, monkeypatch):
+        calls = []
+
+        def mc_p_and_pa(*args, **kwargs):
+            calls.append(kwargs['n_jobs'])
+            return montecarlo.mc_p_and_pa(*args, **kwargs)
+
+        monkeypatch.setattr(polmisc, 'mc_p_and_pa', mc_p_and_pa)
+        q, u = np.linspace(-1., 1., 20), np.linspace(1., -0.5, 20)
+        for func in (polmisc.calc_p, polmisc.calc_pa):
+            assert np.array_equal(func(q, u, 0.2, 0.2, n_draws=500, seed=3, n_jobs=2)[1],
+                                  func(q, u, 0.2, 0.2, n_draws=500, seed=3)[1])
+        assert calls == [2, 1, 2, 1], "n_jobs should be passed to mc_p_and_pa"
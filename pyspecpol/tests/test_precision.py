@@ -0,0 +1,137 @@
+import pyspecpol.misc as polmisc
+from pyspecpol import precision, binning, reduction
+from pyspecpol.collection import PolDataCollection
+from pyspecpol.cube import PolCube
+from pyspecpol.montecarlo import mc_p_and_pa
+from pyspecpol import fitsio
+from astropy.io import fits
+import numpy as np
+import pickle
+import pytest
+from pyspecpol.tests.helpers import make_poldata
+
+F32 = np.dtype(np.float32)
+
+
+class TestPolicy(object):
+    def test_set_and_use_precision(self):
+        assert precision.get_precision() == np.float64
+        with precision.use_precision('float32'):
+            assert precision.get_precision() == F32
+            assert polmisc.PolData().dtype == F32
+            assert precision._as_float([1, 2]).dtype == F32
+        assert precision.get_precision() == np.float64
+
+        precision.set_precision(np.float32)
+        try:
+            assert make_poldata().q.dtype == F32
+        finally:
+            precision.set_precision('float64')
+
+        with pytest.raises(ValueError):
+            precision.set_precision('float16')
+
+    def test_result_dtype(self):
+        x32, x64 = np.ones(3, dtype=F32), np.ones(3)
+        assert precision._result_dtype(x32, 0.5, None) == F32
+        assert precision._result_dtype(x32, x64) == np.float64
+        assert precision._result_dtype(np.arange(3)) == np.float64
+
+
+class TestFloat32PolData(object):
+    def test_block_and_copies(self):
+        poldata = make_poldata(dtype='float32')
+        assert poldata._data.dtype == F32 and poldata.p.dtype == F32
+        for copy in (poldata.copy(), poldata.select_wl(5000., 6000.),
+                     poldata.resample(np.linspace(4500., 7500., 50)),
+                     pickle.loads(pickle.dumps(poldata)), poldata / 2.):
+            assert copy.dtype == F32
+
+        double = poldata.astype('float64')
+        assert double.q.dtype == np.float64 and np.array_equal(double.q, poldata.q)
+        assert polmisc.PolData(dtype='float32').astype(np.float64).dtype == np.float64
+
+    def test_kernels_keep_precision(self):
+        single, double = make_poldata(dtype='float32'), make_poldata()
+        args32 = (single.q, single.u, single.dq, single.du)
+        args64 = (double.q, double.u, double.dq, double.du)
+        covqu = np.full(len(single), 0.01, dtype=F32)
+        for method in ('wang', 'wardle-kronberg', 'mas'):
+            results32 = polmisc.calc_p_and_pa(*args32, method=method, covqu=covqu)
+            results64 = polmisc.calc_p_and_pa(*args64, method=method, covqu=0.01)
+            for value32, value64 in zip(results32, results64):
+                assert value32.dtype == F32
+                assert np.allclose(value32, value64, rtol=1e-5, atol=1e-5)
+
+        assert all(x.dtype == F32 for x in polmisc.calc_p(*args32) + polmisc.calc_pa(*args32))
+        assert polmisc.calc_p(*args32[:2]).dtype == F32
+        assert all(x.dtype == F32 for x in mc_p_and_pa(*args32, n_draws=100, seed=0))
+
+    def test_file_io(self, tmpdir):
+        filename = str(tmpdir.join('obs.csv'))
+        make_poldata().save_csv(filename)
+        with precision.use_precision('float32'):
+            poldata = polmisc.PolData(filename)
+            chunks = list(polmisc.read_chunks(filename, chunksize=64))
+        assert poldata.dtype == F32 and all(chunk.dtype == F32 for chunk in chunks)
+
+        # Binary and FITS files are written in single precision, half the size
+        binary = str(tmpdir.join('obs.pspol'))
+        poldata.save_binary(binary)
+        loaded = polmisc.PolData()
+        loaded.load_binary(binary)
+        assert loaded.dtype == F32 and np.array_equal(loaded.q, poldata.q)
+
+        fits_file = str(tmpdir.join('obs.fits'))
+        poldata.save_fits(fits_file)
+        with fits.open(fits_file) as hdul:
+            assert hdul['Q'].header['BITPIX'] == -32
+        assert fitsio.read_fits(fits_file).dtype == np.float64
+        loaded = fitsio.read_fits(fits_file, dtype='float32')
+        assert loaded.dtype == F32 and np.array_equal(loaded.q, poldata.q)
+
+
+class TestFloat32Stacks(object):
+    def test_collection(self, tmpdir):
+        epochs = [make_poldata(seed=i, dtype='float32') for i in range(3)]
+        collection = PolDataCollection.from_poldata(epochs, times=[0., 1., 2.]).calc_pol()
+        assert collection.dtype == F32 and collection.p.dtype == F32
+        assert collection.epoch(1).dtype == F32
+        assert collection.resample(np.linspace(4500., 7500., 50)).dtype == F32
+        mixed = epochs + [epochs[0].astype('float64')]
+        assert PolDataCollection.from_poldata(mixed).dtype == np.float64
+
+        filename = str(tmpdir.join('stack.fits'))
+        fitsio.write_fits(collection, filename)
+        assert fitsio.read_fits_collection(filename, dtype='float32').dtype == F32
+
+    def test_binning_accumulates_in_float64(self):
+        # An offset large against the S/N: float32 cumulative sums would lose the bins' S/N
+        single = make_poldata(n=20000, dtype='float32')
+        single.q += 50.
+        double = single.astype('float64')
+
+        binned32, edges32 = binning.adaptive_rebin(single, 1000.)
+        binned64, edges64 = binning.adaptive_rebin(double, 1000.)
+        assert np.array_equal(edges32, edges64)
+        assert binned32.dtype == F32
+        assert np.allclose(binned32.q, binned64.q, rtol=1e-6)
+
+        binned32 = binning.rebin(single, 100., flux=np.full(len(single), 1e4))
+        assert binned32.q.dtype == F32
+        assert np.allclose(binned32.dq, binning.rebin(double, 100.).dq, rtol=1e-6)
+
+    def test_reduction_and_cube(self, tmpdir):
+        rng = np.random.RandomState(0)
+        o = rng.uniform(1e4, 2e4, (4, 100)).astype(F32)
+        e = rng.uniform(1e4, 2e4, (4, 100)).astype(F32)
+        poldata = reduction.reduce_beams(np.linspace(4000., 8000., 100), o, e, theta0=10.)
+        assert poldata.dtype == F32 and poldata.covqu.dtype == F32
+
+        q = rng.normal(0., 1., (3, 4, 100)).astype(F32)
+        cube = PolCube(np.arange(100.), q, q[::-1], dq=np.full_like(q, 0.1),
+                       du=np.full_like(q, 0.2))
+        cube.save(str(tmpdir))
+        cube = PolCube.open(str(tmpdir))
+        assert cube.dtype == F32 and all(x.dtype == F32 for x in cube.calc_pol())
+        assert all(x.dtype == F32 for x in cube.integrate(20., 60.))
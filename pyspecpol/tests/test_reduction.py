@@ -0,0 +1,133 @@
+from pyspecpol import reduction
+import numpy as np
+import pytest
+
+
+def make_beams(q, u, hwp_angles=reduction.HWP_ANGLES, flux=1e4):
+    """ o and e beams of a source with Stokes q and u, (..., n_hwp, n_wl) """
+    angles = np.deg2rad(4 * np.asarray(hwp_angles))[:, None]
+    f = q[..., None, :] * np.cos(angles) + u[..., None, :] * np.sin(angles)
+    return flux * (1 + f) / 2, flux * (1 - f) / 2
+
+
+class TestReduction(object):
+    def test_flux_differences(self):
+        f, df = reduction.flux_differences(np.array([60., 50.]), np.array([40., 50.]))
+        assert np.allclose(f, [0.2, 0.])
+        # Poisson: dF = 2 sqrt(o e / (o + e)) / (o + e)
+        assert np.allclose(df, 2 * np.sqrt(np.array([24., 25.])) / 100.)
+        f, df = reduction.flux_differences(60., 40., do=1., de=0.)
+        assert np.isclose(df, 2 * 40. / 100.**2)
+
+    def test_beams_to_stokes(self):
+        q, u = np.array([0.01, -0.02, 0.]), np.array([0., 0.03, -0.01])
+        o, e = make_beams(q, u)
+        q_red, u_red, dq, du = reduction.beams_to_stokes(o, e)
+        assert np.allclose(q_red, q) and np.allclose(u_red, u)
+        # Poisson errors with 4 angles: dq = du = dF / sqrt(2), dF ~ 1/sqrt(flux)
+        assert np.allclose(dq, 1e-2 / np.sqrt(2), rtol=1e-3) and np.allclose(du, dq, rtol=1e-3)
+
+    def test_stacked_sets(self):
+        rng = np.random.RandomState(0)
+        q, u = rng.normal(0, 0.01, (3, 5, 20)), rng.normal(0, 0.01, (3, 5, 20))
+        o, e = make_beams(q, u)
+        q_red, u_red, dq, du = reduction.beams_to_stokes(o, e)
+        assert q_red.shape == (3, 5, 20)
+        assert np.allclose(q_red, q) and np.allclose(u_red, u)
+        single = reduction.beams_to_stokes(o[1, 2], e[1, 2])
+        assert np.allclose(single[0], q_red[1, 2]) and np.allclose(single[3], du[1, 2])
+
+    def test_wrong_shape(self):
+        with pytest.raises(ValueError):
+            reduction.beams_to_stokes(np.ones((3, 10)), np.ones((3, 10)))
+
+    def test_zero_angle(self, tmpdir):
+        table = tmpdir.join('zero_angle.csv')
+        table.write('wl,theta0\n4000,5\n8000,15\n')
+        reduction.register_zero_angle_table('FORS2', 'test', str(table))
+        wl = np.array([4000., 6000., 8000.])
+        assert np.allclose(reduction.zero_angle(wl, 'FORS2', 'test'), [5., 10., 15.])
+        assert reduction._load_zero_angle_table.cache_info().currsize == 1
+        with pytest.raises(KeyError):
+            reduction.zero_angle(wl, 'FORS2', 'unknown')
+
+        # The correction rotates the polarisation angle by theta0
+        q, u = np.full(3, 0.02), np.zeros(3)
+        o, e = make_beams(q, u)
+        poldata = reduction.reduce_beams(wl, o, e, instrument='FORS2', grism='test', time=1.)
+        poldata.calc_pol(debiased=False)
+        assert np.allclose(poldata.pa, [5., 10., 15.]) and np.allclose(poldata.p, 0.02)
+        assert np.allclose(poldata.time, 1.)
+
+    def test_reduce_night(self):
+        wl = np.linspace(4000., 8000., 10)
+        q, u = np.full((4, 10), 0.01), np.linspace(-0.01, 0.01, 40).reshape(4, 10)
+        o, e = make_beams(q, u)
+        poldatas = reduction.reduce_beams(wl, o, e, time=[1., 2., 3., 4.])
+        assert len(poldatas) == 4
+        assert np.allclose(poldatas[2].u, u[2]) and np.allclose(poldatas[3].time, 4.)
+        assert poldatas[0].columns == ('wl', 'time', 'q', 'dq', 'u', 'du', 'nq', 'dnq', 'nu',
+                                       'dnu', 'hwp_chi2', 'hwp_flux_dev', 'covqu')
+
+    def test_covariance(self):
+        q, u = np.array([0.01, -0.02]), np.array([0.03, 0.])
+        o, e = make_beams(q, u)
+        # Errors that differ between the HWP angles correlate q and u
+        do = np.sqrt(o) * np.array([1., 2., 1., 3.])[:, None]
+        q_red, u_red, dq, du, covqu = reduction.beams_to_stokes(o, e, do=do, covariance=True)
+        f, df = reduction.flux_differences(o, e, do=do)
+        four_theta = np.deg2rad(4 * np.array(reduction.HWP_ANGLES))
+        expected = np.sum(0.25 * np.cos(four_theta) * np.sin(four_theta) * (df ** 2).T, axis=1)
+        assert np.allclose(covqu, expected) and np.all(covqu != 0)
+
+        # The zero angle rotates the whole covariance matrix
+        rotated = reduction.beams_to_stokes(o, e, do=do, theta0=20., covariance=True)
+        angle = np.deg2rad(40.)
+        rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+        for i in range(2):
+            matrix = np.array([[dq[i] ** 2, covqu[i]], [covqu[i], du[i] ** 2]])
+            expected = rotation.dot(matrix).dot(rotation.T)
+            assert np.allclose([rotated[2][i] ** 2, rotated[3][i] ** 2, rotated[4][i]],
+                               [expected[0, 0], expected[1, 1], expected[0, 1]])
+
+
+class TestDiagnostics(object):
+    def test_nulls_vanish(self):
+        q, u = np.array([0.01, -0.02]), np.array([0.03, 0.])
+        o, e = make_beams(q, u)
+        q_red, u_red, dq, du, diagnostics = reduction.beams_to_stokes(o, e, diagnostics=True)
+        assert np.allclose(q_red, q) and np.allclose(u_red, u)
+        assert np.allclose(diagnostics['nq'], 0) and np.allclose(diagnostics['nu'], 0)
+        assert np.allclose(diagnostics['dnq'], dq) and np.allclose(diagnostics['dnu'], du)
+        assert np.allclose(diagnostics['hwp_chi2'], 0) and np.allclose(diagnostics['hwp_flux_dev'], 0)
+
+    def test_inconsistent_angle(self):
+        # A spurious polarisation of 1% at the first HWP angle only, and 10% less flux
+        o, e = make_beams(np.zeros((2, 3)), np.zeros((2, 3)), flux=1e6)
+        o[1, 0] *= 0.9 * 1.01 / 1.
+        e[1, 0] *= 0.9 * 0.99
+        q_red, u_red, dq, du, diagnostics = reduction.beams_to_stokes(o, e, diagnostics=True)
+        f0 = (1.01 - 0.99) / 2.
+        # nq = (F_0 + F_45) / 2 and the residuals of the F_i are -+ F_0 / 2
+        assert np.allclose(diagnostics['nq'][1], f0 / 2) and np.allclose(diagnostics['nu'], 0)
+        assert np.allclose(diagnostics['nq'][0], 0)
+        assert np.all(diagnostics['hwp_chi2'][1] > 10) and np.allclose(diagnostics['hwp_chi2'][0], 0)
+        assert np.allclose(diagnostics['hwp_flux_dev'][1], 0.1 / 1.3)
+
+    def test_two_angles(self):
+        o, e = make_beams(np.zeros(3), np.zeros(3), hwp_angles=(0., 45.))
+        diagnostics = reduction.beams_to_stokes(o, e, hwp_angles=(0., 45.), diagnostics=True)[4]
+        assert np.all(np.isnan(diagnostics['hwp_chi2']))
+
+    def test_poldata_columns(self):
+        wl = np.linspace(4000., 8000., 10)
+        o, e = make_beams(np.full((2, 10), 0.01), np.zeros((2, 10)))
+        poldatas = reduction.reduce_beams(wl, o, e, theta0=10.)
+        assert poldatas[0].nq is not None and np.allclose(poldatas[1].hwp_chi2, 0)
+        assert np.allclose(poldatas[1].nq, 0)
+        poldata = reduction.reduce_beams(wl, o[0], e[0], diagnostics=False)
+        assert poldata.nq is None
+
+        # The diagnostics no longer hold once q and u are modified
+        combined = poldatas[0] + poldatas[1]
+        assert combined.nq is None and combined.hwp_chi2 is None
@@ -0,0 +1,152 @@
+# This sub-module holds the linear interpolation helpers shared by the modules that
+# move data between wavelength grids.
+#
+# Resampling is split in two: the plan (index search and weights, which only depend on the two
+# grids) and its application to the values. Plans are cached per pair of grids, so resampling
+# every column of many epochs that share a grid costs a single index search.
+import collections
+import threading
+import numpy as np
+from ..precision import _as_float
+
+# Number of (source grid, target grid) plans kept by `interpolation_plan`
+_PLAN_CACHE_SIZE = 32
+_PLAN_CACHE = collections.OrderedDict()
+_PLAN_CACHE_LOCK = threading.Lock()
+
+
+class InterpolationPlan(object):
+    """
+    Linear interpolation from the grid `wl_from` to the grid `wl_to` (both increasing).
+
+    Notes
+    -----
+    The neighbours and weights of the pixels of `wl_to` are found once, then `apply` resamples
+    any (..., len(wl_from)) array: one column, or a stack of epochs at once. Pixels of `wl_to`
+    outside of `wl_from` are NaN. The values keep their precision (float32 or float64).
+
+    Parameters
+    ----------
+    wl_from : numpy.ndarray
+        Grid of the data
+    wl_to : numpy.ndarray
+        Grid to resample the data on
+    """
+
+    __slots__ = ('wl_from', 'wl_to', 'left', 'right', 'weight', 'outside', '_weights')
+
+    def __init__(self, wl_from, wl_to):
+        # Copies, so the cache can compare them with later grids
+        self.wl_from = np.array(wl_from, dtype=float)
+        self.wl_to = np.array(wl_to, dtype=float)
+
+        index = np.searchsorted(self.wl_from, self.wl_to, side='right') - 1
+        outside = (index < 0) | (self.wl_to > self.wl_from[-1])
+        np.clip(index, 0, len(self.wl_from) - 2, out=index)
+        self.left, self.right = index, index + 1
+        self.weight = (self.wl_to - self.wl_from[self.left]) / \
+                      (self.wl_from[self.right] - self.wl_from[self.left])
+        self.outside = np.flatnonzero(outside)
+        # dtype -> weights of the values and of the variances, see `_weights_of`
+        self._weights = {}
+
+    def _weights_of(self, dtype):
+        """ (1-w, w, (1-w)**2, w**2) in the precision of the values, so no array is upcast """
+        weights = self._weights.get(dtype)
+        if weights is None:
+            left_weight = 1 - self.weight
+            weights = tuple(weight.astype(dtype) for weight in (
+                left_weight, self.weight, left_weight ** 2, self.weight ** 2))
+            self._weights[dtype] = weights
+        return weights
+
+    def matches(self, wl_from, wl_to):
+        """ Whether this plan interpolates from `wl_from` to `wl_to` """
+        return np.array_equal(self.wl_from, wl_from) and np.array_equal(self.wl_to, wl_to)
+
+    def apply(self, values, error=False, variance=False, out=None):
+        """
+        Resamples `values`, or errors (or variances and covariances) by propagating the variance.
+
+        Parameters
+        ----------
+        values : numpy.ndarray
+            (..., len(wl_from)) array
+        error : bool, optional
+            Whether `values` are errors: sqrt((1-w)**2 * left**2 + w**2 * right**2) instead of
+            (1-w) * left + w * right. Default is False.
+        variance : bool, optional
+            Whether `values` are variances or covariances: (1-w)**2 * left + w**2 * right.
+            Default is False.
+        out : numpy.ndarray, optional
+            (..., len(wl_to)) array to write the result in
+
+        Returns
+        -------
+        (..., len(wl_to)) numpy.ndarray
+        """
+        values = _as_float(values)
+        left_weight, right_weight, left_weight2, right_weight2 = self._weights_of(values.dtype)
+        left = np.take(values, self.left, axis=-1)
+        right = np.take(values, self.right, axis=-1)
+        if out is None:
+            out = left
+        if error:
+            np.multiply(left, left, out=left)
+            left *= left_weight2
+            np.multiply(right, right, out=right)
+            right *= right_weight2
+            np.add(left, right, out=out)
+            np.sqrt(out, out=out)
+        elif variance:
+            left *= left_weight2
+            right *= right_weight2
+            np.add(left, right, out=out)
+        else:
+            left *= left_weight
+            right *= right_weight
+            np.add(left, right, out=out)
+        out[..., self.outside] = np.nan
+        return out
+
+
+def interpolation_plan(wl_from, wl_to):
+    """
+    The `InterpolationPlan` from `wl_from` to `wl_to`, built once and cached per pair of grids.
+
+    Notes
+    -----
+    The cache keeps the last `_PLAN_CACHE_SIZE` plans. Grids are matched by value (a plan built
+    for one array is reused for another array with the same wavelengths), first on their length
+    and end points, then on all their values.
+    """
+    wl_from = np.asarray(wl_from, dtype=float)
+    wl_to = np.asarray(wl_to, dtype=float)
+    key = (len(wl_from), wl_from[0], wl_from[-1], len(wl_to), wl_to[0], wl_to[-1])
+
+    with _PLAN_CACHE_LOCK:
+        plans = _PLAN_CACHE.get(key, [])
+        for plan in plans:
+            if plan.matches(wl_from, wl_to):
+                _PLAN_CACHE.move_to_end(key)
+                return plan
+
+    plan = InterpolationPlan(wl_from, wl_to)
+    with _PLAN_CACHE_LOCK:
+        _PLAN_CACHE.setdefault(key, []).append(plan)
+        _PLAN_CACHE.move_to_end(key)
+        while sum(len(plans) for plans in _PLAN_CACHE.values()) > _PLAN_CACHE_SIZE:
+            oldest = next(iter(_PLAN_CACHE))
+            _PLAN_CACHE[oldest].pop(0)
+            if not _PLAN_CACHE[oldest]:
+                del _PLAN_CACHE[oldest]
+    return plan
+
+
+def resample(values, wl_from, wl_to, error=False, variance=False):
+    """
+    Linearly resamples (..., len(wl_from)) `values` on the grid `wl_to` with a cached
+    `InterpolationPlan` (errors: `error=True`, variances: `variance=True`, see
+    `InterpolationPlan.apply`).
+    """
+    return interpolation_plan(wl_from, wl_to).apply(values, error=error, variance=variance)